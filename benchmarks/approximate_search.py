@@ -0,0 +1,87 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../vector_embeddings_handler')))
+
+import faiss
+import numpy as np
+from index_types import INDEX_TYPES, build_index
+from shared.chunk_store import read_index
+
+# Recall@k against the exact flat index, single-query latency, file size, load time and build time of every
+# index type the indexer can publish. Vectors are drawn around random cluster centres, like embeddings of
+# chunks from a limited set of guides, and queries are perturbed copies of stored vectors.
+#
+#   python benchmarks/approximate_search.py --chunks 100000 --dimensions 1536 --nprobe 8 16 32
+
+
+def clustered_vectors(count, dimensions, clusters, rng):
+  centres = rng.standard_normal((clusters, dimensions), dtype=np.float32)
+  vectors = centres[rng.integers(0, clusters, count)] + 0.35 * rng.standard_normal((count, dimensions), dtype=np.float32)
+  return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def measure(index, path, queries, truth, k):
+  faiss.write_index(index, path)
+  started = time.perf_counter()
+  loaded = read_index(path)
+  load_ms = (time.perf_counter() - started) * 1000
+  samples = []
+  found = []
+  for query in queries:
+    started = time.perf_counter()
+    _, labels = loaded.search(query[None, :], k)
+    samples.append(time.perf_counter() - started)
+    found.append(labels[0])
+  samples.sort()
+  recall = np.mean([len(set(row) & set(expected)) / k for row, expected in zip(found, truth)])
+  return {
+    "recall_at_k": round(float(recall), 4),
+    "query_p50_ms": round(samples[len(samples) // 2] * 1000, 3),
+    "query_p95_ms": round(samples[int(len(samples) * 0.95)] * 1000, 3),
+    "bytes": os.path.getsize(path),
+    "load_ms": round(load_ms, 2),
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--chunks", type=int, default=100000)
+  parser.add_argument("--dimensions", type=int, default=384)
+  parser.add_argument("--clusters", type=int, default=500)
+  parser.add_argument("--queries", type=int, default=200)
+  parser.add_argument("--k", type=int, default=8)
+  parser.add_argument("--types", nargs="+", default=list(INDEX_TYPES))
+  parser.add_argument("--nprobe", type=int, nargs="+", default=[16])
+  parser.add_argument("--train-sample", type=int, default=50000)
+  args = parser.parse_args()
+
+  rng = np.random.default_rng(0)
+  flat = faiss.IndexFlatL2(args.dimensions)
+  flat.add(clustered_vectors(args.chunks, args.dimensions, args.clusters, rng))
+  picked = rng.integers(0, args.chunks, args.queries).astype(np.int64)
+  queries = flat.reconstruct_batch(picked) + 0.05 * rng.standard_normal((args.queries, args.dimensions), dtype=np.float32)
+  _, truth = flat.search(queries, args.k)
+
+  results = []
+  directory = tempfile.mkdtemp()
+  for index_type in args.types:
+    for nprobe in (args.nprobe if index_type.startswith("ivf") else [None]):
+      started = time.perf_counter()
+      index = build_index(flat, index_type, nprobe=nprobe or 16, train_sample=args.train_sample, min_vectors=0)
+      build_seconds = time.perf_counter() - started
+      result = {"type": index_type, "nprobe": nprobe, "build_seconds": round(build_seconds, 2)}
+      result.update(measure(index, f"{directory}/{index_type}.faiss", queries, truth, args.k))
+      results.append(result)
+      print(json.dumps(result), file=sys.stderr)
+
+  print(json.dumps({"chunks": args.chunks, "dimensions": args.dimensions, "k": args.k, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,69 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '../'))
+
+# Where the chat handler's cold start goes: the handler module is imported in fresh interpreters with
+# `python -X importtime`, the way the Lambda runtime imports it during init, and the cumulative import time
+# of each module lambda_function imports directly is reported with the total. Modules that an earlier import
+# already loaded show up under that earlier one. With --prewarm the import runs with PREWARM_INDEX=true
+# against whatever S3 the environment points at, so the total includes the index download.
+#
+#   python benchmarks/chat_cold_start.py --runs 5
+
+HANDLER = "chat_handler"
+
+
+def import_times(env):
+  code = "import sys; sys.path[:0] = sys.argv[1:]; import lambda_function"
+  started = time.perf_counter()
+  stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", code, os.path.join(ROOT, HANDLER), ROOT],
+                          env=env, capture_output=True, text=True, check=True).stderr
+  total = time.perf_counter() - started
+  # "import time: self [us] | cumulative | imported package", nested imports indented below their parent;
+  # the direct imports of lambda_function are the lines at its depth + 1 that come before it
+  lines = []
+  for line in stderr.splitlines():
+    if not line.startswith("import time:") or "cumulative" in line:
+      continue
+    _, cumulative, name = line[len("import time:"):].split("|")
+    depth = (len(name) - len(name.lstrip())) // 2
+    lines.append((depth, name.strip(), int(cumulative)))
+  handler = next(i for i, (_, name, _) in enumerate(lines) if name == "lambda_function")
+  depth = lines[handler][0]
+  modules = {}
+  for module_depth, name, cumulative in reversed(lines[:handler]):
+    if module_depth < depth + 1:
+      break
+    if module_depth == depth + 1:
+      modules[name] = cumulative / 1000
+  return {"interpreter_ms": total * 1000, "lambda_function_ms": lines[handler][2] / 1000, "modules": modules}
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--runs", type=int, default=5)
+  parser.add_argument("--top", type=int, default=15, help="modules to report, slowest first")
+  parser.add_argument("--prewarm", action="store_true", help="import with PREWARM_INDEX=true")
+  args = parser.parse_args()
+
+  env = dict(os.environ, METRICS_SINK="none", PREWARM_INDEX="true" if args.prewarm else "false",
+             AWS_DEFAULT_REGION=os.environ.get("AWS_DEFAULT_REGION", "us-east-1"))
+  runs = [import_times(env) for _ in range(args.runs)]
+  # The median run of each figure, so one slow filesystem read doesn't skew the report
+  median = lambda values: round(sorted(values)[len(values) // 2], 1)
+  modules = {name: median([run["modules"].get(name, 0) for run in runs]) for name in runs[-1]["modules"]}
+  print(json.dumps({
+    "runs": args.runs,
+    "interpreter_ms": median([run["interpreter_ms"] for run in runs]),
+    "lambda_function_ms": median([run["lambda_function_ms"] for run in runs]),
+    "modules_ms": dict(sorted(modules.items(), key=lambda item: -item[1])[:args.top]),
+  }, indent=2))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,104 @@
+import argparse
+import http.client
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../chat_handler')))
+# Keep the handlers' per-invocation metrics records out of the JSON report on stdout
+os.environ.setdefault('METRICS_SINK', 'none')
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_community.vectorstores import FAISS
+from benchmarks.fakes import canned_chat_model
+from chat_handler import lambda_function
+from answer_cache import RecentQueryEmbeddings
+from session_history import InMemorySessionBackend, SessionHistoryCache
+from shared.chunk_store import write_faiss_store
+from stream_server import make_server
+
+# Time to first byte and total latency of the chat handler, answering through the JSON endpoint and through
+# the server-sent event stream. The RAG chain is the real one over a small chunk store index, with a fake
+# embedding model and a chat model that streams a canned answer after a fixed first-token delay.
+#
+#   python benchmarks/chat_latency.py --requests 10 --first-token-latency 0.5 --token-latency 0.03
+
+BASE_FILE_NAME = "faiss_index"
+
+
+def build_index(directory, chunks, embeddings):
+  documents = [Document(page_content=f"Composting tip {row}: keep the pile as moist as a wrung-out sponge.",
+                        metadata={"documentId": f"document-{row // 20}", "title": f"Composting guide {row // 20}"})
+               for row in range(chunks)]
+  write_faiss_store(directory, BASE_FILE_NAME, FAISS.from_documents(documents, embeddings))
+
+
+def post(port, path, query, session_id):
+  # Returns (seconds to the first body byte, seconds to the first answer token, total seconds)
+  connection = http.client.HTTPConnection("127.0.0.1", port)
+  started = time.perf_counter()
+  connection.request("POST", path, json.dumps({"query": query, "session_id": session_id}), {"Content-Type": "application/json"})
+  response = connection.getresponse()
+  first_byte = first_token = None
+  while True:
+    line = response.readline()
+    if not line:
+      break
+    first_byte = first_byte or time.perf_counter() - started
+    if first_token is None and (line.startswith(b"event: token") or path == "/chat"):
+      first_token = time.perf_counter() - started
+  total = time.perf_counter() - started
+  connection.close()
+  return first_byte, first_token, total
+
+
+def summarize(samples):
+  samples = sorted(samples)
+  return {"p50_ms": round(samples[len(samples) // 2] * 1000, 1), "max_ms": round(samples[-1] * 1000, 1)}
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--requests", type=int, default=5)
+  parser.add_argument("--chunks", type=int, default=200)
+  parser.add_argument("--first-token-latency", type=float, default=0.3)
+  parser.add_argument("--token-latency", type=float, default=0.02)
+  args = parser.parse_args()
+
+  embeddings = RecentQueryEmbeddings(DeterministicFakeEmbedding(size=64))
+  directory = tempfile.mkdtemp()
+  build_index(directory, args.chunks, embeddings)
+  chat_model = canned_chat_model(first_token_latency=args.first_token_latency, token_latency=args.token_latency)
+
+  with mock.patch.dict(os.environ, {"OPENAI_API_KEY": "benchmark"}), \
+       mock.patch.object(lambda_function, "_chat_model", chat_model), \
+       mock.patch.object(lambda_function, "_query_embeddings", embeddings), \
+       mock.patch.object(lambda_function, "answer_cache", None), \
+       mock.patch.object(lambda_function, "session_histories", SessionHistoryCache(InMemorySessionBackend())):
+    chain = lambda_function.build_rag_chain(directory, BASE_FILE_NAME)
+    with mock.patch.object(lambda_function.index_cache, "get", lambda: chain):
+      server = make_server(lambda_function, port=0)
+      threading.Thread(target=server.serve_forever, daemon=True).start()
+      port = server.server_address[1]
+      results = {}
+      for path in ("/chat", "/chat/stream"):
+        samples = [post(port, path, f"How do I keep a compost pile moist? ({i})", f"{path}-{i}") for i in range(args.requests)]
+        results[path] = {
+          "first_byte": summarize([sample[0] for sample in samples]),
+          "first_token": summarize([sample[1] for sample in samples]),
+          "total": summarize([sample[2] for sample in samples]),
+        }
+      server.shutdown()
+
+  print(json.dumps({"requests": args.requests, "first_token_latency": args.first_token_latency,
+                    "token_latency": args.token_latency, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,237 @@
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+import uuid
+from unittest import mock
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '../'))
+HANDLERS = ("data_ingestion_handler", "vector_embeddings_handler", "chat_handler")
+sys.path.append(ROOT)
+for handler in HANDLERS:
+  sys.path.append(os.path.join(ROOT, handler))
+
+from benchmarks.fakes import FakeDynamoDB, FakeDynamoDBResource, FakeS3, canned_chat_model, hash_embeddings, make_pdf
+from answer_cache import RecentQueryEmbeddings
+from chat_handler import lambda_function as chat
+from data_ingestion_handler import lambda_function as ingestion
+from shared.tracing import MemorySink
+from vector_embeddings_handler import lambda_function as indexer
+
+# Offline end-to-end run of the three handlers: synthetic PDF guides are uploaded and ingested, the indexer
+# builds and publishes the index, and a set of chat sessions asks first questions and follow-ups against it.
+# S3 and DynamoDB are the in-process fakes, embeddings are hash-based vectors and the chat model streams a
+# canned answer, each with a fixed latency standing in for the network. Nothing leaves the machine and the
+# same parameters give the same corpus, queries and index, so reports from two commits can be diffed:
+#
+#   python benchmarks/end_to_end.py --output before.json
+#   git checkout <other commit> && python benchmarks/end_to_end.py --output after.json
+#   diff <(jq -S 'del(.commit)' before.json) <(jq -S 'del(.commit)' after.json)
+#
+# The report holds import (cold start) times of each handler in a fresh interpreter, ingestion and indexing
+# throughput, the chat handler's cold first request and warm latency percentiles, the mean of every stage
+# metric each handler emitted, and the peak RSS after each phase.
+
+UPLOAD_BUCKET = "uploads"
+WORDS = ("compost", "greens", "browns", "leaves", "grass", "worms", "moisture", "aeration", "carbon", "nitrogen",
+         "bin", "pile", "turning", "temperature", "coffee", "eggshells", "manure", "sawdust", "odor", "finished",
+         "soil", "mulch", "winter", "summer", "kitchen", "scraps", "shredded", "cardboard", "microbes", "tumbler")
+TOPICS = ("coffee grounds", "eggshells", "grass clippings", "worm bins", "winter piles", "smelly bins",
+          "shredded cardboard", "manure", "pile temperature", "finished compost")
+FOLLOW_UPS = ("What about in a small apartment?", "How long does that take?", "Is it safe for vegetables?")
+
+
+class LambdaContext:
+  def __init__(self, timeout_seconds=900):
+    self.aws_request_id = str(uuid.uuid4())
+    self.deadline = time.monotonic() + timeout_seconds
+
+  def get_remaining_time_in_millis(self):
+    return int((self.deadline - time.monotonic()) * 1000)
+
+
+def guide_text(rng, sentences):
+  return " ".join(" ".join(rng.choice(WORDS) for _ in range(12)).capitalize() + "." for _ in range(sentences))
+
+
+def summarize(samples):
+  samples = sorted(samples)
+  if not samples:
+    return {}
+  rank = lambda share: samples[min(len(samples) - 1, int(len(samples) * share))]
+  return {
+    "count": len(samples),
+    "mean_ms": round(sum(samples) / len(samples) * 1000, 1),
+    "p50_ms": round(rank(0.5) * 1000, 1),
+    "p90_ms": round(rank(0.9) * 1000, 1),
+    "p99_ms": round(rank(0.99) * 1000, 1),
+    "max_ms": round(samples[-1] * 1000, 1),
+  }
+
+
+def peak_rss_kb():
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def import_cold_start(handler):
+  # Imports the handler the way the Lambda runtime does, in a fresh interpreter with only its own directory
+  # ru_maxrss survives exec and would report this process's peak, so the child reads its own VmHWM
+  code = ("import sys, time; sys.path[:0] = sys.argv[1:]; started = time.perf_counter(); import lambda_function; "
+          "elapsed = time.perf_counter() - started; "
+          "rss = [line.split()[1] for line in open('/proc/self/status') if line.startswith('VmHWM:')]; "
+          "print(round(elapsed * 1000, 1), rss[0])")
+  env = dict(os.environ, METRICS_SINK="none", AWS_DEFAULT_REGION=os.environ.get("AWS_DEFAULT_REGION", "us-east-1"))
+  output = subprocess.run([sys.executable, "-c", code, os.path.join(ROOT, handler), ROOT],
+                          env=env, capture_output=True, text=True, check=True).stdout.splitlines()[-1].split()
+  return {"import_ms": float(output[0]), "rss_kb": int(output[1])}
+
+
+def stage_means(sink):
+  totals = {}
+  for metrics in sink.metrics():
+    for name, value in metrics.items():
+      totals.setdefault(name, []).append(value)
+  return {name: round(sum(values) / len(values), 3) for name, values in sorted(totals.items())}
+
+
+def git_commit():
+  try:
+    return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def run(args):
+  rng = random.Random(args.seed)
+  s3 = FakeS3(latency=args.s3_latency)
+  dynamodb = FakeDynamoDB(latency=args.dynamodb_latency)
+  clients = {"s3": s3, "dynamodb": dynamodb}
+  resources = FakeDynamoDBResource(dynamodb)
+  embeddings = hash_embeddings(args.dimensions, args.embedding_latency)
+  chat_model = canned_chat_model(first_token_latency=args.first_token_latency, token_latency=args.token_latency)
+  sinks = {handler: MemorySink() for handler in HANDLERS}
+  patches = [
+    mock.patch("boto3.client", lambda name, *a, **kwargs: clients[name]),
+    mock.patch("boto3.resource", lambda name, *a, **kwargs: resources),
+    mock.patch.dict(os.environ, {
+      "OPENAI_API_KEY": "benchmark",
+      "AWS_LAMBDA_FUNCTION_MEMORY_SIZE": "2048",
+      "AWS_LAMBDA_LOG_GROUP_NAME": "benchmark",
+      "INGEST_CONCURRENCY": str(args.ingest_concurrency),
+    }),
+    mock.patch.object(indexer, "OpenAIEmbeddings", lambda **kwargs: embeddings),
+    mock.patch.object(chat, "_query_embeddings", RecentQueryEmbeddings(embeddings)),
+    mock.patch.object(chat, "_chat_model", chat_model),
+    mock.patch.object(ingestion.tracer, "sink", sinks["data_ingestion_handler"]),
+    mock.patch.object(indexer.tracer, "sink", sinks["vector_embeddings_handler"]),
+    mock.patch.object(chat.tracer, "sink", sinks["chat_handler"]),
+  ]
+  for patch in patches:
+    patch.start()
+  try:
+    report = {}
+    report["cold_start"] = {handler: import_cold_start(handler) for handler in HANDLERS}
+
+    keys = []
+    for i in range(args.documents):
+      keys.append(f"guides/guide-{i}.pdf")
+      s3.put(UPLOAD_BUCKET, keys[-1], make_pdf(args.pages, f"Guide {i}. {guide_text(rng, args.sentences)}"))
+    samples = []
+    started = time.perf_counter()
+    for start in range(0, len(keys), args.batch):
+      event = {"Records": [{"s3": {"bucket": {"name": UPLOAD_BUCKET}, "object": {"key": key}}} for key in keys[start:start + args.batch]]}
+      invoked = time.perf_counter()
+      response = ingestion.lambda_handler(event, LambdaContext())
+      samples.append(time.perf_counter() - invoked)
+      assert response["statusCode"] == 200, response
+    seconds = time.perf_counter() - started
+    report["ingestion"] = {
+      "documents": args.documents,
+      "seconds": round(seconds, 3),
+      "documents_per_second": round(args.documents / seconds, 2),
+      "pages_per_second": round(args.documents * args.pages / seconds, 1),
+      "invocations": summarize(samples),
+      "peak_rss_kb": peak_rss_kb(),
+    }
+
+    started = time.perf_counter()
+    response = indexer.lambda_handler({}, LambdaContext())
+    seconds = time.perf_counter() - started
+    assert response["statusCode"] == 200, response
+    body = response["body"]
+    report["indexing"] = {
+      "documents": body["documents_processed"],
+      "chunks": body["embedding"]["chunks"],
+      "seconds": round(seconds, 3),
+      "chunks_per_second": round(body["embedding"]["chunks"] / seconds, 1),
+      "index_size": body["index_size"],
+      "index_type": body["index_type"],
+      "peak_rss_kb": peak_rss_kb(),
+    }
+
+    # Every session asks a first question and then follow-ups; later rounds repeat the first questions
+    requests = []
+    for round_number in range(args.rounds):
+      for session in range(args.sessions):
+        session_id = f"session-{round_number}-{session}"
+        requests.append((f"How should I handle {TOPICS[session % len(TOPICS)]} in my compost?", session_id))
+        requests.extend((FOLLOW_UPS[turn % len(FOLLOW_UPS)], session_id) for turn in range(args.follow_ups))
+    samples = []
+    for query, session_id in requests:
+      invoked = time.perf_counter()
+      response = chat.lambda_handler({"body": json.dumps({"query": query, "session_id": session_id})}, LambdaContext())
+      samples.append(time.perf_counter() - invoked)
+      assert response["statusCode"] == 200, response
+    chat_metrics = sinks["chat_handler"].metrics()
+    report["chat"] = {
+      "cold_request_ms": round(samples[0] * 1000, 1),
+      "warm_requests": summarize(samples[1:]),
+      "answer_cache_hits": sum(metrics.get("answer_cache_hit", 0) for metrics in chat_metrics),
+      "peak_rss_kb": peak_rss_kb(),
+    }
+    report["stages"] = {handler: stage_means(sinks[handler]) for handler in HANDLERS}
+    return report
+  finally:
+    for patch in reversed(patches):
+      patch.stop()
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--documents", type=int, default=20)
+  parser.add_argument("--pages", type=int, default=4)
+  parser.add_argument("--sentences", type=int, default=30, help="synthetic sentences per page")
+  parser.add_argument("--batch", type=int, default=5, help="S3 records per ingestion invocation")
+  parser.add_argument("--ingest-concurrency", type=int, default=4)
+  parser.add_argument("--sessions", type=int, default=10)
+  parser.add_argument("--follow-ups", type=int, default=2)
+  parser.add_argument("--rounds", type=int, default=2)
+  parser.add_argument("--dimensions", type=int, default=256)
+  parser.add_argument("--s3-latency", type=float, default=0.01)
+  parser.add_argument("--dynamodb-latency", type=float, default=0.003)
+  parser.add_argument("--embedding-latency", type=float, default=0.05)
+  parser.add_argument("--first-token-latency", type=float, default=0.3)
+  parser.add_argument("--token-latency", type=float, default=0.02)
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--output", help="write the report to this file instead of stdout")
+  args = parser.parse_args()
+
+  report = {"commit": git_commit(), "python": platform.python_version(),
+            "parameters": {key: value for key, value in vars(args).items() if key != "output"}}
+  report.update(run(args))
+  report["peak_rss_kb"] = peak_rss_kb()
+  text = json.dumps(report, indent=2, sort_keys=True)
+  if args.output:
+    with open(args.output, "w") as f:
+      f.write(text + "\n")
+  else:
+    print(text)
+
+
+if __name__ == "__main__":
+  main()
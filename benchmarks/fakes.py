@@ -0,0 +1,568 @@
+import base64
+import hashlib
+import io
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+
+# Local stand-ins for the services the handlers talk to, so tests and benchmarks run offline and
+# deterministically.
+
+
+def hash_embedding(text, size=1536):
+  seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+  vector = np.random.default_rng(seed).standard_normal(size).astype(np.float32)
+  return vector / np.linalg.norm(vector)
+
+
+def hash_embeddings(size=1536, latency=0.0):
+  # In-process embedding model returning hash_embedding vectors, after `latency` seconds per call
+  from langchain_core.embeddings import Embeddings
+
+  class HashEmbeddings(Embeddings):
+    def embed_documents(self, texts):
+      time.sleep(latency)
+      return [hash_embedding(text, size).tolist() for text in texts]
+
+    def embed_query(self, text):
+      return self.embed_documents([text])[0]
+
+  return HashEmbeddings()
+
+
+class FakeEmbeddingsServer:
+  # Serves POST /v1/embeddings with hash-based vectors. Requests beyond `max_concurrent_requests` in flight
+  # are answered with 429 and a Retry-After header, like the real API under a rate limit.
+  def __init__(self, size=1536, latency=0.0, max_concurrent_requests=None, retry_after=0.01):
+    self.size = size
+    self.latency = latency
+    self.max_concurrent_requests = max_concurrent_requests
+    self.retry_after = retry_after
+    self.requests = 0
+    self.rate_limited = 0
+    self.peak_concurrency = 0
+    self._in_flight = 0
+    self._lock = threading.Lock()
+    self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+    self._thread = None
+
+  @property
+  def base_url(self):
+    return f"http://127.0.0.1:{self._server.server_address[1]}/v1"
+
+  def __enter__(self):
+    self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+    self._thread.start()
+    return self
+
+  def __exit__(self, *exc_info):
+    self._server.shutdown()
+    self._server.server_close()
+
+  def _handler(self):
+    fake = self
+
+    class Handler(BaseHTTPRequestHandler):
+      def log_message(self, *args):
+        pass
+
+      def _send(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+          self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+      def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with fake._lock:
+          fake.requests += 1
+          limited = fake.max_concurrent_requests is not None and fake._in_flight >= fake.max_concurrent_requests
+          if limited:
+            fake.rate_limited += 1
+          else:
+            fake._in_flight += 1
+            fake.peak_concurrency = max(fake.peak_concurrency, fake._in_flight)
+        if limited:
+          self._send(429, {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+            {"Retry-After": str(fake.retry_after)})
+          return
+        try:
+          time.sleep(fake.latency)
+          inputs = request["input"] if isinstance(request["input"], list) else [request["input"]]
+          data = []
+          for index, text in enumerate(inputs):
+            vector = hash_embedding(text if isinstance(text, str) else json.dumps(text), fake.size)
+            if request.get("encoding_format") == "base64":
+              embedding = base64.b64encode(vector.tobytes()).decode("ascii")
+            else:
+              embedding = vector.tolist()
+            data.append({"object": "embedding", "index": index, "embedding": embedding})
+          tokens = sum(len(str(text)) // 4 + 1 for text in inputs)
+          self._send(200, {"object": "list", "data": data, "model": request.get("model"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens}})
+        finally:
+          with fake._lock:
+            fake._in_flight -= 1
+
+    return Handler
+
+
+def client_error(code, message, operation):
+  from botocore.exceptions import ClientError
+  return ClientError({"Error": {"Code": code, "Message": message}}, operation)
+
+
+def _plain(value):
+  (kind, data), = value.items()
+  if kind == "N":
+    return float(data)
+  if kind in ("SS", "NS", "BS"):
+    return frozenset(data)
+  return data
+
+
+class _Expression:
+  # Evaluates the subset of DynamoDB condition/update expression syntax the handlers use: comparisons,
+  # IN, AND/OR/NOT, parentheses, attribute_exists/attribute_not_exists, and SET a = b [+|- c] / REMOVE a.
+  TOKEN = re.compile(r"\s*(<>|<=|>=|[=<>(),+-]|[#:]?[A-Za-z_][A-Za-z0-9_]*)")
+
+  def __init__(self, text, names, values):
+    self.tokens = []
+    position = 0
+    text = text.strip()
+    while position < len(text):
+      match = self.TOKEN.match(text, position)
+      if not match:
+        raise ValueError(f"Cannot parse expression at: {text[position:]}")
+      self.tokens.append(match.group(1))
+      position = match.end()
+    self.names = names or {}
+    self.values = values or {}
+    self.position = 0
+
+  def peek(self):
+    return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+  def take(self, expected=None):
+    token = self.peek()
+    if expected is not None and (token or "").upper() != expected:
+      raise ValueError(f"Expected {expected}, got {token}")
+    self.position += 1
+    return token
+
+  def path(self, token):
+    return self.names.get(token, token)
+
+  def operand(self, item):
+    token = self.take()
+    if token.startswith(":"):
+      return self.values[token]
+    if token == "if_not_exists":
+      self.take("(")
+      attribute = self.path(self.take())
+      self.take(",")
+      default = self.operand(item)
+      self.take(")")
+      return item.get(attribute, default)
+    return item.get(self.path(token))
+
+  def condition(self, item):
+    result = self.conjunction(item)
+    while (self.peek() or "").upper() == "OR":
+      self.take()
+      right = self.conjunction(item)
+      result = result or right
+    return result
+
+  def conjunction(self, item):
+    result = self.negation(item)
+    while (self.peek() or "").upper() == "AND":
+      self.take()
+      right = self.negation(item)
+      result = result and right
+    return result
+
+  def negation(self, item):
+    if (self.peek() or "").upper() == "NOT":
+      self.take()
+      return not self.negation(item)
+    return self.comparison(item)
+
+  def comparison(self, item):
+    token = self.peek()
+    if token == "(":
+      self.take()
+      result = self.condition(item)
+      self.take(")")
+      return result
+    if token in ("attribute_exists", "attribute_not_exists"):
+      self.take()
+      self.take("(")
+      exists = self.path(self.take()) in item
+      self.take(")")
+      return exists if token == "attribute_exists" else not exists
+    left = self.operand(item)
+    operator = self.take()
+    if operator.upper() == "IN":
+      self.take("(")
+      options = [self.operand(item)]
+      while self.peek() == ",":
+        self.take()
+        options.append(self.operand(item))
+      self.take(")")
+      return left is not None and _plain(left) in [_plain(option) for option in options if option is not None]
+    right = self.operand(item)
+    if left is None or right is None:
+      return operator == "<>" and (left is None) != (right is None)
+    left, right = _plain(left), _plain(right)
+    return {"=": left == right, "<>": left != right, "<": left < right, "<=": left <= right,
+            ">": left > right, ">=": left >= right}[operator]
+
+  def update(self, item):
+    while self.peek() is not None:
+      clause = self.take().upper()
+      while True:
+        attribute = self.path(self.take())
+        if clause == "SET":
+          self.take("=")
+          value = self.operand(item)
+          if self.peek() in ("+", "-"):
+            sign = 1 if self.take() == "+" else -1
+            number = _plain(value) + sign * _plain(self.operand(item))
+            value = {"N": str(int(number) if number == int(number) else number)}
+          item[attribute] = value
+        elif clause == "REMOVE":
+          item.pop(attribute, None)
+        else:
+          raise ValueError(f"Unsupported update clause {clause}")
+        if self.peek() != ",":
+          break
+        self.take()
+    return item
+
+
+class FakeDynamoDB:
+  # In-process stand-in for the low-level DynamoDB client. Tables are created on first use and `key_schema`
+  # maps a table name to its partition key. Queries evaluate the key condition against every item, so they
+  # work the same on the table and on any of its indexes.
+  KEY_SCHEMA = {"DocumentMetadata": "documentId", "VectorMetadata": "documentId", "EmbeddingCache": "chunkHash",
+                "DocumentHashes": "hash", "ChatSessions": "sessionId",
+                "AnswerCache": "entryId"}
+
+  def __init__(self, key_schema=None, latency=0.0):
+    self.key_schema = dict(self.KEY_SCHEMA, **(key_schema or {}))
+    self.latency = latency
+    self.tables = {}
+    self.calls = {}
+    self._lock = threading.RLock()
+
+  def table(self, name):
+    return self.tables.setdefault(name, {})
+
+  def _key(self, table_name, key):
+    attribute = self.key_schema.get(table_name) or next(iter(key))
+    return _plain(key[attribute])
+
+  def _call(self, operation):
+    with self._lock:
+      self.calls[operation] = self.calls.get(operation, 0) + 1
+    if self.latency:
+      time.sleep(self.latency)
+
+  def _check(self, table_name, key, condition, names, values, operation):
+    if condition is None:
+      return
+    item = self.table(table_name).get(self._key(table_name, key), {})
+    if not _Expression(condition, names, values).condition(item):
+      raise client_error("ConditionalCheckFailedException", "The conditional request failed", operation)
+
+  def get_item(self, TableName, Key, **kwargs):
+    self._call("GetItem")
+    with self._lock:
+      item = self.table(TableName).get(self._key(TableName, Key))
+    return {"Item": dict(item)} if item is not None else {}
+
+  def put_item(self, TableName, Item, ConditionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None, **kwargs):
+    self._call("PutItem")
+    with self._lock:
+      self._check(TableName, Item, ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues, "PutItem")
+      self.table(TableName)[self._key(TableName, Item)] = dict(Item)
+    return {}
+
+  def update_item(self, TableName, Key, UpdateExpression, ConditionExpression=None, ExpressionAttributeNames=None,
+                  ExpressionAttributeValues=None, ReturnValues=None, **kwargs):
+    self._call("UpdateItem")
+    with self._lock:
+      self._check(TableName, Key, ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues, "UpdateItem")
+      table = self.table(TableName)
+      old = dict(table.get(self._key(TableName, Key), Key))
+      item = dict(old)
+      _Expression(UpdateExpression, ExpressionAttributeNames, ExpressionAttributeValues).update(item)
+      table[self._key(TableName, Key)] = item
+    returned = {"ALL_NEW": item, "ALL_OLD": old}.get(ReturnValues)
+    return {"Attributes": dict(returned)} if returned is not None else {}
+
+  def delete_item(self, TableName, Key, **kwargs):
+    self._call("DeleteItem")
+    with self._lock:
+      self.table(TableName).pop(self._key(TableName, Key), None)
+    return {}
+
+  def query(self, TableName, KeyConditionExpression, IndexName=None, ExpressionAttributeNames=None,
+            ExpressionAttributeValues=None, Limit=None, ExclusiveStartKey=None, ScanIndexForward=True,
+            FilterExpression=None, **kwargs):
+    self._call("Query")
+    with self._lock:
+      items = [item for item in self.table(TableName).values() if _Expression(
+        KeyConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues).condition(item)]
+    # Pages continue after the key of the last returned item, like DynamoDB, so items that leave the
+    # query's result set between pages don't shift the next page
+    key_attribute = self.key_schema.get(TableName)
+    items.sort(key=lambda item: str(_plain(item[key_attribute])), reverse=not ScanIndexForward)
+    if ExclusiveStartKey:
+      start_key = str(_plain(ExclusiveStartKey[key_attribute]))
+      items = [item for item in items if (str(_plain(item[key_attribute])) > start_key) == ScanIndexForward]
+    page = items[:Limit] if Limit else items
+    # Like DynamoDB, the filter applies to the page after Limit, so a page can come back short or empty
+    matches = [item for item in page if FilterExpression is None or _Expression(
+      FilterExpression, ExpressionAttributeNames, ExpressionAttributeValues).condition(item)]
+    response = {"Items": [dict(item) for item in matches], "Count": len(matches), "ScannedCount": len(page)}
+    if Limit and len(items) > Limit:
+      response["LastEvaluatedKey"] = {key_attribute: page[-1][key_attribute]}
+    return response
+
+  def batch_get_item(self, RequestItems):
+    self._call("BatchGetItem")
+    responses = {}
+    with self._lock:
+      for table_name, request in RequestItems.items():
+        table = self.table(table_name)
+        responses[table_name] = [dict(table[self._key(table_name, key)]) for key in request["Keys"]
+                                 if self._key(table_name, key) in table]
+    return {"Responses": responses, "UnprocessedKeys": {}}
+
+  def batch_write_item(self, RequestItems):
+    self._call("BatchWriteItem")
+    with self._lock:
+      for table_name, requests in RequestItems.items():
+        for request in requests:
+          if "PutRequest" in request:
+            item = request["PutRequest"]["Item"]
+            self.table(table_name)[self._key(table_name, item)] = dict(item)
+          else:
+            self.table(table_name).pop(self._key(table_name, request["DeleteRequest"]["Key"]), None)
+    return {"UnprocessedItems": {}}
+
+  def transact_write_items(self, TransactItems, **kwargs):
+    self._call("TransactWriteItems")
+    with self._lock:
+      for action in TransactItems:
+        (kind, request), = action.items()
+        key = request.get("Key") or request.get("Item")
+        try:
+          self._check(request["TableName"], key, request.get("ConditionExpression"),
+                      request.get("ExpressionAttributeNames"), request.get("ExpressionAttributeValues"), "TransactWriteItems")
+        except Exception:
+          raise client_error("TransactionCanceledException", "Transaction cancelled", "TransactWriteItems")
+      for action in TransactItems:
+        (kind, request), = action.items()
+        if kind == "Put":
+          self.table(request["TableName"])[self._key(request["TableName"], request["Item"])] = dict(request["Item"])
+        elif kind == "Update":
+          table = self.table(request["TableName"])
+          key = self._key(request["TableName"], request["Key"])
+          item = dict(table.get(key, request["Key"]))
+          _Expression(request["UpdateExpression"], request.get("ExpressionAttributeNames"),
+                      request.get("ExpressionAttributeValues")).update(item)
+          table[key] = item
+        elif kind == "Delete":
+          self.table(request["TableName"]).pop(self._key(request["TableName"], request["Key"]), None)
+    return {}
+
+
+class FakeS3:
+  # In-process stand-in for the S3 client calls the handlers make. Objects are kept as bytes with an ETag
+  # derived from their content.
+  def __init__(self, latency=0.0):
+    self.latency = latency
+    self.objects = {}
+    self.calls = {}
+    self._lock = threading.Lock()
+
+  def _call(self, operation):
+    with self._lock:
+      self.calls[operation] = self.calls.get(operation, 0) + 1
+    if self.latency:
+      time.sleep(self.latency)
+
+  def _get(self, Bucket, Key, operation):
+    if (Bucket, Key) not in self.objects:
+      raise client_error("404" if operation == "HeadObject" else "NoSuchKey", "Not Found", operation)
+    return self.objects[(Bucket, Key)]
+
+  def put(self, Bucket, Key, data):
+    if isinstance(data, str):
+      data = data.encode("utf-8")
+    self.objects[(Bucket, Key)] = bytes(data)
+
+  def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None, **kwargs):
+    self._call("PutObject")
+    with self._lock:
+      current = self.objects.get((Bucket, Key))
+      if (IfNoneMatch == "*" and current is not None) or \
+         (IfMatch is not None and (current is None or self._etag(current) != IfMatch)):
+        raise client_error("PreconditionFailed", "At least one of the pre-conditions you specified did not hold", "PutObject")
+      self.put(Bucket, Key, Body.read() if hasattr(Body, "read") else Body)
+    return {"ETag": self._etag(self.objects[(Bucket, Key)])}
+
+  def upload_file(self, Filename, Bucket, Key, **kwargs):
+    self._call("PutObject")
+    with open(Filename, "rb") as f:
+      self.put(Bucket, Key, f.read())
+
+  def download_file(self, Bucket, Key, Filename, **kwargs):
+    self._call("GetObject")
+    data = self._get(Bucket, Key, "HeadObject")
+    with open(Filename, "wb") as f:
+      f.write(data)
+
+  def get_object(self, Bucket, Key, **kwargs):
+    self._call("GetObject")
+    data = self._get(Bucket, Key, "GetObject")
+    return {"Body": io.BytesIO(data), "ContentLength": len(data), "ETag": self._etag(data)}
+
+  def head_object(self, Bucket, Key, **kwargs):
+    self._call("HeadObject")
+    data = self._get(Bucket, Key, "HeadObject")
+    return {"ContentLength": len(data), "ETag": self._etag(data)}
+
+  def delete_object(self, Bucket, Key, **kwargs):
+    self._call("DeleteObject")
+    self.objects.pop((Bucket, Key), None)
+    return {}
+
+  def delete_objects(self, Bucket, Delete, **kwargs):
+    self._call("DeleteObjects")
+    for entry in Delete["Objects"]:
+      self.objects.pop((Bucket, entry["Key"]), None)
+    return {"Deleted": [{"Key": entry["Key"]} for entry in Delete["Objects"]]}
+
+  def list_objects_v2(self, Bucket, Prefix="", MaxKeys=1000, ContinuationToken=None, **kwargs):
+    self._call("ListObjectsV2")
+    with self._lock:
+      keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+    keys = [key for key in keys if ContinuationToken is None or key > ContinuationToken]
+    page = keys[:MaxKeys]
+    response = {"Contents": [{"Key": key, "Size": len(self.objects[(Bucket, key)])} for key in page],
+                "KeyCount": len(page), "IsTruncated": len(keys) > MaxKeys}
+    if response["IsTruncated"]:
+      response["NextContinuationToken"] = page[-1]
+    return response
+
+  @staticmethod
+  def _etag(data):
+    return '"%s"' % hashlib.md5(data).hexdigest()
+
+
+class FakeDynamoDBTable:
+  def __init__(self, client, name):
+    self.client = client
+    self.name = name
+    self._serializer = TypeSerializer()
+    self._deserializer = TypeDeserializer()
+
+  def _serialize(self, item):
+    return {key: self._serializer.serialize(value) for key, value in item.items()}
+
+  def _deserialize(self, item):
+    return {key: self._deserializer.deserialize(value) for key, value in item.items()}
+
+  def put_item(self, Item, **kwargs):
+    return self.client.put_item(TableName=self.name, Item=self._serialize(Item), **kwargs)
+
+  def get_item(self, Key, **kwargs):
+    response = self.client.get_item(TableName=self.name, Key=self._serialize(Key), **kwargs)
+    return {"Item": self._deserialize(response["Item"])} if "Item" in response else {}
+
+  def delete_item(self, Key, **kwargs):
+    return self.client.delete_item(TableName=self.name, Key=self._serialize(Key), **kwargs)
+
+
+class FakeDynamoDBResource:
+  # Stand-in for boto3.resource('dynamodb') backed by a FakeDynamoDB client, so handlers using either API
+  # see the same tables
+  def __init__(self, client=None):
+    self.client = client or FakeDynamoDB()
+
+  def Table(self, name):
+    return FakeDynamoDBTable(self.client, name)
+
+
+def make_pdf(pages, text="Compost needs a balance of greens and browns, moisture and air."):
+  import fitz
+  document = fitz.open()
+  for page_number in range(pages):
+    page = document.new_page()
+    page.insert_textbox(fitz.Rect(72, 72, 540, 770), f"Page {page_number + 1}. " + text)
+  data = document.tobytes()
+  document.close()
+  return data
+
+
+def make_image_pdf(pages, color=(0.4, 0.6, 0.2)):
+  # A PDF with no text layer, like a scanned guide: each page is a filled rectangle
+  import fitz
+  document = fitz.open()
+  for page_number in range(pages):
+    page = document.new_page()
+    page.draw_rect(fitz.Rect(72, 72, 540, 72 + 100 * (page_number + 1)), color=color, fill=color)
+  data = document.tobytes()
+  document.close()
+  return data
+
+
+def canned_chat_model(answer="Compost needs a balance of greens and browns, kept as moist as a wrung-out sponge.",
+                      first_token_latency=0.3, token_latency=0.02):
+  # Chat model that streams `answer` word by word after a fixed delay, standing in for gpt-3.5-turbo.
+  # Prompts asking for a standalone question get the latest human message back unchanged.
+  from langchain_core.language_models import BaseChatModel
+  from langchain_core.messages import AIMessage, AIMessageChunk
+  from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+  class CannedChatModel(BaseChatModel):
+    calls: int = 0
+
+    @property
+    def _llm_type(self):
+      return "canned"
+
+    def _reply(self, messages):
+      self.calls += 1
+      if "standalone question" in str(messages[0].content):
+        return [message for message in messages if message.type == "human"][-1].content
+      return answer
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+      reply = self._reply(messages)
+      time.sleep(first_token_latency + token_latency * len(reply.split()))
+      return ChatResult(generations=[ChatGeneration(message=AIMessage(content=reply))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+      reply = self._reply(messages)
+      time.sleep(first_token_latency)
+      for token in re.findall(r"\S+\s*", reply):
+        time.sleep(token_latency)
+        chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+        if run_manager:
+          run_manager.on_llm_new_token(token, chunk=chunk)
+        yield chunk
+
+  return CannedChatModel()
@@ -0,0 +1,109 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+
+# Compares cold loading of the legacy pickled FAISS index against the chunk store format. Each load runs
+# in a fresh interpreter so its RSS is not shared with the build or with the other format.
+#
+#   python benchmarks/index_load.py --chunks 100000 --dimensions 1536
+
+BASE_FILE_NAME = "faiss_index"
+
+
+def build(directory, chunks, dimensions):
+  import faiss
+  import numpy as np
+  from langchain_community.docstore.in_memory import InMemoryDocstore
+  from langchain_community.vectorstores import FAISS
+  from langchain_core.documents import Document
+  from shared.chunk_store import write_faiss_store
+
+  rng = np.random.default_rng(0)
+  index = faiss.IndexFlatL2(dimensions)
+  index.add(rng.standard_normal((chunks, dimensions), dtype=np.float32))
+  ids = [f"{row:036d}" for row in range(chunks)]
+  text = "Compost needs a balance of greens and browns, moisture and air. " * 8
+  docstore = InMemoryDocstore({id: Document(page_content=f"{row} {text}"[:512], metadata={
+    "documentId": f"document-{row // 200}", "title": f"Composting guide {row // 200}"}) for row, id in enumerate(ids)})
+  db = FAISS(None, index, docstore, dict(enumerate(ids)))
+  db.save_local(folder_path=directory, index_name=BASE_FILE_NAME)
+  os.makedirs(f"{directory}/chunkstore/")
+  write_faiss_store(f"{directory}/chunkstore/", BASE_FILE_NAME, db)
+
+
+def current_rss_kb():
+  # ru_maxrss survives exec, so a child's peak would include the parent's; read the live RSS instead
+  try:
+    with open("/proc/self/status") as f:
+      for line in f:
+        if line.startswith("VmRSS:"):
+          return int(line.split()[1])
+  except OSError:
+    pass
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(directory, index_format, k):
+  import numpy as np
+  from langchain_community.vectorstores import FAISS
+  from shared.chunk_store import load_chunk_store_faiss
+
+  rss_before = current_rss_kb()
+  started = time.perf_counter()
+  if index_format == "pickle":
+    db = FAISS.load_local(folder_path=directory, index_name=BASE_FILE_NAME, embeddings=None, allow_dangerous_deserialization=True)
+  else:
+    db = load_chunk_store_faiss(f"{directory}/chunkstore/", BASE_FILE_NAME, None)
+  load_seconds = time.perf_counter() - started
+  rss_after_load = current_rss_kb()
+
+  query = np.random.default_rng(1).standard_normal(db.index.d).astype(np.float32).tolist()
+  started = time.perf_counter()
+  hits = db.similarity_search_with_score_by_vector(query, k=k)
+  search_seconds = time.perf_counter() - started
+  return {
+    "format": index_format,
+    "load_ms": round(load_seconds * 1000, 2),
+    "search_ms": round(search_seconds * 1000, 2),
+    "hits": len(hits),
+    "load_rss_delta_kb": rss_after_load - rss_before,
+    "rss_delta_kb": current_rss_kb() - rss_before,
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--chunks", type=int, default=20000)
+  parser.add_argument("--dimensions", type=int, default=1536)
+  parser.add_argument("--k", type=int, default=8)
+  parser.add_argument("--measure", choices=("pickle", "chunkstore"))
+  parser.add_argument("--directory")
+  args = parser.parse_args()
+
+  if args.measure:
+    print(json.dumps(measure(args.directory, args.measure, args.k)))
+    return
+
+  with tempfile.TemporaryDirectory() as directory:
+    build(directory, args.chunks, args.dimensions)
+    sizes = {
+      "pickle_bytes": sum(os.path.getsize(f"{directory}/{BASE_FILE_NAME}{suffix}") for suffix in (".faiss", ".pkl")),
+      "chunkstore_bytes": sum(os.path.getsize(f"{directory}/chunkstore/{name}") for name in os.listdir(f"{directory}/chunkstore/")),
+    }
+    results = []
+    for index_format in ("pickle", "chunkstore"):
+      output = subprocess.run([sys.executable, __file__, "--measure", index_format, "--directory", directory, "--k", str(args.k)],
+                              check=True, capture_output=True, text=True).stdout
+      results.append(json.loads(output.strip().splitlines()[-1]))
+  print(json.dumps({"chunks": args.chunks, "dimensions": args.dimensions, **sizes, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,66 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from unittest import mock
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../data_ingestion_handler')))
+# Keep the handlers' per-invocation metrics records out of the JSON report on stdout
+os.environ.setdefault('METRICS_SINK', 'none')
+
+from benchmarks.fakes import FakeDynamoDB, FakeDynamoDBResource, FakeS3, make_pdf
+from data_ingestion_handler import lambda_function
+
+# Throughput of the ingestion handler for S3 events carrying 1, 10 and 100 records, against in-process S3
+# and DynamoDB fakes with a fixed per-call latency standing in for the network.
+#
+#   python benchmarks/ingestion_throughput.py --pages 20 --concurrency 1 4 8
+
+BUCKET = "uploads"
+
+
+def run(records, pages, concurrency, s3_latency, dynamodb_latency):
+  s3 = FakeS3(latency=s3_latency)
+  dynamodb = FakeDynamoDBResource(FakeDynamoDB(latency=dynamodb_latency))
+  keys = [f"guides/guide-{i}.pdf" for i in range(records)]
+  for i, key in enumerate(keys):
+    # Distinct text per guide, so none of them is skipped as a duplicate
+    s3.put(BUCKET, key, make_pdf(pages, f"Guide {i}: compost needs a balance of greens and browns."))
+  event = {"Records": [{"s3": {"bucket": {"name": BUCKET}, "object": {"key": key}}} for key in keys]}
+
+  with mock.patch.object(lambda_function.boto3, "client", lambda name: s3), \
+       mock.patch.object(lambda_function.boto3, "resource", lambda name: dynamodb), \
+       mock.patch.object(lambda_function, "_thread_state", threading.local()), \
+       mock.patch.dict(os.environ, {"INGEST_CONCURRENCY": str(concurrency)}):
+    started = time.perf_counter()
+    response = lambda_function.lambda_handler(event, {})
+    seconds = time.perf_counter() - started
+
+  assert response["statusCode"] == 200, response
+  return {
+    "records": records,
+    "concurrency": concurrency,
+    "seconds": round(seconds, 3),
+    "records_per_second": round(records / seconds, 1),
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--records", type=int, nargs="+", default=[1, 10, 100])
+  parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4])
+  parser.add_argument("--pages", type=int, default=4)
+  parser.add_argument("--s3-latency", type=float, default=0.02)
+  parser.add_argument("--dynamodb-latency", type=float, default=0.005)
+  args = parser.parse_args()
+
+  results = [run(records, args.pages, concurrency, args.s3_latency, args.dynamodb_latency)
+             for records in args.records for concurrency in args.concurrency]
+  print(json.dumps({"pages_per_pdf": args.pages, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,104 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../chat_handler')))
+
+import faiss
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from mmr_retriever import MMRRetriever
+from shared.chunk_store import load_chunk_store_faiss, write_chunk_store
+
+# Per-query latency of LangChain's FAISS MMR search against MMRRetriever on chunk store indexes of growing
+# size, with random vectors. Both get the same precomputed query vectors, so only search and selection are
+# timed.
+#
+#   python benchmarks/mmr_retrieval.py --chunks 10000 100000 1000000 --dimensions 128
+
+BASE_FILE_NAME = "faiss_index"
+
+
+class Chunk:
+  def __init__(self, row):
+    self.page_content = f"Composting tip {row}: keep the pile as moist as a wrung-out sponge."
+    self.metadata = {"documentId": f"document-{row // 200}", "title": f"Composting guide {row // 200}"}
+
+
+class Chunks:
+  # Lazy sequence of chunks, so building a million-row store doesn't hold a million Documents
+  def __init__(self, count):
+    self.count = count
+
+  def __len__(self):
+    return self.count
+
+  def __iter__(self):
+    return (Chunk(row) for row in range(self.count))
+
+
+class QueryVectors(Embeddings):
+  def __init__(self, vectors):
+    self.vectors = vectors
+
+  def embed_documents(self, texts):
+    return [self.vectors[text] for text in texts]
+
+  def embed_query(self, text):
+    return self.vectors[text]
+
+
+def build(directory, chunks, dimensions, seed=0):
+  index = faiss.IndexFlatL2(dimensions)
+  rng = np.random.default_rng(seed)
+  for start in range(0, chunks, 100000):
+    index.add(rng.standard_normal((min(100000, chunks - start), dimensions), dtype=np.float32))
+  write_chunk_store(directory, BASE_FILE_NAME, index, [f"{row:036d}" for row in range(chunks)], Chunks(chunks))
+
+
+def timed(search, queries):
+  search(queries[0])
+  samples = []
+  for query in queries:
+    started = time.perf_counter()
+    search(query)
+    samples.append(time.perf_counter() - started)
+  samples.sort()
+  return {"p50_ms": round(samples[len(samples) // 2] * 1000, 2), "p95_ms": round(samples[int(len(samples) * 0.95)] * 1000, 2)}
+
+
+def run(chunks, dimensions, queries, k, fetch_k):
+  directory = tempfile.mkdtemp()
+  build(directory, chunks, dimensions)
+  rng = np.random.default_rng(1)
+  vectors = {f"query {i}": rng.standard_normal(dimensions).astype(np.float32).tolist() for i in range(queries)}
+  db = load_chunk_store_faiss(directory, BASE_FILE_NAME, QueryVectors(vectors))
+  retriever = MMRRetriever(db=db, k=k, fetch_k=fetch_k)
+  filtered = retriever.filtered({"documentId": [f"document-{i}" for i in range(0, chunks // 200, 10)]})
+  names = list(vectors)
+  return {
+    "chunks": chunks,
+    "langchain_mmr": timed(lambda query: db.max_marginal_relevance_search_by_vector(vectors[query], k=k, fetch_k=fetch_k), names),
+    "mmr_retriever": timed(retriever.invoke, names),
+    "mmr_retriever_filtered_10pct": timed(filtered.invoke, names),
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--chunks", type=int, nargs="+", default=[10000, 100000, 1000000])
+  parser.add_argument("--dimensions", type=int, default=128)
+  parser.add_argument("--queries", type=int, default=50)
+  parser.add_argument("--k", type=int, default=8)
+  parser.add_argument("--fetch-k", type=int, default=20)
+  args = parser.parse_args()
+  results = [run(chunks, args.dimensions, args.queries, args.k, args.fetch_k) for chunks in args.chunks]
+  print(json.dumps({"dimensions": args.dimensions, "k": args.k, "fetch_k": args.fetch_k, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+  main()
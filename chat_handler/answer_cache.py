@@ -0,0 +1,177 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+import boto3
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from question_router import normalize_question
+from shared.tracing import span, timed
+
+# Answers to first-turn questions, reused for later questions whose embedding is close enough. Entries
+# belong to the index version they were answered from, so publishing a new index retires them, and expire
+# after `ttl_seconds`; the least recently used entries are evicted beyond `max_entries`. The DynamoDB backend
+# shares answers between containers: each container keeps the current version's entries in memory and only
+# re-reads them every `refresh_interval` seconds, so a hit costs no network call besides the query embedding.
+# Each user's index has versions of its own, so entries also carry a `scope` (the user id, None for the
+# shared index): a new version only retires the older entries of its own scope.
+
+logger = logging.getLogger()
+
+
+def entry_key(version, question):
+  return f"{version}#{hashlib.sha256(normalize_question(question).encode('utf-8')).hexdigest()[:32]}"
+
+
+def unit_vector(vector):
+  vector = np.asarray(vector, dtype=np.float32)
+  norm = np.linalg.norm(vector)
+  return vector / norm if norm else vector
+
+
+class LocalAnswerCache:
+  def __init__(self, threshold=0.92, max_entries=512, ttl_seconds=24 * 3600):
+    self.threshold = threshold
+    self.max_entries = max_entries
+    self.ttl_seconds = ttl_seconds
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+    self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+  def _add(self, key, scope, version, vector, answer, sources, expires_at):
+    self._entries[key] = (scope, version, unit_vector(vector), (answer, list(sources)), expires_at)
+    self._entries.move_to_end(key)
+    while len(self._entries) > self.max_entries:
+      self._entries.popitem(last=False)
+      self.stats["evictions"] += 1
+
+  # Returns the (answer, source titles) of the closest entry, or None below the similarity threshold
+  def lookup(self, version, vector, scope=None):
+    now = time.time()
+    with self._lock:
+      stale = [key for key, entry in self._entries.items() if entry[0] == scope and entry[1] != version or entry[4] <= now]
+      for key in stale:
+        del self._entries[key]
+        self.stats["evictions"] += 1
+      keys = [key for key, entry in self._entries.items() if entry[0] == scope]
+      if keys:
+        similarities = np.stack([self._entries[key][2] for key in keys]) @ unit_vector(vector)
+        best = int(np.argmax(similarities))
+        if similarities[best] >= self.threshold:
+          self._entries.move_to_end(keys[best])
+          self.stats["hits"] += 1
+          return self._entries[keys[best]][3]
+      self.stats["misses"] += 1
+      return None
+
+  def put(self, version, question, vector, answer, sources=(), scope=None):
+    with self._lock:
+      self._add(entry_key(version, question), scope, version, vector, answer, sources, time.time() + self.ttl_seconds)
+      self.stats["stores"] += 1
+
+
+class DynamoDBAnswerCache(LocalAnswerCache):
+  def __init__(self, dynamodb=None, table_name="AnswerCache", refresh_interval=60, **kwargs):
+    super().__init__(**kwargs)
+    self._dynamodb = dynamodb
+    self.table_name = table_name
+    self.refresh_interval = refresh_interval
+    # scope -> (version, monotonic time its entries were last read)
+    self._loaded = {}
+    self.stats["refreshes"] = 0
+
+  @property
+  def dynamodb(self):
+    if self._dynamodb is None:
+      self._dynamodb = boto3.client('dynamodb')
+    return self._dynamodb
+
+  @timed("dynamodb")
+  def _refresh(self, version, scope):
+    # Reads every live entry of `version` through the indexVersion-index GSI
+    now = time.time()
+    items = []
+    query = {
+      'TableName': self.table_name,
+      'IndexName': 'indexVersion-index',
+      'KeyConditionExpression': 'indexVersion = :version',
+      'ExpressionAttributeValues': {':version': {'S': version}},
+    }
+    while True:
+      response = self.dynamodb.query(**query)
+      items.extend(response.get('Items', []))
+      if 'LastEvaluatedKey' not in response:
+        break
+      query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    with self._lock:
+      for item in items:
+        expires_at = int(item['expiresAt']['N'])
+        if expires_at > now and item['entryId']['S'] not in self._entries:
+          vector = np.frombuffer(bytes(item['vector']['B']), dtype=np.float32)
+          sources = [source['S'] for source in item.get('sources', {}).get('L', [])]
+          self._add(item['entryId']['S'], scope, version, vector, item['answer']['S'], sources, expires_at)
+      self.stats["refreshes"] += 1
+
+  def lookup(self, version, vector, scope=None):
+    loaded_version, loaded_at = self._loaded.get(scope, (None, 0.0))
+    if loaded_version != version or time.monotonic() - loaded_at >= self.refresh_interval:
+      self._loaded[scope] = (version, time.monotonic())
+      self._refresh(version, scope)
+    return super().lookup(version, vector, scope)
+
+  def put(self, version, question, vector, answer, sources=(), scope=None):
+    super().put(version, question, vector, answer, sources, scope)
+    with span("dynamodb"):
+      self.dynamodb.put_item(TableName=self.table_name, Item={
+        'entryId': {'S': entry_key(version, question)},
+        'indexVersion': {'S': version},
+        'question': {'S': question},
+        'answer': {'S': answer},
+        'sources': {'L': [{'S': source} for source in sources]},
+        'vector': {'B': np.asarray(vector, dtype=np.float32).tobytes()},
+        'expiresAt': {'N': str(int(time.time() + self.ttl_seconds))},
+      })
+
+
+class RecentQueryEmbeddings(Embeddings):
+  # Remembers the embeddings of the most recent queries, so the question embedded for the answer cache
+  # isn't sent to the embeddings API a second time by the retriever on a cache miss
+  def __init__(self, underlying, max_queries=64):
+    self.underlying = underlying
+    self.max_queries = max_queries
+    self._queries = OrderedDict()
+    self._lock = threading.Lock()
+
+  def embed_documents(self, texts):
+    return self.underlying.embed_documents(texts)
+
+  def embed_query(self, text):
+    with self._lock:
+      if text in self._queries:
+        self._queries.move_to_end(text)
+        return self._queries[text]
+    with span("embedding"):
+      vector = self.underlying.embed_query(text)
+    with self._lock:
+      self._queries[text] = vector
+      while len(self._queries) > self.max_queries:
+        self._queries.popitem(last=False)
+    return vector
+
+
+def create_answer_cache():
+  backend = os.getenv('ANSWER_CACHE', 'dynamodb')
+  settings = {
+    'threshold': float(os.getenv('ANSWER_CACHE_THRESHOLD', '0.92')),
+    'max_entries': int(os.getenv('ANSWER_CACHE_SIZE', '512')),
+    'ttl_seconds': int(os.getenv('ANSWER_CACHE_TTL_SECONDS', str(24 * 3600))),
+  }
+  if backend == 'dynamodb':
+    return DynamoDBAnswerCache(table_name=os.getenv('ANSWER_CACHE_TABLE', 'AnswerCache'), **settings)
+  if backend == 'local':
+    return LocalAnswerCache(**settings)
+  if backend == 'none':
+    return None
+  raise ValueError(f"Unknown ANSWER_CACHE backend '{backend}'")
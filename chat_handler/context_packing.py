@@ -0,0 +1,139 @@
+import logging
+import re
+import threading
+from langchain_core.documents import Document
+from shared.tokens import estimate_tokens
+from shared.tracing import count, timed
+
+# Turns the retrieved chunks into the context passages of the QA prompt. The indexer splits documents into
+# overlapping chunks and MMR often returns neighbours from the same document, so chunks of one documentId
+# that are adjacent (by chunk position) or overlap textually are merged into one passage with the repeated
+# text removed. Passages that mostly repeat a more relevant one (by shared word 3-grams) are dropped, and the
+# rest are added in relevance order while they fit the token budget. A passage ranks as high as its most
+# relevant chunk. Indexes built before chunk positions were recorded are merged on textual overlap only.
+
+logger = logging.getLogger()
+
+MIN_OVERLAP_CHARS = 8
+PACKING_STATS = ("requests", "chunks", "passages", "tokens_before", "tokens_after", "merged",
+                 "duplicates_dropped", "over_budget_dropped")
+
+
+def text_overlap(before, after):
+  # Length of the longest suffix of `before` that `after` starts with
+  for size in range(min(len(before), len(after)), MIN_OVERLAP_CHARS - 1, -1):
+    if before.endswith(after[:size]):
+      return size
+  return 0
+
+
+def shingles(text, size=3):
+  words = re.findall(r"\w+", text.casefold())
+  return {tuple(words[i:i + size]) for i in range(max(1, len(words) - size + 1))}
+
+
+class Passage:
+  def __init__(self, document, rank):
+    self.document = document
+    self.rank = rank
+    self.text = document.page_content
+    position = document.metadata.get("chunk")
+    self.positions = [position] if position is not None else []
+
+  def join(self, document, rank):
+    # Merges `document` into the passage when it is a neighbour; returns False otherwise
+    text = document.page_content
+    position = document.metadata.get("chunk")
+    if position is not None and self.positions:
+      if position in self.positions:
+        self.rank = min(self.rank, rank)
+        return True
+      if position != self.positions[-1] + 1:
+        return False
+      overlap = text_overlap(self.text, text)
+      self.text += text[overlap:] if overlap else "\n" + text
+      self.positions.append(position)
+    elif text in self.text:
+      pass
+    elif text_overlap(self.text, text):
+      self.text += text[text_overlap(self.text, text):]
+    elif text_overlap(text, self.text):
+      self.text = text + self.text[text_overlap(text, self.text):]
+    else:
+      return False
+    self.rank = min(self.rank, rank)
+    return True
+
+  def to_document(self):
+    metadata = {key: value for key, value in self.document.metadata.items() if key != "chunk"}
+    if self.positions:
+      metadata["chunks"] = self.positions
+    return Document(page_content=self.text, metadata=metadata)
+
+
+class ContextPacker:
+  def __init__(self, max_tokens=1500, duplicate_overlap=0.8, stats=None):
+    self.max_tokens = max_tokens
+    # Share of the smaller passage's 3-grams that also appear in a kept passage for it to count as a duplicate
+    self.duplicate_overlap = duplicate_overlap
+    self.stats = stats if stats is not None else {}
+    self._stats_lock = threading.Lock()
+
+  def merge(self, documents):
+    groups = {}
+    for rank, document in enumerate(documents):
+      groups.setdefault(document.metadata.get("documentId", id(document)), []).append((rank, document))
+    passages = []
+    for members in groups.values():
+      # Chunks in document order, so each one only has to be tried against the passages before it
+      members.sort(key=lambda member: (member[1].metadata.get("chunk", float("inf")), member[0]))
+      merged = []
+      for rank, document in members:
+        if not any(passage.join(document, rank) for passage in merged):
+          merged.append(Passage(document, rank))
+      passages.extend(merged)
+    return sorted(passages, key=lambda passage: passage.rank)
+
+  def is_duplicate(self, grams, kept):
+    return any(len(grams & other) >= self.duplicate_overlap * min(len(grams), len(other)) for other in kept)
+
+  @timed("context_packing")
+  def pack(self, documents):
+    passages = self.merge(documents)
+    packed, kept = [], []
+    duplicates = over_budget = tokens = 0
+    for passage in passages:
+      grams = shingles(passage.text)
+      if self.is_duplicate(grams, kept):
+        duplicates += 1
+        continue
+      size = estimate_tokens(passage.text)
+      if tokens + size > self.max_tokens:
+        if packed:
+          over_budget += 1
+          continue
+        # The most relevant passage is cut to the budget rather than leaving the prompt without context
+        passage.text = passage.text[:self.max_tokens * 4]
+        size = estimate_tokens(passage.text)
+      packed.append(passage.to_document())
+      kept.append(grams)
+      tokens += size
+
+    request = {
+      "requests": 1,
+      "chunks": len(documents),
+      "passages": len(packed),
+      "tokens_before": sum(estimate_tokens(document.page_content) for document in documents),
+      "tokens_after": tokens,
+      "merged": len(documents) - len(passages),
+      "duplicates_dropped": duplicates,
+      "over_budget_dropped": over_budget,
+    }
+    logger.info(f"Packed {request['chunks']} chunks into {request['passages']} passages, "
+                f"{request['tokens_before']} -> {request['tokens_after']} tokens: {request}")
+    count("context_tokens", request["tokens_after"])
+    count("context_tokens_saved", request["tokens_before"] - request["tokens_after"])
+    with self._stats_lock:
+      for key in PACKING_STATS:
+        self.stats[key] = self.stats.get(key, 0) + request[key]
+    return packed
@@ -0,0 +1,144 @@
+import logging
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+import boto3
+from shared.index_manifest import read_manifest
+from shared.tracing import span, timed
+
+# Keeps the FAISS index (and whatever is built on top of it) resident for the lifetime of a warm Lambda
+# container. The index manifest is checked at most once every `refresh_interval` seconds and, when it points
+# at a new version, that version is downloaded and swapped in on a background thread while requests keep
+# being served from the current one. Buckets without a manifest fall back to the unversioned objects under
+# `prefix`, versioned by their ETags. Each version is downloaded into its own directory under `local_dir`,
+# since the index files stay memory-mapped while they are served and must not be overwritten in place.
+# Users' indexes have no unversioned fallback: a user without a published index raises IndexNotPublished.
+
+logger = logging.getLogger()
+
+
+class IndexNotPublished(Exception):
+  pass
+
+
+class IndexCache:
+  def __init__(self, bucket, prefix, base_file_name, build, refresh_interval=60, local_dir="/tmp/", s3_client=None,
+               legacy_fallback=True):
+    self.bucket = bucket
+    self.prefix = prefix
+    self.legacy_fallback = legacy_fallback
+    self.base_file_name = base_file_name
+    self.build = build
+    self.refresh_interval = refresh_interval
+    self.local_dir = local_dir
+    self._s3 = s3_client
+    self._lock = threading.Lock()
+    self._refreshing = False
+    self._value = None
+    self._version = None
+    self._size = 0
+    self._last_check = 0.0
+    self.stats = {"hits": 0, "loads": 0, "checks": 0, "swaps": 0, "refresh_errors": 0}
+
+  @property
+  def s3(self):
+    if self._s3 is None:
+      self._s3 = boto3.client("s3")
+    return self._s3
+
+  @property
+  def version(self):
+    return self._version
+
+  @property
+  def size(self):
+    # Bytes of the loaded version's files, which the index and its chunk store take in memory once touched
+    return self._size
+
+  def resolve(self):
+    # Returns the current version and the S3 keys of its files
+    manifest, _ = read_manifest(self.s3, self.bucket, self.prefix)
+    if manifest is not None:
+      return manifest["version"], [f"{manifest['prefix']}{file_name}" for file_name in manifest["files"]]
+    if not self.legacy_fallback:
+      raise IndexNotPublished(f"No index has been published under {self.prefix}")
+    keys = [f"{self.prefix}{self.base_file_name}.faiss", f"{self.prefix}{self.base_file_name}.pkl"]
+    etags = [self.s3.head_object(Bucket=self.bucket, Key=key)["ETag"].strip('"') for key in keys]
+    return ":".join(etags), keys
+
+  def get(self):
+    with self._lock:
+      if self._value is None:
+        self._load(*self.resolve())
+        return self._value
+      self.stats["hits"] += 1
+      value = self._value
+      due = time.monotonic() - self._last_check >= self.refresh_interval
+      if due and not self._refreshing:
+        self._refreshing = True
+        self._last_check = time.monotonic()
+        threading.Thread(target=self._refresh, daemon=True).start()
+    return value
+
+  def _version_dir(self, version):
+    return f"{self.local_dir}{version.replace(':', '-')}/"
+
+  @timed("s3_download")
+  def _download(self, version, keys):
+    version_dir = self._version_dir(version)
+    Path(version_dir).mkdir(parents=True, exist_ok=True)
+    for key in keys:
+      self.s3.download_file(self.bucket, key, f"{version_dir}{key.rsplit('/', 1)[-1]}")
+    return version_dir
+
+  def _files_size(self, version):
+    version_dir = self._version_dir(version)
+    return sum(entry.stat().st_size for entry in os.scandir(version_dir) if entry.is_file())
+
+  def _load(self, version, keys):
+    started = time.monotonic()
+    version_dir = self._download(version, keys)
+    with span("index_load"):
+      self._value = self.build(version_dir, self.base_file_name)
+    self._version = version
+    self._size = self._files_size(version)
+    self._last_check = time.monotonic()
+    self.stats["loads"] += 1
+    logger.info(f"Loaded FAISS index version {version} in {time.monotonic() - started:.2f}s")
+
+  def _refresh(self):
+    try:
+      self.stats["checks"] += 1
+      version, keys = self.resolve()
+      if version == self._version:
+        return
+      logger.info(f"FAISS index changed from {self._version} to {version}, reloading")
+      value = self.build(self._download(version, keys), self.base_file_name)
+      size = self._files_size(version)
+      with self._lock:
+        if self._version is None:
+          # Closed while the new version was loading
+          shutil.rmtree(self._version_dir(version), ignore_errors=True)
+          return
+        previous_version = self._version
+        self._value = value
+        self._version = version
+        self._size = size
+        self.stats["loads"] += 1
+        self.stats["swaps"] += 1
+      # Requests still holding the previous index keep their mappings after the files are unlinked
+      shutil.rmtree(self._version_dir(previous_version), ignore_errors=True)
+    except Exception as e:
+      self.stats["refresh_errors"] += 1
+      logger.error(f"FAISS index refresh failed: {str(e)}")
+    finally:
+      self._refreshing = False
+
+  def close(self):
+    # Drops the index and its local files; requests still holding it keep working on the unlinked files
+    with self._lock:
+      version, self._value, self._version, self._size = self._version, None, None, 0
+    if version is not None:
+      shutil.rmtree(self._version_dir(version), ignore_errors=True)
@@ -0,0 +1,67 @@
+import logging
+import shutil
+import threading
+from collections import OrderedDict
+from shared.tracing import count
+
+# Users' indexes, kept resident in a warm container while they are in use. A user's index is loaded on that
+# user's first question (through an IndexCache of its own, so it is refreshed like the shared index) and the
+# least recently used indexes are closed once the loaded ones take more than `max_bytes` together, estimated
+# by the size of their files, or once less than `min_free_bytes` is left on the disk holding them. The index
+# that was just used is never evicted, so a single index larger than the cap is still served. A user whose
+# index fails to load is not kept in the pool.
+
+logger = logging.getLogger()
+
+
+class IndexPool:
+  def __init__(self, create_cache, max_bytes, min_free_bytes=0, disk_path="/tmp"):
+    # `create_cache(user_id)` returns an IndexCache for the user's index
+    self.create_cache = create_cache
+    self.max_bytes = max_bytes
+    self.min_free_bytes = min_free_bytes
+    self.disk_path = disk_path
+    self._caches = OrderedDict()
+    self._lock = threading.Lock()
+    self.stats = {"hits": 0, "loads": 0, "load_errors": 0, "evictions": 0, "resident": 0, "resident_bytes": 0}
+
+  def get(self, user_id):
+    # Returns the user's IndexCache and the value built on its current index
+    with self._lock:
+      cache = self._caches.get(user_id)
+      if cache is None:
+        cache = self._caches[user_id] = self.create_cache(user_id)
+      self._caches.move_to_end(user_id)
+    loaded = cache.version is not None
+    try:
+      value = cache.get()
+    except Exception:
+      with self._lock:
+        self.stats["load_errors"] += 1
+        if cache.version is None and self._caches.get(user_id) is cache:
+          del self._caches[user_id]
+      raise
+    with self._lock:
+      self.stats["hits" if loaded else "loads"] += 1
+    count("index_pool_hit", int(loaded))
+    self.evict()
+    return cache, value
+
+  def full(self, size):
+    if size > self.max_bytes:
+      return True
+    return self.min_free_bytes > 0 and shutil.disk_usage(self.disk_path).free < self.min_free_bytes
+
+  def evict(self):
+    while True:
+      with self._lock:
+        size = sum(cache.size for cache in self._caches.values())
+        self.stats["resident"] = len(self._caches)
+        self.stats["resident_bytes"] = size
+        if len(self._caches) <= 1 or not self.full(size):
+          return
+        user_id, cache = self._caches.popitem(last=False)
+        self.stats["evictions"] += 1
+      # Closing removes the index files, so the free disk space is checked again afterwards
+      logger.info(f"Evicting the index of user {user_id} ({cache.size} bytes) from the index pool")
+      cache.close()
@@ -1,43 +1,140 @@
 import os
 import json
-import boto3
-from pathlib import Path
-from langchain.chains import create_history_aware_retriever, create_retrieval_chain
-from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain_openai import OpenAIEmbeddings
-from langchain_openai import ChatOpenAI
+import logging
+import threading
+import time
+import weakref
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.messages import AIMessage, HumanMessage
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.runnables import RunnableLambda, RunnablePassthrough
 from langchain_core.runnables.history import RunnableWithMessageHistory
-from langchain_core.chat_history import BaseChatMessageHistory
-from langchain_community.chat_message_histories import ChatMessageHistory
 from langchain_community.vectorstores import FAISS
+from botocore.exceptions import ClientError
+from answer_cache import RecentQueryEmbeddings, create_answer_cache
+from context_packing import ContextPacker
+from index_cache import IndexCache, IndexNotPublished
+from index_pool import IndexPool
+from mmr_retriever import MMRRetriever, check_filter
+from question_router import QuestionRouter
+from session_history import SessionHistoryCache, create_session_backend, message_tokens
+from shared.index_manifest import BASE_FILE_NAME, INDEX_PREFIX, index_prefix
+from shared.chunk_store import is_chunk_store, load_chunk_store_faiss
+from shared.tenants import check_user_id
+from shared.tokens import estimate_tokens
+from shared.tracing import Tracer, count
 
+# Cold starts: langchain_openai (and the openai SDK behind it) is the most expensive import of this module,
+# so it is imported when the first client is built instead of at init, and the retrieval chain is assembled
+# from langchain_core runnables rather than importing langchain.chains. The OpenAI clients and the prompts are
+# created once per container and shared by every chain; a chain is built once per index version. With
+# PREWARM_INDEX=true the index is downloaded and the chain built during the Lambda init phase, with the
+# OpenAI clients built on a second thread while the index downloads.
 
-def lambda_handler(event, context):
-  
-  def get_session_history(session_id: str) -> BaseChatMessageHistory:
-    if session_id not in store:
-        store[session_id] = ChatMessageHistory()
-    return store[session_id]
-    
-  store = {}
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
 
-  try:
-    file_path = f"/tmp/"
-    base_file_name = "faiss_index"
-    Path(file_path).mkdir(parents=True, exist_ok=True)
+# Stage timings, token counts and cold/warm starts of every request, emitted as one metrics record each
+tracer = Tracer("chat_handler")
+
+# How often each retrieval path was taken (no_history, self_contained, rewrite, speculative_hit/miss), kept
+# across index reloads for the lifetime of the container
+route_stats = {}
+# Context packing totals (chunks, passages, tokens before/after, merged, duplicates and over-budget passages)
+packing_stats = {}
+
+_clients_lock = threading.Lock()
+_query_embeddings = None
+_chat_model = None
+
+
+def query_embeddings():
+  # Shared by the retriever and the answer cache, so a question is embedded once per request
+  global _query_embeddings
+  with _clients_lock:
+    if _query_embeddings is None:
+      from langchain_openai import OpenAIEmbeddings
+      _query_embeddings = RecentQueryEmbeddings(OpenAIEmbeddings(
+        client = None, model = "text-embedding-3-small"
+      ))
+  return _query_embeddings
+
+
+def chat_model():
+  # One client for the question rewrite, the answer and history summaries
+  global _chat_model
+  with _clients_lock:
+    if _chat_model is None:
+      from langchain_openai import ChatOpenAI
+      _chat_model = ChatOpenAI(model="gpt-3.5-turbo")
+  return _chat_model
+
+
+contextualize_q_system_prompt = (
+          "Given a chat history and the latest user question "
+          "which might reference context in the chat history, "
+          "formulate a standalone question which can be understood "
+          "without the chat history. Do NOT answer the question, "
+          "just reformulate it if needed and otherwise return it as is."
+      )
+
+contextualize_q_prompt = ChatPromptTemplate.from_messages(
+          [
+              ("system", contextualize_q_system_prompt),
+              MessagesPlaceholder("chat_history"),
+              ("human", "{input}"),
+          ]
+      )
+
+system_prompt = (
+          "You are an assistant for question-answering tasks. "
+          "Use the following pieces of retrieved context to answer "
+          "the question. If you don't know the answer, say that you "
+          "don't know. Use three sentences maximum and keep the "
+          "answer concise."
+          "\n\n"
+          "{context}"
+      )
+
+qa_prompt = ChatPromptTemplate.from_messages(
+          [
+              ("system", system_prompt),
+              MessagesPlaceholder("chat_history"),
+              ("human", "{input}"),
+          ]
+      )
+
+summary_prompt = ChatPromptTemplate.from_messages(
+          [
+              ("system", "Update the summary of a conversation about composting with the turns below. "
+                         "Keep the facts and topics the user may refer back to, in at most 100 words."),
+              ("human", "Summary so far: {summary}\n\nNew turns:\n{conversation}"),
+          ]
+      )
+
+# Neighbouring and duplicate chunks are merged, and the context is kept within CONTEXT_MAX_TOKENS
+context_packer = ContextPacker(
+  max_tokens=int(os.getenv('CONTEXT_MAX_TOKENS', '1500')),
+  duplicate_overlap=float(os.getenv('CONTEXT_DUPLICATE_OVERLAP', '0.8')),
+  stats=packing_stats,
+)
 
-    s3 = boto3.client("s3")
-    s3.download_file('compost-chatbot-bucket', f"indices/{base_file_name}.faiss", f"{file_path}{base_file_name}.faiss")
-    s3.download_file('compost-chatbot-bucket', f"indices/{base_file_name}.pkl", f"{file_path}{base_file_name}.pkl")
 
-    openai_api_key = os.getenv('OPENAI_API_KEY')
-    if not openai_api_key:
-      raise ValueError("OPENAI_API_KEY environment variable is not set")
-    embeddings_model = OpenAIEmbeddings(
-      client = None, model = "text-embedding-3-small"
-    )
+def format_context(inputs):
+  # The passages as the stuff-documents chain joins them
+  return "\n\n".join(document.page_content for document in inputs["context"])
 
+
+def build_rag_chain(file_path, base_file_name):
+  openai_api_key = os.getenv('OPENAI_API_KEY')
+  if not openai_api_key:
+    raise ValueError("OPENAI_API_KEY environment variable is not set")
+  embeddings_model = query_embeddings()
+
+  if is_chunk_store(file_path, base_file_name):
+    db = load_chunk_store_faiss(file_path, base_file_name, embeddings_model)
+  else:
+    # Indexes published before the chunk store format still carry a pickled docstore
     db = FAISS.load_local(
             index_name=base_file_name,
             folder_path=file_path,
@@ -45,78 +142,244 @@ def lambda_handler(event, context):
             allow_dangerous_deserialization=True,
         )
 
-    retriever = db.as_retriever(search_type="mmr", search_kwargs={"k": 8})
+  score_threshold = os.getenv('RETRIEVER_SCORE_THRESHOLD')
+  retriever = MMRRetriever(
+    db=db,
+    k=int(os.getenv('RETRIEVER_K', '8')),
+    fetch_k=int(os.getenv('RETRIEVER_FETCH_K', '20')),
+    lambda_mult=float(os.getenv('RETRIEVER_LAMBDA_MULT', '0.5')),
+    score_threshold=float(score_threshold) if score_threshold else None,
+  )
 
-    contextualize_q_system_prompt = (
-              "Given a chat history and the latest user question "
-              "which might reference context in the chat history, "
-              "formulate a standalone question which can be understood "
-              "without the chat history. Do NOT answer the question, "
-              "just reformulate it if needed and otherwise return it as is."
-          )
+  # Only follow-up questions are rewritten into standalone ones before retrieval
+  router = QuestionRouter(
+    contextualize_q_prompt | chat_model() | StrOutputParser(),
+    retriever,
+    mode=os.getenv('QUESTION_ROUTING', 'adaptive'),
+    stats=route_stats,
+  )
+  history_aware_retriever = RunnableLambda(router.retrieve) | RunnableLambda(context_packer.pack)
 
-    contextualize_q_prompt = ChatPromptTemplate.from_messages(
-              [
-                  ("system", contextualize_q_system_prompt),
-                  MessagesPlaceholder("chat_history"),
-                  ("human", "{input}"),
-              ]
-          )
+  # Same shape as create_retrieval_chain over create_stuff_documents_chain: the output stream carries
+  # "context" once retrieval is done, then the "answer" tokens
+  question_answer_chain = RunnablePassthrough.assign(context=format_context) | qa_prompt | chat_model() | StrOutputParser()
+  return RunnablePassthrough.assign(context=history_aware_retriever).assign(answer=question_answer_chain)
 
-    history_aware_retriever = create_history_aware_retriever(ChatOpenAI(model="gpt-3.5-turbo"), retriever, contextualize_q_prompt)
 
-    system_prompt = (
-              "You are an assistant for question-answering tasks. "
-              "Use the following pieces of retrieved context to answer "
-              "the question. If you don't know the answer, say that you "
-              "don't know. Use three sentences maximum and keep the "
-              "answer concise."
-              "\n\n"
-              "{context}" 
-          )
-    
-    qa_prompt = ChatPromptTemplate.from_messages(
-              [
-                  ("system", system_prompt),
-                  MessagesPlaceholder("chat_history"),
-                  ("human", "{input}"),
-              ]
-          )
+# The index and the chain built on it live as long as the container; warm invocations reuse them and only
+# reload when the index manifest in S3 points at a new version.
+index_cache = IndexCache(
+  bucket='compost-chatbot-bucket',
+  prefix=INDEX_PREFIX,
+  base_file_name=BASE_FILE_NAME,
+  build=build_rag_chain,
+  refresh_interval=int(os.getenv('INDEX_REFRESH_SECONDS', '60')),
+)
+
+
+def create_user_index_cache(user_id):
+  return IndexCache(
+    bucket='compost-chatbot-bucket',
+    prefix=index_prefix(user_id),
+    base_file_name=BASE_FILE_NAME,
+    build=build_rag_chain,
+    refresh_interval=int(os.getenv('INDEX_REFRESH_SECONDS', '60')),
+    local_dir=f"/tmp/users/{user_id}/",
+    legacy_fallback=False,
+  )
+
+
+# Requests carrying a user_id are answered from that user's own index. Users' indexes are loaded on first use
+# and the least recently used ones are dropped once together they exceed INDEX_POOL_MAX_MB, or once less than
+# INDEX_POOL_MIN_FREE_MB is left in /tmp, which also holds the shared index and refresh downloads.
+index_pool = IndexPool(
+  create_user_index_cache,
+  max_bytes=int(os.getenv('INDEX_POOL_MAX_MB', '256')) * 1024 * 1024,
+  min_free_bytes=int(os.getenv('INDEX_POOL_MIN_FREE_MB', '128')) * 1024 * 1024,
+)
+
+
+def index_for(user_id):
+  # The IndexCache and RAG chain that answer `user_id`, or the shared ones
+  if user_id is None:
+    return index_cache, index_cache.get()
+  return index_pool.get(user_id)
+
+
+def summarize_history(summary, messages):
+  conversation = "\n".join(f"{message.type}: {message.content}" for message in messages)
+  chain = summary_prompt | chat_model() | StrOutputParser()
+  return chain.invoke({"summary": summary or "(none)", "conversation": conversation})
 
-    question_answer_chain = create_stuff_documents_chain(ChatOpenAI(model="gpt-3.5-turbo"), qa_prompt)
-    rag_chain = create_retrieval_chain(history_aware_retriever, question_answer_chain)
 
+# Session histories are persisted per session_id and the most recent ones stay cached in the container.
+# Turns that fall outside the token budget are dropped, or summarized when HISTORY_SUMMARIZE is set.
+session_histories = SessionHistoryCache(
+  create_session_backend(),
+  max_sessions=int(os.getenv('SESSION_CACHE_SIZE', '256')),
+  max_tokens=int(os.getenv('HISTORY_MAX_TOKENS', '1000')),
+  summarize=summarize_history if os.getenv('HISTORY_SUMMARIZE', 'false') == 'true' else None,
+)
 
-    conversational_rag_chain = RunnableWithMessageHistory(
+
+# Answers to history-free first turns, reused for near-duplicate questions against the same index version
+answer_cache = create_answer_cache()
+
+
+def source_titles(documents):
+  return list(dict.fromkeys(document.metadata.get("title", "") for document in documents))
+
+
+# IndexCache -> (chain, history wrapper); an evicted user's entry goes with its IndexCache
+_conversational = weakref.WeakKeyDictionary()
+
+
+def conversational_chain(cache, rag_chain):
+  # The history wrapper is built once per chain, i.e. once per index version
+  chain, conversational = _conversational.get(cache, (None, None))
+  if chain is not rag_chain:
+    conversational = RunnableWithMessageHistory(
               rag_chain,
-              get_session_history,
+              lambda session_id: session_histories.get(session_id),
               input_messages_key="input",
               history_messages_key="chat_history",
               output_messages_key="answer",
           )
-    
-    body = json.loads(event['body'])
-    query = body.get('query')
-    session_id = body.get('session_id', 'default_session')
+    _conversational[cache] = (rag_chain, conversational)
+  return conversational
+
+
+def answer_events(query, session_id, filter=None, user_id=None):
+  # Yields ("sources", titles) once retrieval is done, then ("token", text) as the answer is generated.
+  # Cached answers come back as a single token. `filter` limits retrieval to the given documentIds/titles.
+  cache, rag_chain = index_for(user_id)
+  # The version this answer comes from; a refresh can swap the index in while the answer is generated
+  version = cache.version
+  conversational_rag_chain = conversational_chain(cache, rag_chain)
+  logger.info(f"FAISS index cache stats: {cache.stats}")
+  if user_id is not None:
+    logger.info(f"Index pool stats: {index_pool.stats}")
+    # Session ids are chosen by clients, so each user's sessions are kept apart. parse_request rejects a
+    # "/" in session ids, so no shared session can be named like one of them.
+    session_id = f"{user_id}/{session_id}"
+
+  # Only unfiltered first turns can be served from the answer cache; a follow-up's answer depends on its history.
+  # Entries are scoped to the user whose index answered them.
+  history = session_histories.get(session_id)
+  count("question_tokens", estimate_tokens(query))
+  count("history_tokens", sum(message_tokens(message) for message in history.messages))
+  cacheable = answer_cache is not None and not history.messages and not filter
+  if cacheable:
+    vector = query_embeddings().embed_query(query)
+    try:
+      cached = answer_cache.lookup(version, vector, user_id)
+    except ClientError as e:
+      logger.warning(f"Answer cache lookup failed: {str(e)}")
+      cached = None
+    logger.info(f"Answer cache stats: {answer_cache.stats}")
+    count("answer_cache_hit", int(cached is not None))
+    if cached is not None:
+      answer, sources = cached
+      history.add_messages([HumanMessage(content=query), AIMessage(content=answer)])
+      yield "sources", sources
+      yield "token", answer
+      return
+
+  sources = []
+  answer = []
+  started = time.perf_counter()
+  generation_started = None
+  for chunk in conversational_rag_chain.stream(
+    {"input": query, "filter": filter},
+    config={"configurable": {"session_id": session_id}}
+  ):
+    if "context" in chunk:
+      generation_started = time.perf_counter()
+      sources = source_titles(chunk["context"])
+      yield "sources", sources
+    if chunk.get("answer"):
+      if not answer:
+        count("first_token", (time.perf_counter() - started) * 1000, "Milliseconds")
+      answer.append(chunk["answer"])
+      yield "token", chunk["answer"]
+  # Generation is timed from the retrieved context to the last token
+  if generation_started is not None:
+    count("llm_generation", (time.perf_counter() - generation_started) * 1000, "Milliseconds")
+  count("answer_tokens", estimate_tokens("".join(answer)))
+  logger.info(f"Session history cache stats: {session_histories.stats}")
+  logger.info(f"Question routing stats: {route_stats}")
+  logger.info(f"Context packing stats: {packing_stats}")
+
+  if cacheable:
+    try:
+      answer_cache.put(version, query, vector, "".join(answer), sources, user_id)
+    except ClientError as e:
+      logger.warning(f"Answer cache write failed: {str(e)}")
+
+
+def parse_request(event):
+  body = json.loads(event['body'])
+  user_id = body.get('user_id')
+  if user_id is not None:
+    check_user_id(user_id)
+  session_id = body.get('session_id', 'default_session')
+  if not isinstance(session_id, str) or not session_id or "/" in session_id:
+    raise ValueError(f"Invalid session id {session_id!r}")
+  filter = body.get('filter')
+  if filter is not None:
+    check_filter(filter)
+  return body.get('query'), session_id, filter, user_id
 
-    if not query:
+
+def lambda_handler(event, context):
+  with tracer.invocation(RequestId=getattr(context, 'aws_request_id', '')):
+    try:
+      query, session_id, filter, user_id = parse_request(event)
+    except Exception as e:
+      # A malformed body or an invalid user_id, answered like the stream server does
       return {
         'statusCode': 400,
-        'body': json.dumps({'error': 'No query was provided'})
+        'body': json.dumps({'error': str(e)})
+      }
+    try:
+      if not query:
+        return {
+          'statusCode': 400,
+          'body': json.dumps({'error': 'No query was provided'})
+        }
+
+      answer = "".join(data for kind, data in answer_events(query, session_id, filter, user_id) if kind == "token")
+      return {
+          'statusCode': 200,
+          'body': json.dumps({'response': answer})
+      }
+    except IndexNotPublished as e:
+      return {
+        'statusCode': 404,
+        'body': json.dumps({'error': str(e)})
       }
-    
-    result = conversational_rag_chain.invoke(
-      {"input": query},
-      config={"configurable": {"session_id": session_id}}
-    )
-
-  
-    return {
-        'statusCode': 200,
-        'body': json.dumps({'response': result["answer"]})
-    }
+    except Exception as e:
+      count("errors")
+      return {
+        'statusCode': 500,
+        'body': str(e)
+      }
+
+
+def prewarm():
+  # Runs during the Lambda init phase: the OpenAI clients are built on a second thread while the index is
+  # downloaded and the chain built, so the first request finds both ready
+  started = time.perf_counter()
+  clients = threading.Thread(target=chat_model, daemon=True)
+  clients.start()
+  try:
+    conversational_chain(index_cache, index_cache.get())
   except Exception as e:
-    return {
-      'statusCode': 500,
-      'body': str(e)
-    }
\ No newline at end of file
+    # The first request retries the load and reports the error
+    logger.warning(f"Prewarming the index failed: {str(e)}")
+  clients.join()
+  logger.info(f"Prewarmed in {(time.perf_counter() - started) * 1000:.0f} ms, FAISS index cache stats: {index_cache.stats}")
+
+
+if os.getenv('PREWARM_INDEX', 'false') == 'true':
+  prewarm()
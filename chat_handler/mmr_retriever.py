@@ -0,0 +1,120 @@
+from typing import Any, Optional
+import faiss
+import numpy as np
+from langchain_core.retrievers import BaseRetriever
+from shared.chunk_store import ChunkStoreDocstore
+from shared.tracing import span
+
+# Maximal marginal relevance over a FAISS vectorstore in one index search. The `fetch_k` nearest rows and
+# their vectors are fetched in batch, and each MMR step is a vector operation over all candidates: the
+# query similarities and the candidate-to-candidate similarity matrix are computed once, and the highest
+# similarity of every candidate to the already selected ones is kept as a running maximum. The selection
+# matches LangChain's maximal_marginal_relevance.
+#
+# `filter` restricts results to chunks whose documentId and/or title is one of the given values. On a chunk
+# store index the matching rows are handed to FAISS as an ID selector, so the search only ever returns
+# matching chunks; other indexes are post-filtered from a larger candidate set, as LangChain does.
+
+
+def normalize_rows(vectors):
+  norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+  return vectors / np.where(norms == 0, 1, norms)
+
+
+def mmr_select(query, candidates, k, lambda_mult):
+  # Returns the positions of the selected candidates in selection order
+  if min(k, len(candidates)) <= 0:
+    return []
+  candidates = normalize_rows(np.asarray(candidates, dtype=np.float32))
+  query = np.asarray(query, dtype=np.float32)
+  query_similarity = candidates @ (query / (np.linalg.norm(query) or 1))
+  similarity = candidates @ candidates.T
+  selected = [int(np.argmax(query_similarity))]
+  redundancy = similarity[selected[0]].copy()
+  available = np.ones(len(candidates), dtype=bool)
+  available[selected[0]] = False
+  while len(selected) < min(k, len(candidates)):
+    scores = np.where(available, lambda_mult * query_similarity - (1 - lambda_mult) * redundancy, -np.inf)
+    best = int(np.argmax(scores))
+    selected.append(best)
+    available[best] = False
+    np.maximum(redundancy, similarity[best], out=redundancy)
+  return selected
+
+
+def check_filter(filter):
+  # Filters come from clients: metadata fields mapped to a value or a list of accepted values
+  if not isinstance(filter, dict) or not all(
+      isinstance(value, str) or (isinstance(value, list) and all(isinstance(item, str) for item in value))
+      for value in filter.values()):
+    raise ValueError(f"Invalid filter {filter!r}, expected fields mapped to a string or a list of strings")
+  return filter
+
+
+def filter_values(filter):
+  return {key: {value} if isinstance(value, str) else set(value) for key, value in (filter or {}).items() if value}
+
+
+def matches(metadata, values):
+  return all(metadata.get(key) in allowed for key, allowed in values.items())
+
+
+class MMRRetriever(BaseRetriever):
+  db: Any
+  k: int = 8
+  fetch_k: int = 20
+  lambda_mult: float = 0.5
+  # Minimum cosine similarity to the query; weaker candidates are dropped before MMR
+  score_threshold: Optional[float] = None
+  filter: Optional[dict] = None
+
+  def filtered(self, filter):
+    return self.model_copy(update={"filter": filter}) if filter else self
+
+  def _store(self):
+    docstore = self.db.docstore
+    return docstore.store if isinstance(docstore, ChunkStoreDocstore) else None
+
+  def _allowed_rows(self, store, values):
+    documents = [document for document in range(len(store.document_ids))
+                 if matches({"documentId": store.document_ids[document], "title": store.titles[document]}, values)]
+    return np.flatnonzero(np.isin(store.rows, documents)).astype(np.int64)
+
+  def _document(self, row):
+    return self.db.docstore.search(self.db.index_to_docstore_id[int(row)])
+
+  def _candidates(self, query):
+    # Returns the FAISS rows of the candidates for MMR
+    index = self.db.index
+    values = filter_values(self.filter)
+    store = self._store()
+    if values and store is not None:
+      rows = self._allowed_rows(store, values)
+      if len(rows) <= self.fetch_k:
+        return rows
+      selector = faiss.IDSelectorBatch(rows)
+      # IVF indexes only take their own parameter type, which has to carry nprobe along
+      ivf = faiss.try_extract_index_ivf(index)
+      params = faiss.SearchParametersIVF(sel=selector, nprobe=ivf.nprobe) if ivf is not None else faiss.SearchParameters(sel=selector)
+      _, labels = index.search(query[None, :], self.fetch_k, params=params)
+      return labels[0][labels[0] >= 0]
+
+    _, labels = index.search(query[None, :], self.fetch_k * 2 if values else self.fetch_k)
+    rows = labels[0][labels[0] >= 0]
+    if values:
+      rows = np.array([row for row in rows if matches(self._document(row).metadata, values)][:self.fetch_k], dtype=np.int64)
+    return rows
+
+  def _get_relevant_documents(self, query, *, run_manager=None):
+    vector = np.asarray(self.db.embeddings.embed_query(query), dtype=np.float32)
+    with span("retrieval"):
+      rows = np.asarray(self._candidates(vector), dtype=np.int64)
+      if not len(rows):
+        return []
+      candidates = self.db.index.reconstruct_batch(rows)
+      if self.score_threshold is not None:
+        similarity = normalize_rows(candidates) @ (vector / (np.linalg.norm(vector) or 1))
+        kept = np.flatnonzero(similarity >= self.score_threshold)
+        rows, candidates = rows[kept], candidates[kept]
+      # Only the selected rows are turned into Documents
+      return [self._document(rows[position]) for position in mmr_select(vector, candidates, self.k, self.lambda_mult)]
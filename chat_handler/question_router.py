@@ -0,0 +1,85 @@
+import logging
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from shared.tracing import propagate, span
+
+# Decides per question whether the chat history has to be folded into a standalone question by the rewrite
+# model before retrieval. First turns and questions that read as self-contained go straight to the retriever;
+# only likely follow-ups (pronouns and other references back, "what about ..." openers, very short questions)
+# pay for the LLM round-trip. In 'speculative' mode a follow-up is also retrieved on the raw question while
+# the rewrite is in flight, and those documents are used when the rewrite comes back unchanged.
+
+logger = logging.getLogger()
+
+ROUTING_MODES = ("always", "adaptive", "speculative")
+
+FOLLOW_UP_WORDS = frozenset((
+  "it", "its", "it's", "itself", "they", "them", "their", "theirs", "this", "that", "these", "those",
+  "he", "she", "him", "her", "his", "there", "one", "ones", "such", "same", "other", "another",
+  "former", "latter", "above", "previous", "mentioned",
+))
+FOLLOW_UP_OPENERS = ("and ", "but ", "also ", "so ", "then ", "what about", "how about", "what else", "why not", "how so", "any other", "more ")
+MIN_SELF_CONTAINED_WORDS = 4
+
+
+def normalize_question(question):
+  return " ".join(re.findall(r"[a-z0-9']+", question.lower()))
+
+
+def is_self_contained(question):
+  text = normalize_question(question)
+  words = text.split()
+  if len(words) < MIN_SELF_CONTAINED_WORDS or f"{text} ".startswith(FOLLOW_UP_OPENERS):
+    return False
+  return not any(word in FOLLOW_UP_WORDS for word in words)
+
+
+class QuestionRouter:
+  def __init__(self, rewrite, retriever, mode="adaptive", stats=None):
+    if mode not in ROUTING_MODES:
+      raise ValueError(f"Unknown question routing mode '{mode}', expected one of {ROUTING_MODES}")
+    self.rewrite = rewrite
+    self.retriever = retriever
+    self.mode = mode
+    self.stats = stats if stats is not None else {}
+    self._stats_lock = threading.Lock()
+    self._executor = ThreadPoolExecutor(max_workers=4) if mode == "speculative" else None
+
+  def _count(self, path):
+    with self._stats_lock:
+      self.stats[path] = self.stats.get(path, 0) + 1
+    return path
+
+  def route(self, inputs):
+    if not inputs.get("chat_history"):
+      return "no_history"
+    if self.mode != "always" and is_self_contained(inputs["input"]):
+      return "self_contained"
+    return "speculative" if self.mode == "speculative" else "rewrite"
+
+  def _rewrite(self, inputs, config):
+    with span("question_rewrite"):
+      return self.rewrite.invoke(inputs, config)
+
+  def retrieve(self, inputs, config=None):
+    question = inputs["input"]
+    # A request can narrow retrieval to some documents; see MMRRetriever.filter
+    retriever = self.retriever.filtered(inputs["filter"]) if inputs.get("filter") else self.retriever
+    path = self.route(inputs)
+    if path in ("no_history", "self_contained"):
+      self._count(path)
+      return retriever.invoke(question, config)
+
+    if path == "rewrite":
+      self._count(path)
+      return retriever.invoke(self._rewrite(inputs, config), config)
+
+    speculative = self._executor.submit(propagate(retriever.invoke), question, config)
+    standalone = self._rewrite(inputs, config)
+    if normalize_question(standalone) == normalize_question(question):
+      self._count("speculative_hit")
+      return speculative.result()
+    self._count("speculative_miss")
+    speculative.cancel()
+    return retriever.invoke(standalone, config)
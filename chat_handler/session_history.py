@@ -0,0 +1,202 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+import boto3
+from botocore.exceptions import ClientError
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import SystemMessage, messages_from_dict, messages_to_dict
+from shared.tokens import estimate_tokens
+from shared.tracing import timed
+
+# Conversation memory that outlives a single invocation. Each session's history is persisted in a backend
+# (DynamoDB, or a process-local dict for local runs) and kept in a bounded LRU cache of the warm container,
+# so follow-up turns usually don't read the backend at all. Writes are conditional on the version the cache
+# last saw: when another container has written the session in the meantime, the history is reloaded and the
+# new turn appended to it. Histories are kept within a token budget by dropping the oldest turns, which are
+# optionally folded into a running summary first.
+
+logger = logging.getLogger()
+
+SAVE_ATTEMPTS = 3
+
+
+def message_tokens(message):
+  # Every chat message also costs a few tokens of role and framing
+  return estimate_tokens(message.content) + 4
+
+
+class SessionConflict(Exception):
+  pass
+
+
+class InMemorySessionBackend:
+  def __init__(self):
+    self.sessions = {}
+    self._lock = threading.Lock()
+
+  def load(self, session_id):
+    with self._lock:
+      record = self.sessions.get(session_id)
+      return json.loads(record) if record else None
+
+  def save(self, session_id, record, expected_version):
+    with self._lock:
+      current = self.sessions.get(session_id)
+      if (json.loads(current)["version"] if current else 0) != expected_version:
+        raise SessionConflict(session_id)
+      self.sessions[session_id] = json.dumps(record)
+
+
+class DynamoDBSessionBackend:
+  def __init__(self, dynamodb=None, table_name="ChatSessions", ttl_seconds=7 * 24 * 3600):
+    self._dynamodb = dynamodb
+    self.table_name = table_name
+    self.ttl_seconds = ttl_seconds
+
+  @property
+  def dynamodb(self):
+    if self._dynamodb is None:
+      self._dynamodb = boto3.client('dynamodb')
+    return self._dynamodb
+
+  @timed("dynamodb")
+  def load(self, session_id):
+    item = self.dynamodb.get_item(TableName=self.table_name, Key={'sessionId': {'S': session_id}}, ConsistentRead=True).get('Item')
+    if not item:
+      return None
+    return {
+      'messages': json.loads(item['messages']['S']),
+      'summary': item.get('summary', {}).get('S', ''),
+      'version': int(item['version']['N']),
+    }
+
+  @timed("dynamodb")
+  def save(self, session_id, record, expected_version):
+    item = {
+      'sessionId': {'S': session_id},
+      'messages': {'S': json.dumps(record['messages'])},
+      'summary': {'S': record['summary']},
+      'version': {'N': str(record['version'])},
+      'expiresAt': {'N': str(int(time.time()) + self.ttl_seconds)},
+    }
+    if expected_version:
+      condition = {'ConditionExpression': 'version = :expected', 'ExpressionAttributeValues': {':expected': {'N': str(expected_version)}}}
+    else:
+      condition = {'ConditionExpression': 'attribute_not_exists(sessionId)'}
+    try:
+      self.dynamodb.put_item(TableName=self.table_name, Item=item, **condition)
+    except ClientError as e:
+      if e.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException':
+        raise SessionConflict(session_id)
+      raise
+
+
+class SessionHistory(BaseChatMessageHistory):
+  def __init__(self, session_id, backend, max_tokens, summarize=None):
+    self.session_id = session_id
+    self.backend = backend
+    self.max_tokens = max_tokens
+    self.summarize = summarize
+    self.loaded_at = 0.0
+    self.reload()
+
+  def reload(self):
+    record = self.backend.load(self.session_id) or {'messages': [], 'summary': '', 'version': 0}
+    self._messages = messages_from_dict(record['messages'])
+    self.summary = record['summary']
+    self.version = record['version']
+    self.loaded_at = time.monotonic()
+
+  @property
+  def messages(self):
+    if self.summary:
+      return [SystemMessage(content=f"Summary of the earlier conversation: {self.summary}")] + self._messages
+    return list(self._messages)
+
+  def trim(self, messages, summary):
+    # Drops the oldest whole turns until the history fits the budget, always keeping the latest turn
+    budget = self.max_tokens - (estimate_tokens(summary) if summary else 0)
+    tokens = sum(message_tokens(message) for message in messages)
+    start = 0
+    while tokens > budget and start < len(messages):
+      end = start + 1
+      while end < len(messages) and messages[end].type != "human":
+        end += 1
+      if end == len(messages):
+        break
+      tokens -= sum(message_tokens(message) for message in messages[start:end])
+      start = end
+    if start and self.summarize:
+      try:
+        summary = self.summarize(summary, messages[:start])
+      except Exception as e:
+        logger.warning(f"Summarizing session {self.session_id} failed, dropping the oldest turns: {str(e)}")
+    return messages[start:], summary
+
+  def add_messages(self, messages):
+    for attempt in range(SAVE_ATTEMPTS):
+      kept, summary = self.trim(self._messages + list(messages), self.summary)
+      record = {'messages': messages_to_dict(kept), 'summary': summary, 'version': self.version + 1}
+      try:
+        self.backend.save(self.session_id, record, self.version)
+      except SessionConflict:
+        logger.info(f"Session {self.session_id} was written by another container, reloading it")
+        self.reload()
+        continue
+      self._messages, self.summary, self.version = kept, summary, record['version']
+      self.loaded_at = time.monotonic()
+      return
+    logger.warning(f"Could not save session {self.session_id} after {SAVE_ATTEMPTS} attempts")
+
+  def clear(self):
+    self._messages = []
+    self.summary = ''
+    self.add_messages([])
+
+
+class SessionHistoryCache:
+  # LRU of the container's most recently used sessions. Entries older than `max_age` seconds are reloaded
+  # so a session that moved to another container and back doesn't resume from a stale copy.
+  def __init__(self, backend, max_sessions=256, max_tokens=1000, summarize=None, max_age=300):
+    self.backend = backend
+    self.max_sessions = max_sessions
+    self.max_tokens = max_tokens
+    self.summarize = summarize
+    self.max_age = max_age
+    self._sessions = OrderedDict()
+    self._lock = threading.Lock()
+    self.stats = {"hits": 0, "misses": 0, "reloads": 0, "evictions": 0}
+
+  def get(self, session_id):
+    with self._lock:
+      history = self._sessions.get(session_id)
+      if history is not None:
+        self._sessions.move_to_end(session_id)
+        if time.monotonic() - history.loaded_at < self.max_age:
+          self.stats["hits"] += 1
+          return history
+        self.stats["reloads"] += 1
+        history.reload()
+        return history
+      self.stats["misses"] += 1
+      history = SessionHistory(session_id, self.backend, self.max_tokens, self.summarize)
+      self._sessions[session_id] = history
+      while len(self._sessions) > self.max_sessions:
+        self._sessions.popitem(last=False)
+        self.stats["evictions"] += 1
+      return history
+
+
+def create_session_backend():
+  backend = os.getenv('SESSION_HISTORY', 'dynamodb')
+  if backend == 'dynamodb':
+    return DynamoDBSessionBackend(
+      table_name=os.getenv('SESSION_HISTORY_TABLE', 'ChatSessions'),
+      ttl_seconds=int(os.getenv('SESSION_TTL_SECONDS', str(7 * 24 * 3600))),
+    )
+  if backend == 'memory':
+    return InMemorySessionBackend()
+  raise ValueError(f"Unknown SESSION_HISTORY backend '{backend}'")
@@ -0,0 +1,98 @@
+import argparse
+import json
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# HTTP entry point that streams answers as server-sent events while they are generated. The Python Lambda
+# runtime returns a response only once the handler finishes, so streaming is served by this server instead:
+# locally, or inside the container behind the Lambda Web Adapter with invoke mode RESPONSE_STREAM.
+#
+#   POST /chat         {"query": ..., "session_id": ..., "filter": ..., "user_id": ...}  ->  {"response": ...}, same as lambda_handler
+#   POST /chat/stream  {"query": ..., "session_id": ..., "filter": ..., "user_id": ...}  ->  text/event-stream:
+#     event: sources  data: ["Backyard Composting", ...]
+#     event: token    data: "Compost"          (repeated)
+#     event: done     data: {"response": "<the whole answer>"}
+#     event: error    data: {"error": "..."}   (instead of done, when the answer failed)
+#
+#   python chat_handler/stream_server.py --port 8080
+
+logger = logging.getLogger()
+
+
+def sse_event(kind, data):
+  return f"event: {kind}\ndata: {json.dumps(data)}\n\n".encode("utf-8")
+
+
+def make_server(chat, host="127.0.0.1", port=8080):
+  # `chat` is the chat handler's lambda_function module
+  class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+      pass
+
+    def _write_chunk(self, data):
+      self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+      self.wfile.flush()
+
+    def _send_json(self, status, body):
+      data = body.encode("utf-8")
+      self.send_response(status)
+      self.send_header("Content-Type", "application/json")
+      self.send_header("Content-Length", str(len(data)))
+      self.end_headers()
+      self.wfile.write(data)
+
+    def do_POST(self):
+      event = {'body': self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")}
+      if self.path == "/chat":
+        response = chat.lambda_handler(event, None)
+        self._send_json(response['statusCode'], response['body'])
+        return
+      if self.path != "/chat/stream":
+        self._send_json(404, json.dumps({'error': 'Not found'}))
+        return
+
+      try:
+        query, session_id, filter, user_id = chat.parse_request(event)
+      except Exception as e:
+        self._send_json(400, json.dumps({'error': str(e)}))
+        return
+      if not query:
+        self._send_json(400, json.dumps({'error': 'No query was provided'}))
+        return
+
+      self.send_response(200)
+      self.send_header("Content-Type", "text/event-stream")
+      self.send_header("Cache-Control", "no-cache")
+      self.send_header("Transfer-Encoding", "chunked")
+      self.end_headers()
+      answer = []
+      with chat.tracer.invocation(Endpoint="stream"):
+        try:
+          for kind, data in chat.answer_events(query, session_id, filter, user_id):
+            if kind == "token":
+              answer.append(data)
+            self._write_chunk(sse_event(kind, data))
+          self._write_chunk(sse_event("done", {'response': "".join(answer)}))
+        except Exception as e:
+          logger.error(f"Streaming answer failed: {str(e)}")
+          self._write_chunk(sse_event("error", {'error': str(e)}))
+      self.wfile.write(b"0\r\n\r\n")
+
+  return ThreadingHTTPServer((host, port), Handler)
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=8080)
+  args = parser.parse_args()
+  import lambda_function
+  server = make_server(lambda_function, args.host, args.port)
+  logger.info(f"Serving chat on http://{args.host}:{args.port}")
+  server.serve_forever()
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,81 @@
+import hashlib
+import unicodedata
+from botocore.exceptions import ClientError
+from shared.tracing import timed
+
+# Content-hash index used to skip duplicate uploads. DocumentHashes maps "pdf#<sha256 of the PDF bytes>",
+# "text#<sha256 of the normalized extracted text>" and "title#<title>" to a documentId. A known PDF hash is
+# caught before extraction, a known text hash catches the same guide saved as a different PDF, and a known
+# title turns a re-upload into an update of the existing document. A user's documents are only compared with
+# that user's, under keys prefixed with "user#<userId>#".
+
+HASH_CHUNK_BYTES = 8 * 1024 * 1024
+
+
+def source_sha256(source):
+  digest = hashlib.sha256()
+  if isinstance(source, str):
+    with open(source, "rb") as f:
+      for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b""):
+        digest.update(chunk)
+  else:
+    digest.update(memoryview(source))
+  return digest.hexdigest()
+
+
+def text_fingerprint(parts):
+  # Hash of the NFKC-normalized, case-folded words of the text, so whitespace and layout differences
+  # between extractions don't matter. A word split across two parts is carried over to the next part,
+  # which makes the result independent of how the pages were split between workers. Text without any words,
+  # like that of an image-only PDF, has no fingerprint: such PDFs can only be told apart by their bytes.
+  digest = hashlib.sha256()
+  carry = ""
+  empty = True
+  for part in parts:
+    text = carry + unicodedata.normalize("NFKC", part.decode("utf-8")).casefold()
+    words = text.split()
+    carry = words.pop() if words and not text[-1].isspace() else ""
+    for word in words:
+      digest.update(word.encode("utf-8") + b" ")
+      empty = False
+  if carry:
+    digest.update(carry.encode("utf-8") + b" ")
+    empty = False
+  return None if empty else digest.hexdigest()
+
+
+class DocumentHashIndex:
+  def __init__(self, table, user_id=None):
+    self.table = table
+    self.scope = f"user#{user_id}#" if user_id is not None else ""
+
+  def key(self, kind, value):
+    return {'hash': f"{self.scope}{kind}#{value}"}
+
+  @timed("dynamodb")
+  def lookup(self, kind, value):
+    item = self.table.get_item(Key=self.key(kind, value)).get('Item')
+    return item['documentId'] if item else None
+
+  @timed("dynamodb")
+  def claim(self, kind, value, documentId):
+    # Returns False when another upload registered the same hash first
+    try:
+      self.table.put_item(
+        Item={**self.key(kind, value), 'documentId': documentId},
+        ConditionExpression='attribute_not_exists(#h)',
+        ExpressionAttributeNames={'#h': 'hash'},
+      )
+      return True
+    except ClientError as e:
+      if e.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException':
+        return False
+      raise
+
+  @timed("dynamodb")
+  def put(self, kind, value, documentId):
+    self.table.put_item(Item={**self.key(kind, value), 'documentId': documentId})
+
+  @timed("dynamodb")
+  def delete(self, kind, value):
+    self.table.delete_item(Key=self.key(kind, value))
@@ -1,46 +1,236 @@
 import os
 import json
+import time
 import uuid
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 import boto3
-import fitz
+from deduplication import DocumentHashIndex, source_sha256, text_fingerprint
+from pdf_extraction import extract_text, map_object, spool_object
+from shared.tenants import upload_user_id
+from shared.tracing import Tracer, count, propagate, span
 
+# PDFs uploaded under users/<userId>/ are that user's documents: they carry a userId, are only deduplicated
+# against the user's other documents and end up in the user's own index.
+#
+# Extracted text larger than TEXT_OFFLOAD_BYTES does not fit comfortably in a DynamoDB item (400 KB limit),
+# so it is written to S3 and DocumentMetadata keeps a pointer to it next to the extraction stats.
+EXTRACTED_TEXT_PREFIX = "extracted-text/"
+
+# boto3 resources are not thread-safe, so each worker thread gets its own DocumentMetadata and DocumentHashes tables
+_thread_state = threading.local()
+
+# Stage timings and record counts of every invocation, emitted as one metrics record each
+tracer = Tracer("data_ingestion_handler")
+
+
+class IngestionFailed(Exception):
+  pass
+
+
+def document_table():
+  if not hasattr(_thread_state, 'table'):
+    _thread_state.table = boto3.resource('dynamodb').Table('DocumentMetadata')
+  return _thread_state.table
+
+
+def hash_index(user_id=None):
+  if not hasattr(_thread_state, 'hash_table'):
+    _thread_state.hash_table = boto3.resource('dynamodb').Table(os.getenv('DOCUMENT_HASH_TABLE', 'DocumentHashes'))
+  return DocumentHashIndex(_thread_state.hash_table, user_id)
+
+
+def s3_records(event):
+  # Yields (item identifier, S3 record) pairs for direct S3 notifications and for S3 notifications
+  # delivered through SQS, where the identifier is the SQS messageId used for partial batch failures
+  for record in event.get('Records', []):
+    if 's3' in record:
+      yield record['s3']['object']['key'], record
+    elif 'body' in record:
+      for s3_record in json.loads(record['body']).get('Records', []):
+        yield record['messageId'], s3_record
+
+
+def process_record(s3_client, record):
+  bucket_name = record['s3']['bucket']['name']
+  key = urllib.parse.unquote_plus(record['s3']['object']['key'])
+  if key.startswith(EXTRACTED_TEXT_PREFIX):
+    return {'key': key, 'status': 'skipped'}
+  filename = os.path.basename(key)
+  title = os.path.splitext(filename)[0]
+  user_id = upload_user_id(key)
+
+  hashes = hash_index(user_id)
+
+  # Spool the PDF to /tmp or stream it into memory, without reading the whole body into one bytes object
+  started = time.monotonic()
+  pdf_source = os.getenv('PDF_SOURCE', 'spool')
+  with span('s3_download'):
+    if pdf_source == 'spool':
+      source = spool_object(s3_client, bucket_name, key, f"/tmp/{uuid.uuid4()}.pdf")
+    elif pdf_source == 'mmap':
+      source = map_object(s3_client, bucket_name, key)
+    else:
+      raise ValueError(f"Unknown PDF_SOURCE '{pdf_source}', expected 'spool' or 'mmap'")
 
-def lambda_handler(event, context):
+  try:
+    # A byte-identical upload is recognized before any extraction work is done
+    with span('hashing'):
+      pdf_hash = source_sha256(source)
+    duplicate_of = hashes.lookup('pdf', pdf_hash)
+    if duplicate_of:
+      return {'key': key, 'status': 'duplicate', 'documentId': duplicate_of}
+    workers = int(os.getenv('PDF_EXTRACT_WORKERS', '0')) or None
+    with span('pdf_extraction'):
+      parts, pages = extract_text(source, workers)
+  finally:
+    if pdf_source == 'spool':
+      os.remove(source)
+    else:
+      source.close()
+  text_bytes = sum(len(part) for part in parts)
+  extraction_ms = int((time.monotonic() - started) * 1000)
+
+  # The same text saved as a different PDF is a duplicate too; remember its PDF hash so the next copy is
+  # caught before extraction
+  with span('hashing'):
+    text_hash = text_fingerprint(parts)
+  duplicate_of = hashes.lookup('text', text_hash) if text_hash else None
+  if duplicate_of:
+    hashes.put('pdf', pdf_hash, duplicate_of)
+    return {'key': key, 'status': 'duplicate', 'documentId': duplicate_of}
+
+  # A new version of a known title replaces that document instead of adding a second one
+  previous_id = hashes.lookup('title', title)
+  documentId = previous_id or str(uuid.uuid4())
+  if not previous_id and not hashes.claim('title', title, documentId):
+    previous_id = documentId = hashes.lookup('title', title)
+  if text_hash and not hashes.claim('text', text_hash, documentId):
+    return {'key': key, 'status': 'duplicate', 'documentId': hashes.lookup('text', text_hash)}
+  with span('dynamodb'):
+    previous = document_table().get_item(Key={'documentId': previous_id}).get('Item', {}) if previous_id else {}
+
+  item = {
+      'documentId': documentId,
+      'title': title,  
+      'status': 'pending',
+      'pages': pages,
+      'textBytes': text_bytes,
+      'extractionMs': extraction_ms,
+      'pdfHash': pdf_hash,
+  }
+  if text_hash:
+    item['textHash'] = text_hash
+  if user_id is not None:
+    item['userId'] = user_id
+  try:
+    if text_bytes > int(os.getenv('TEXT_OFFLOAD_BYTES', '300000')):
+      text_bucket = os.getenv('EXTRACTED_TEXT_BUCKET', bucket_name)
+      text_key = f"{EXTRACTED_TEXT_PREFIX}{documentId}.txt"
+      # Write the page-range blocks straight to a spool file instead of joining them in memory
+      text_path = f"/tmp/{documentId}.txt"
+      with open(text_path, 'wb') as f:
+        f.writelines(parts)
+      del parts
+      try:
+        with span('s3_upload'):
+          s3_client.upload_file(Filename=text_path, Bucket=text_bucket, Key=text_key, ExtraArgs={'ContentType': 'text/plain; charset=utf-8'})
+      finally:
+        os.remove(text_path)
+      item['textBucket'] = text_bucket
+      item['textKey'] = text_key
+    else:
+      item['text'] = b"".join(parts).decode('utf-8')
+
+    with span('dynamodb'):
+      document_table().put_item(Item=item)
+  except Exception:
+    # Give the text hash back so a retry of this record isn't mistaken for a duplicate
+    if text_hash:
+      hashes.delete('text', text_hash)
+    raise
+  hashes.put('pdf', pdf_hash, documentId)
+  if previous_id:
+    # The previous version's hashes no longer describe this document
+    if previous.get('textHash') not in (None, text_hash):
+      hashes.delete('text', previous['textHash'])
+    if previous.get('pdfHash') not in (None, pdf_hash):
+      hashes.delete('pdf', previous['pdfHash'])
+    # Nor does its offloaded text once the new version is stored inline or somewhere else
+    if previous.get('textKey') and (previous['textBucket'], previous['textKey']) != (item.get('textBucket'), item.get('textKey')):
+      with span('s3_delete'):
+        s3_client.delete_object(Bucket=previous['textBucket'], Key=previous['textKey'])
+  count('pages', pages)
+  count('text_bytes', text_bytes, 'Bytes')
+  result = {'key': key, 'status': 'updated' if previous_id else 'stored', 'documentId': documentId, 'pages': pages, 'textBytes': text_bytes}
+  if user_id is not None:
+    result['userId'] = user_id
+  return result
+
+
+def ingest_records(event, context):
   try:
     s3_client = boto3.client('s3')
-    dynamodb = boto3.resource('dynamodb')
-    table = dynamodb.Table('DocumentMetadata')
-
-    bucket_name = event['Records'][0]['s3']['bucket']['name']
-    
-    key = event['Records'][0]['s3']['object']['key']
-    filename = os.path.basename(key)
-    title = os.path.splitext(filename)[0]
-
-    documentId = str(uuid.uuid4())
-
-    response = s3_client.get_object(Bucket=bucket_name, Key=key)
-    file_content = response['Body'].read()
-
-    document = fitz.open("pdf", file_content)
-    text = ""
-    for page in document:
-          text += page.get_text()
-
-    response = table.put_item(
-          Item={
-              'documentId': documentId,
-              'text': text,
-              'title': title,  
-              'status': 'pending',
-          }
-      )
+    records = list(s3_records(event))
+
+    # Every record in the batch is processed, a bounded number at a time; a failed record is reported
+    # individually so only it is retried
+    def run(entry):
+      identifier, record = entry
+      try:
+        return identifier, process_record(s3_client, record), None
+      except Exception as e:
+        return identifier, None, str(e)
+
+    max_workers = max(1, min(int(os.getenv('INGEST_CONCURRENCY', '4')), len(records)))
+    # Each record reports its stages into this invocation's metrics from its worker thread
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+      futures = [executor.submit(propagate(run), entry) for entry in records]
+      outcomes = [future.result() for future in futures]
+
+    results = []
+    failures = []
+    for identifier, result, error in outcomes:
+      if error is None:
+        results.append(result)
+      else:
+        results.append({'key': identifier, 'status': 'failed', 'error': error})
+        if identifier not in failures:
+          failures.append(identifier)
+      count(f"records_{results[-1]['status']}")
+
+    if not failures:
+      status_code = 200
+    elif len(failures) == len(records):
+      status_code = 500
+    else:
+      status_code = 207
     return {
-          'statusCode': 200,
-          'body': json.dumps('Text successfully extracted and stored.')
+          'statusCode': status_code,
+          'body': json.dumps({
+            'message': 'Text successfully extracted and stored.' if not failures else f"{len(failures)} of {len(records)} records failed.",
+            'results': results,
+          }),
+          'batchItemFailures': [{'itemIdentifier': identifier} for identifier in failures],
       }
   except Exception as e:
+    count('errors')
     return {
       'statusCode': 500,
       'body': str(e)
-    }
\ No newline at end of file
+    }
+
+
+def lambda_handler(event, context):
+  with tracer.invocation(RequestId=getattr(context, 'aws_request_id', '')):
+    response = ingest_records(event, context)
+  # Partial batch failures only work through SQS. Direct S3 notifications invoke the function asynchronously,
+  # which ignores the response, so a failed record is only retried when the invocation raises; the records
+  # that succeeded come back as duplicates and are skipped before extraction. The same goes for an SQS batch
+  # that failed before any record could be reported.
+  from_sqs = any('s3' not in record for record in event.get('Records', []))
+  reported = from_sqs and response.get('batchItemFailures')
+  if response['statusCode'] != 200 and not reported:
+    raise IngestionFailed(response['body'])
+  return response
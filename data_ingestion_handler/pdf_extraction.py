@@ -0,0 +1,104 @@
+import mmap
+import multiprocessing
+import os
+import threading
+import fitz
+
+# Text extraction for uploaded PDFs. The PDF is either spooled to /tmp or streamed into an anonymous
+# memory map, so the S3 body is never held as one bytes object, and large PDFs are split into page ranges
+# extracted in parallel by forked worker processes. Lambda has no /dev/shm, which rules out
+# multiprocessing.Pool and its queues; plain Process + Pipe works. Each worker returns its range as one
+# UTF-8 block and the blocks are kept as a list of parts, so callers can write them out without ever
+# concatenating the whole text.
+#
+# MuPDF is not thread-safe, so when several records are ingested concurrently every MuPDF call made in this
+# process, and every fork, happens under one lock. The forked workers never touch the lock.
+
+READ_CHUNK_BYTES = 8 * 1024 * 1024
+MIN_PAGES_PER_WORKER = 8
+
+_mupdf_lock = threading.Lock()
+
+
+def spool_object(s3_client, bucket, key, path):
+  s3_client.download_file(bucket, key, path)
+  return path
+
+
+def map_object(s3_client, bucket, key):
+  response = s3_client.get_object(Bucket=bucket, Key=key)
+  mapped = mmap.mmap(-1, max(response['ContentLength'], 1))
+  for chunk in iter(lambda: response['Body'].read(READ_CHUNK_BYTES), b""):
+    mapped.write(chunk)
+  return mapped
+
+
+def open_pdf(source):
+  if isinstance(source, str):
+    return fitz.open(source)
+  return fitz.open(stream=memoryview(source), filetype="pdf")
+
+
+def page_ranges(page_count, workers):
+  workers = max(1, min(workers, page_count // MIN_PAGES_PER_WORKER))
+  size, extra = divmod(page_count, workers)
+  start = 0
+  for worker in range(workers):
+    end = start + size + (1 if worker < extra else 0)
+    yield start, end
+    start = end
+
+
+def extract_range(source, start, end):
+  document = open_pdf(source)
+  try:
+    return "".join(document[page].get_text() for page in range(start, end)).encode("utf-8")
+  finally:
+    document.close()
+
+
+def _extract_worker(source, start, end, connection):
+  try:
+    connection.send((True, extract_range(source, start, end)))
+  except Exception as e:
+    connection.send((False, str(e)))
+  finally:
+    connection.close()
+
+
+def extract_text(source, workers=None):
+  # Returns (parts, page_count) where parts are UTF-8 blocks in page order
+  with _mupdf_lock:
+    document = open_pdf(source)
+    page_count = document.page_count
+    document.close()
+
+  ranges = list(page_ranges(page_count, workers or os.cpu_count() or 1))
+  if len(ranges) <= 1:
+    with _mupdf_lock:
+      return [extract_range(source, 0, page_count)], page_count
+
+  context = multiprocessing.get_context("fork")
+  processes = []
+  with _mupdf_lock:
+    for start, end in ranges:
+      receiver, sender = context.Pipe(duplex=False)
+      process = context.Process(target=_extract_worker, args=(source, start, end, sender), daemon=True)
+      process.start()
+      sender.close()
+      processes.append((process, receiver, start, end))
+
+  parts = []
+  try:
+    for process, receiver, start, end in processes:
+      succeeded, part = receiver.recv()
+      if not succeeded:
+        raise RuntimeError(f"Extracting pages {start}-{end} failed: {part}")
+      parts.append(part)
+  finally:
+    for process, receiver, _, _ in processes:
+      receiver.close()
+      process.join(timeout=5)
+      if process.is_alive():
+        process.terminate()
+  return parts, page_count
@@ -0,0 +1,147 @@
+import json
+import mmap
+import os
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+from langchain_community.docstore.base import Docstore
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+
+# Pickle-free on-disk layout of the published index. Next to the raw FAISS index it stores the chunk text
+# as one UTF-8 blob addressed by an offsets array, and the chunk metadata as a columnar table: a per-row
+# index into a small table of distinct (documentId, title) pairs, plus the vector IDs the indexer tracks in
+# VectorMetadata, and each chunk's position within its document. Every file except the document table can be
+# memory-mapped, so a reader only touches the pages holding the rows it actually returns instead of
+# unpickling the whole docstore. Stores written before chunk positions were recorded have no .chunks.npy.
+
+FORMAT = "chunkstore-v1"
+SUFFIXES = (".faiss", ".texts", ".offsets.npy", ".rows.npy", ".ids.npy", ".chunks.npy", ".documents.json")
+NO_CHUNK = np.iinfo(np.uint32).max
+
+
+def file_names(base_file_name):
+  return [f"{base_file_name}{suffix}" for suffix in SUFFIXES]
+
+
+def is_chunk_store(folder_path, base_file_name):
+  return os.path.exists(os.path.join(folder_path, f"{base_file_name}.texts"))
+
+
+def write_chunk_store(folder_path, base_file_name, index, ids, documents):
+  # `ids` and `documents` are aligned with the rows of `index`
+  path = os.path.join(folder_path, base_file_name)
+  faiss.write_index(index, f"{path}.faiss")
+
+  offsets = np.zeros(len(documents) + 1, dtype=np.uint64)
+  document_rows = {}
+  rows = np.zeros(len(documents), dtype=np.uint32)
+  chunks = np.full(len(documents), NO_CHUNK, dtype=np.uint32)
+  with open(f"{path}.texts", "wb") as texts:
+    for row, document in enumerate(documents):
+      data = document.page_content.encode("utf-8")
+      texts.write(data)
+      offsets[row + 1] = offsets[row] + len(data)
+      key = (document.metadata.get("documentId", ""), document.metadata.get("title", ""))
+      rows[row] = document_rows.setdefault(key, len(document_rows))
+      if "chunk" in document.metadata:
+        chunks[row] = document.metadata["chunk"]
+  np.save(f"{path}.offsets.npy", offsets)
+  np.save(f"{path}.rows.npy", rows)
+  np.save(f"{path}.ids.npy", np.array(ids, dtype="S36"))
+  np.save(f"{path}.chunks.npy", chunks)
+
+  with open(f"{path}.documents.json", "w", encoding="utf-8") as f:
+    json.dump({
+      "format": FORMAT,
+      "documentId": [documentId for documentId, _ in document_rows],
+      "title": [title for _, title in document_rows],
+    }, f)
+
+
+def write_faiss_store(folder_path, base_file_name, db):
+  rows = range(db.index.ntotal)
+  ids = [db.index_to_docstore_id[row] for row in rows]
+  write_chunk_store(folder_path, base_file_name, db.index, ids, [db.docstore.search(id) for id in ids])
+
+
+class ChunkStore:
+  def __init__(self, folder_path, base_file_name, mmap_index=True):
+    path = os.path.join(folder_path, base_file_name)
+    self.index = read_index(f"{path}.faiss", mmap_index)
+    self.offsets = np.load(f"{path}.offsets.npy", mmap_mode="r")
+    self.rows = np.load(f"{path}.rows.npy", mmap_mode="r")
+    self.ids = np.load(f"{path}.ids.npy", mmap_mode="r")
+    self.chunks = np.load(f"{path}.chunks.npy", mmap_mode="r") if os.path.exists(f"{path}.chunks.npy") else None
+    with open(f"{path}.documents.json", encoding="utf-8") as f:
+      table = json.load(f)
+    self.document_ids = table["documentId"]
+    self.titles = table["title"]
+    with open(f"{path}.texts", "rb") as f:
+      self._texts = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(f"{path}.texts") else b""
+
+  def __len__(self):
+    return len(self.rows)
+
+  def text(self, row):
+    return self._texts[int(self.offsets[row]):int(self.offsets[row + 1])].decode("utf-8")
+
+  def metadata(self, row):
+    document = int(self.rows[row])
+    metadata = {"documentId": self.document_ids[document], "title": self.titles[document]}
+    if self.chunks is not None and self.chunks[row] != NO_CHUNK:
+      metadata["chunk"] = int(self.chunks[row])
+    return metadata
+
+  def document(self, row):
+    return Document(page_content=self.text(row), metadata=self.metadata(row))
+
+  def vector_id(self, row):
+    return self.ids[row].decode("ascii")
+
+
+class ChunkStoreDocstore(Docstore):
+  # Read-only docstore over a ChunkStore whose IDs are the FAISS row numbers, so LangChain's FAISS
+  # vectorstore builds Documents only for the rows a search returns
+  def __init__(self, store):
+    self.store = store
+
+  def search(self, search):
+    return self.store.document(int(search))
+
+
+class RowIds:
+  def __init__(self, size):
+    self.size = size
+
+  def __getitem__(self, row):
+    if not 0 <= row < self.size:
+      raise KeyError(row)
+    return int(row)
+
+  def __len__(self):
+    return self.size
+
+
+def load_chunk_store_faiss(folder_path, base_file_name, embeddings):
+  # Memory-mapped, read-only vectorstore for serving queries
+  store = ChunkStore(folder_path, base_file_name)
+  return FAISS(embeddings, store.index, ChunkStoreDocstore(store), RowIds(len(store)))
+
+
+def load_faiss_store(folder_path, base_file_name, embeddings):
+  # Fully materialized, writable vectorstore for the indexer to update
+  store = ChunkStore(folder_path, base_file_name, mmap_index=False)
+  ids = [store.vector_id(row) for row in range(len(store))]
+  docstore = InMemoryDocstore({id: store.document(row) for row, id in enumerate(ids)})
+  return FAISS(embeddings, store.index, docstore, dict(enumerate(ids)))
+
+
+def read_index(path, mmap_index=True):
+  # Flat codes can be mapped straight from the file; index types that don't support it are read normally
+  if mmap_index:
+    try:
+      return faiss.read_index(path, faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+    except RuntimeError:
+      pass
+  return faiss.read_index(path)
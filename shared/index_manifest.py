@@ -0,0 +1,66 @@
+import json
+import time
+import uuid
+from botocore.exceptions import ClientError
+from shared.tenants import check_user_id
+
+# The published FAISS index lives under a versioned prefix, indices/<version>/, and a small manifest object
+# points at the current version. The indexer uploads a complete version before it swaps the manifest, so
+# readers that follow the manifest never see a half-uploaded .faiss/.pkl pair. The manifest is written with
+# an S3 conditional put against the ETag the indexer started from, so two concurrent runs cannot silently
+# overwrite each other's version. Every user's index is published the same way under its own prefix,
+# indices/users/<userId>/, with its own manifest.
+
+INDEX_PREFIX = "indices/"
+USER_INDEX_PREFIX = f"{INDEX_PREFIX}users/"
+BASE_FILE_NAME = "faiss_index"
+
+
+class ManifestConflict(Exception):
+  pass
+
+
+def new_version():
+  return f"{time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())}-{uuid.uuid4().hex[:8]}"
+
+
+def index_prefix(user_id=None):
+  # Where the shared index, or the index of `user_id`, is published
+  return f"{USER_INDEX_PREFIX}{check_user_id(user_id)}/" if user_id is not None else INDEX_PREFIX
+
+
+def manifest_key(prefix=INDEX_PREFIX):
+  return f"{prefix}manifest.json"
+
+
+MANIFEST_KEY = manifest_key()
+
+
+def version_prefix(version, prefix=INDEX_PREFIX):
+  return f"{prefix}{version}/"
+
+
+def read_manifest(s3, bucket, prefix=INDEX_PREFIX):
+  try:
+    response = s3.get_object(Bucket=bucket, Key=manifest_key(prefix))
+  except ClientError as e:
+    if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey'):
+      return None, None
+    raise
+  return json.loads(response['Body'].read()), response['ETag']
+
+
+def write_manifest(s3, bucket, manifest, expected_etag, prefix=INDEX_PREFIX):
+  conditions = {'IfMatch': expected_etag} if expected_etag else {'IfNoneMatch': '*'}
+  try:
+    s3.put_object(
+      Bucket=bucket,
+      Key=manifest_key(prefix),
+      Body=json.dumps(manifest).encode('utf-8'),
+      ContentType='application/json',
+      **conditions,
+    )
+  except ClientError as e:
+    if e.response.get('Error', {}).get('Code') in ('PreconditionFailed', 'ConditionalRequestConflict'):
+      raise ManifestConflict(f"The index manifest changed since version {expected_etag} was read")
+    raise
@@ -0,0 +1,27 @@
+import re
+
+# Documents, indexes and chat sessions can belong to a user: a person or an organisation served from the same
+# deployment. A PDF uploaded under users/<userId>/ is stored as that user's document (DocumentMetadata.userId,
+# queried through the userId-index), the indexer builds one index per user under indices/users/<userId>/, and
+# a chat request carrying a user_id is answered from that user's index only. Everything else belongs to the
+# shared corpus and its single index, as before. User ids end up in S3 keys and /tmp paths, so only a
+# conservative set of characters is accepted.
+
+UPLOAD_PREFIX = "users/"
+USER_ID_PATTERN = re.compile(r"[A-Za-z0-9][A-Za-z0-9_.@-]{0,127}")
+
+
+def check_user_id(user_id):
+  if not isinstance(user_id, str) or not USER_ID_PATTERN.fullmatch(user_id):
+    raise ValueError(f"Invalid user id {user_id!r}")
+  return user_id
+
+
+def upload_user_id(key):
+  # The owner of an uploaded object, or None for the shared corpus
+  if not key.startswith(UPLOAD_PREFIX):
+    return None
+  user_id, separator, _ = key[len(UPLOAD_PREFIX):].partition("/")
+  if not separator:
+    return None
+  return check_user_id(user_id)
@@ -0,0 +1,7 @@
+# Token counts used for batching embeddings, trimming chat history and packing context. They only need to be
+# close, so no tokenizer is loaded.
+
+
+def estimate_tokens(text):
+  # ~4 characters per token for English text with cl100k_base, without loading a tokenizer
+  return len(text) // 4 + 1
@@ -0,0 +1,163 @@
+import contextvars
+import functools
+import json
+import logging
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+# Per-invocation timings and counters for the handlers. A handler opens one trace per invocation with
+# `Tracer.invocation()`; inside it, `span(name)` adds the time spent in a stage to the metric `name` and
+# `count(name, value)` adds to a counter, from any module and without passing the trace around. Spans with the
+# same name add up (every DynamoDB call of a request lands in one `dynamodb` metric), and outside an
+# invocation both are no-ops, so background work such as index refreshes isn't attributed to a request.
+#
+# When the invocation ends, one CloudWatch embedded metric format (EMF) record is emitted with the metrics,
+# the duration, the peak RSS and whether this was the container's first (cold) invocation. The record goes to
+# a sink chosen by METRICS_SINK: 'emf' prints it to stdout, where CloudWatch Logs extracts the metrics,
+# 'log' writes it through the logger, 'none' drops it, and tests install a MemorySink to inspect it.
+#
+# The current trace is a context variable: work handed to another thread only reports into it when it is
+# wrapped with `propagate()`.
+
+logger = logging.getLogger()
+
+NAMESPACE = "CompostChatbot"
+
+_current = contextvars.ContextVar("trace", default=None)
+_cold_start = True
+_cold_start_lock = threading.Lock()
+
+
+class StdoutSink:
+  # EMF records have to be a log line of their own; the Lambda logger's prefix would hide them
+  def emit(self, record):
+    print(json.dumps(record), flush=True)
+
+
+class LogSink:
+  def emit(self, record):
+    logger.info(f"Metrics: {json.dumps(record)}")
+
+
+class NullSink:
+  def emit(self, record):
+    pass
+
+
+class MemorySink:
+  def __init__(self):
+    self.records = []
+
+  def emit(self, record):
+    self.records.append(record)
+
+  def metrics(self):
+    # The metric values of every record, in emission order
+    return [{metric["Name"]: record[metric["Name"]] for metric in record["_aws"]["CloudWatchMetrics"][0]["Metrics"]}
+            for record in self.records]
+
+
+def create_sink():
+  sink = os.getenv('METRICS_SINK', 'emf')
+  if sink == 'emf':
+    return StdoutSink()
+  if sink == 'log':
+    return LogSink()
+  if sink == 'none':
+    return NullSink()
+  raise ValueError(f"Unknown METRICS_SINK '{sink}'")
+
+
+class Trace:
+  def __init__(self, cold_start, properties):
+    self.cold_start = cold_start
+    self.properties = properties
+    # name -> [value, CloudWatch unit]
+    self.metrics = {}
+    self._lock = threading.Lock()
+
+  def add(self, name, value, unit="Count"):
+    with self._lock:
+      self.metrics.setdefault(name, [0, unit])[0] += value
+
+
+class Tracer:
+  def __init__(self, service, namespace=NAMESPACE, sink=None):
+    self.service = service
+    self.namespace = namespace
+    self.sink = sink if sink is not None else create_sink()
+
+  @contextmanager
+  def invocation(self, **properties):
+    global _cold_start
+    with _cold_start_lock:
+      cold_start, _cold_start = _cold_start, False
+    trace = Trace(cold_start, properties)
+    token = _current.set(trace)
+    started = time.perf_counter()
+    try:
+      yield trace
+    finally:
+      trace.add("duration", (time.perf_counter() - started) * 1000, "Milliseconds")
+      _current.reset(token)
+      try:
+        self.sink.emit(self.record(trace))
+      except Exception as e:
+        logger.warning(f"Emitting metrics failed: {str(e)}")
+
+  def record(self, trace):
+    trace.add("cold_start", int(trace.cold_start))
+    trace.add("max_rss", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, "Kilobytes")
+    record = {
+      "_aws": {
+        "Timestamp": int(time.time() * 1000),
+        "CloudWatchMetrics": [{
+          "Namespace": self.namespace,
+          "Dimensions": [["Service"], ["Service", "ColdStart"]],
+          "Metrics": [{"Name": name, "Unit": unit} for name, (_, unit) in trace.metrics.items()],
+        }],
+      },
+      "Service": self.service,
+      "ColdStart": "true" if trace.cold_start else "false",
+      **trace.properties,
+    }
+    record.update({name: round(value, 3) for name, (value, _) in trace.metrics.items()})
+    return record
+
+
+@contextmanager
+def span(name):
+  trace = _current.get()
+  started = time.perf_counter()
+  try:
+    yield
+  finally:
+    if trace is not None:
+      trace.add(name, (time.perf_counter() - started) * 1000, "Milliseconds")
+
+
+def count(name, value=1, unit="Count"):
+  trace = _current.get()
+  if trace is not None:
+    trace.add(name, value, unit)
+
+
+def timed(name):
+  # Decorator form of `span`
+  def decorate(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+      with span(name):
+        return function(*args, **kwargs)
+    return wrapper
+  return decorate
+
+
+def propagate(function):
+  # Runs `function` in a copy of the caller's context, so it reports into the caller's trace from another
+  # thread. Wrap each submission separately; one context can't be entered by two threads at once.
+  context = contextvars.copy_context()
+  return lambda *args, **kwargs: context.run(function, *args, **kwargs)
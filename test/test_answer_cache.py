@@ -0,0 +1,87 @@
+import sys
+import os
+import json
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../chat_handler')))
+
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.runnables import RunnableLambda
+from benchmarks.fakes import FakeDynamoDB
+from answer_cache import DynamoDBAnswerCache, LocalAnswerCache, RecentQueryEmbeddings
+from session_history import InMemorySessionBackend, SessionHistoryCache
+
+class TestAnswerCache(unittest.TestCase):
+    def test_near_duplicate_questions_hit(self):
+        cache = LocalAnswerCache(threshold=0.9)
+        cache.put("v1", "what is composting", [1.0, 0.0, 0.1], "Composting is ...")
+        self.assertEqual(cache.lookup("v1", [0.9, 0.05, 0.1]), ("Composting is ...", []))
+        self.assertIsNone(cache.lookup("v1", [0.0, 1.0, 0.0]))
+        self.assertEqual((cache.stats["hits"], cache.stats["misses"]), (1, 1))
+
+    def test_entries_belong_to_an_index_version(self):
+        cache = LocalAnswerCache()
+        cache.put("v1", "can I compost meat", [1.0, 0.0], "Not at home.")
+        self.assertIsNone(cache.lookup("v2", [1.0, 0.0]))
+        self.assertIsNone(cache.lookup("v1", [1.0, 0.0]))
+
+    def test_each_user_keeps_the_entries_of_its_own_index_version(self):
+        cache = LocalAnswerCache()
+        cache.put("shared-v1", "can I compost meat", [1.0, 0.0], "Not at home.")
+        cache.put("org-1-v1", "can I compost meat", [1.0, 0.0], "Only in the digester.", scope="org-1")
+        self.assertEqual(cache.lookup("org-2-v1", [1.0, 0.0], "org-2"), None)
+        self.assertEqual(cache.lookup("org-1-v1", [1.0, 0.0], "org-1"), ("Only in the digester.", []))
+        self.assertEqual(cache.lookup("shared-v1", [1.0, 0.0]), ("Not at home.", []))
+        self.assertIsNone(cache.lookup("org-1-v2", [1.0, 0.0], "org-1"))
+        self.assertEqual(cache.lookup("shared-v1", [1.0, 0.0]), ("Not at home.", []))
+
+    def test_expired_and_least_recently_used_entries_are_evicted(self):
+        cache = LocalAnswerCache(max_entries=2)
+        cache.put("v1", "a", [1.0, 0.0, 0.0], "A")
+        cache.put("v1", "b", [0.0, 1.0, 0.0], "B")
+        cache.lookup("v1", [1.0, 0.0, 0.0])
+        cache.put("v1", "c", [0.0, 0.0, 1.0], "C")
+        self.assertEqual(cache.lookup("v1", [1.0, 0.0, 0.0]), ("A", []))
+        self.assertIsNone(cache.lookup("v1", [0.0, 1.0, 0.0]))
+        expiring = LocalAnswerCache(ttl_seconds=0)
+        expiring.put("v1", "a", [1.0], "A")
+        self.assertIsNone(expiring.lookup("v1", [1.0]))
+
+    def test_dynamodb_backend_shares_answers_between_containers(self):
+        dynamodb = FakeDynamoDB()
+        DynamoDBAnswerCache(dynamodb).put("v1", "is composting legal in Illinois", [0.0, 1.0], "Yes.", ["Illinois Rules"])
+        other = DynamoDBAnswerCache(dynamodb)
+        self.assertEqual(other.lookup("v1", [0.0, 1.0]), ("Yes.", ["Illinois Rules"]))
+        self.assertEqual(other.lookup("v1", [0.0, 1.0]), ("Yes.", ["Illinois Rules"]))
+        self.assertEqual(dynamodb.calls["Query"], 1)
+        other.lookup("org-1-v1", [0.0, 1.0], "org-1")
+        other.lookup("v1", [0.0, 1.0])
+        other.lookup("org-1-v1", [0.0, 1.0], "org-1")
+        self.assertEqual(dynamodb.calls["Query"], 2)
+
+    def test_handler_serves_repeated_first_turns_without_the_chain(self):
+        from chat_handler import lambda_function
+        calls = []
+        def answer(inputs):
+            calls.append(inputs["input"])
+            return {"answer": "Composting turns scraps into soil."}
+        embeddings = RecentQueryEmbeddings(DeterministicFakeEmbedding(size=16))
+        with mock.patch.object(lambda_function, "session_histories", SessionHistoryCache(InMemorySessionBackend())), \
+             mock.patch.object(lambda_function, "answer_cache", LocalAnswerCache()), \
+             mock.patch.object(lambda_function, "_query_embeddings", embeddings), \
+             mock.patch.object(lambda_function.index_cache, "_version", "v1"), \
+             mock.patch.object(lambda_function.index_cache, "get", lambda: RunnableLambda(answer)):
+            def ask(session_id, query="What is composting?"):
+                response = lambda_function.lambda_handler({"body": json.dumps({"query": query, "session_id": session_id})}, None)
+                return json.loads(response["body"])["response"]
+            self.assertEqual(ask("s1"), "Composting turns scraps into soil.")
+            self.assertEqual(ask("s2"), "Composting turns scraps into soil.")
+            self.assertEqual(len(calls), 1)
+            # The cached turn is part of s2's history, so its follow-up isn't a first turn
+            ask("s2")
+            self.assertEqual(len(calls), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,56 +1,141 @@
 import sys
 import os
+import tempfile
 import unittest
 import json
+from unittest import mock
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../chat_handler')))
 
+from langchain_core.documents import Document
+from langchain_community.vectorstores import FAISS
+from benchmarks.fakes import FakeS3, canned_chat_model, hash_embeddings
+from answer_cache import LocalAnswerCache
+from chat_handler import lambda_function
 from chat_handler.lambda_function import lambda_handler
+from index_pool import IndexPool
+from session_history import InMemorySessionBackend, SessionHistoryCache
+from shared.chunk_store import file_names, write_faiss_store
+from shared.index_manifest import index_prefix, manifest_key
+
+ANSWER = "Composting is the controlled breakdown of organic matter into humus."
 
 class TestLambdaHandler(unittest.TestCase):
+    def setUp(self):
+        embeddings = hash_embeddings(size=32)
+        self.embeddings = embeddings
+        directory = tempfile.mkdtemp()
+        documents = [Document(page_content=f"Composting tip {i}.", metadata={"documentId": f"d{i % 3}", "title": f"Guide {i % 3}", "chunk": i // 3}) for i in range(30)]
+        write_faiss_store(directory, "faiss_index", FAISS.from_documents(documents, embeddings))
+        self.directory = directory
+        patches = [
+            mock.patch.dict(os.environ, {"OPENAI_API_KEY": "test"}),
+            mock.patch.object(lambda_function, "_chat_model", canned_chat_model(ANSWER, 0, 0)),
+            mock.patch.object(lambda_function, "_query_embeddings", embeddings),
+            mock.patch.object(lambda_function, "answer_cache", None),
+            mock.patch.object(lambda_function, "session_histories", SessionHistoryCache(InMemorySessionBackend())),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        chain = lambda_function.build_rag_chain(directory, "faiss_index")
+        patch = mock.patch.object(lambda_function.index_cache, "get", lambda: chain)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def ask(self, body):
+        response = lambda_handler({"body": json.dumps(body)}, {})
+        return response['statusCode'], json.loads(response['body'])
+
     def test_lambda_handler(self):
-        event = {
-            "body": json.dumps({"question": "What is composting"})
-        }
-        context = {}
-        response = lambda_handler(event, context)
-        self.assertEqual(response['statusCode'], 200)
-        self.assertIn('body', response)
-        body = json.loads(response['body'])
-        self.assertIn('query', body)
-        self.assertIn('result', body)
-        
-        print("Request:")
-        print(json.dumps(event, indent=2))
-        
-        print("\nResponse:")
-        print(json.dumps(response, indent=2))
-        
-
-        print("\nChatbot Response:")
-        print(body['result'])
-    
+        status, body = self.ask({"query": "What is composting", "session_id": "s1"})
+        self.assertEqual(status, 200)
+        self.assertEqual(body, {'response': ANSWER})
+
     def test_lambda_handler_verbose_question(self):
-        event = {
-            "body": json.dumps({"question": "Is composting legal in Illinois, are there any constraints on volume of compost per household, and are there any other constraints on composting?"})
-        }
-        context = {}
-        response = lambda_handler(event, context)
-        self.assertEqual(response['statusCode'], 200)
-        self.assertIn('body', response)
-        body = json.loads(response['body'])
-        self.assertIn('query', body)
-        self.assertIn('result', body)
-        
-        print("Request:")
-        print(json.dumps(event, indent=2))
-        
-        print("\nResponse:")
-        print(json.dumps(response, indent=2))
-        
-
-        print("\nChatbot Response:")
-        print(body['result'])
+        question = "Is composting legal in Illinois, are there any constraints on volume of compost per household, and are there any other constraints on composting?"
+        status, body = self.ask({"query": question, "session_id": "s2"})
+        self.assertEqual(status, 200)
+        self.assertEqual(body['response'], ANSWER)
+        status, body = self.ask({"query": "And in Chicago?", "session_id": "s2"})
+        self.assertEqual(status, 200)
+        self.assertEqual(len(lambda_function.session_histories.get("s2").messages), 4)
+
+    def test_missing_query_is_rejected(self):
+        status, body = self.ask({"question": "What is composting"})
+        self.assertEqual(status, 400)
+        self.assertEqual(body, {'error': 'No query was provided'})
+
+    def test_invalid_user_id_is_rejected(self):
+        status, body = self.ask({"query": "What is composting", "user_id": "../org-1"})
+        self.assertEqual(status, 400)
+        self.assertEqual(body, {'error': "Invalid user id '../org-1'"})
+
+    def test_session_ids_cannot_reach_into_users_sessions(self):
+        for session_id in ("org-1/s5", "", 5):
+            status, body = self.ask({"query": "What is composting", "session_id": session_id})
+            self.assertEqual((status, body), (400, {'error': f"Invalid session id {session_id!r}"}))
+
+    def test_invalid_filter_is_rejected(self):
+        for filter in (["d1"], {"documentId": 1}, {"title": ["Guide 1", None]}):
+            status, body = self.ask({"query": "What is composting", "filter": filter})
+            self.assertEqual(status, 400)
+            self.assertIn("Invalid filter", body["error"])
+        status, body = self.ask({"query": "What is composting", "session_id": "s7", "filter": {"documentId": ["d1"], "title": "Guide 1"}})
+        self.assertEqual((status, body), (200, {'response': ANSWER}))
+
+    def test_answer_is_cached_under_the_version_that_answered_it(self):
+        cache = lambda_function.index_cache
+        conversational_chain = lambda_function.conversational_chain
+        class RefreshedWhileStreaming:
+            def __init__(self, chain):
+                self.chain = chain
+            def stream(self, *args, **kwargs):
+                cache._version = "v2"
+                return self.chain.stream(*args, **kwargs)
+        with mock.patch.object(lambda_function, "answer_cache", LocalAnswerCache()), \
+             mock.patch.object(cache, "_version", "v1"), \
+             mock.patch.object(lambda_function, "conversational_chain", lambda *args: RefreshedWhileStreaming(conversational_chain(*args))):
+            status, body = self.ask({"query": "What is composting", "session_id": "s6"})
+            self.assertEqual(status, 200)
+            vector = self.embeddings.embed_query("What is composting")
+            self.assertEqual(lambda_function.answer_cache.lookup("v1", vector)[0], ANSWER)
+            self.assertIsNone(lambda_function.answer_cache.lookup("v2", vector))
+
+    def test_prewarm_builds_the_conversational_chain(self):
+        lambda_function.prewarm()
+        chain = lambda_function.index_cache.get()
+        cache = lambda_function.index_cache
+        self.assertIs(lambda_function.conversational_chain(cache, chain), lambda_function.conversational_chain(cache, chain))
+        status, body = self.ask({"query": "What is composting", "session_id": "s3"})
+        self.assertEqual(body, {'response': ANSWER})
+
+    def test_prewarm_failure_is_left_to_the_first_request(self):
+        def fail():
+            raise RuntimeError("index unavailable")
+        with mock.patch.object(lambda_function.index_cache, "get", fail):
+            with self.assertLogs(level="WARNING"):
+                lambda_function.prewarm()
+            response = lambda_handler({"body": json.dumps({"query": "What is composting", "session_id": "s4"})}, {})
+        self.assertEqual(response, {'statusCode': 500, 'body': "index unavailable"})
+
+    def test_user_requests_are_answered_from_the_users_index(self):
+        s3 = FakeS3()
+        prefix = index_prefix("org-1")
+        for file_name in file_names("faiss_index"):
+            with open(os.path.join(self.directory, file_name), "rb") as f:
+                s3.put("compost-chatbot-bucket", f"{prefix}v1/{file_name}", f.read())
+        s3.put("compost-chatbot-bucket", manifest_key(prefix), json.dumps({"version": "v1", "prefix": f"{prefix}v1/", "files": file_names("faiss_index")}))
+        with mock.patch("boto3.client", lambda name: s3), \
+             mock.patch.object(lambda_function, "index_pool", IndexPool(lambda_function.create_user_index_cache, max_bytes=1 << 30)):
+            status, body = self.ask({"query": "What is composting", "session_id": "s5", "user_id": "org-1"})
+            self.assertEqual((status, body), (200, {'response': ANSWER}))
+            self.assertEqual(len(lambda_function.session_histories.get("org-1/s5").messages), 2)
+            status, body = self.ask({"query": "What is composting", "session_id": "s5", "user_id": "org-2"})
+            self.assertEqual(status, 404)
+            self.assertEqual(lambda_function.index_pool.stats["resident"], 1)
+            self.assertEqual(lambda_function.index_pool.stats["load_errors"], 1)
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
@@ -0,0 +1,57 @@
+import sys
+import os
+import tempfile
+import unittest
+from langchain_community.embeddings import DeterministicFakeEmbedding
+from langchain_community.vectorstores import FAISS
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+
+from shared.chunk_store import ChunkStore, is_chunk_store, load_chunk_store_faiss, load_faiss_store, write_faiss_store
+
+class TestChunkStore(unittest.TestCase):
+    def setUp(self):
+        self.embeddings = DeterministicFakeEmbedding(size=16)
+        texts = [f"chunk {i}: compost ✓ épluchures" for i in range(40)]
+        metadatas = [{"documentId": f"doc-{i % 4}", "title": f"Guide {i % 4}"} for i in range(40)]
+        self.db = FAISS.from_texts(texts, self.embeddings, metadatas=metadatas)
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        write_faiss_store(self.directory.name, "faiss_index", self.db)
+
+    def test_rows_round_trip(self):
+        self.assertTrue(is_chunk_store(self.directory.name, "faiss_index"))
+        store = ChunkStore(self.directory.name, "faiss_index")
+        self.assertEqual(len(store), 40)
+        self.assertEqual(len(store.document_ids), 4)
+        for row in (0, 17, 39):
+            expected = self.db.docstore.search(self.db.index_to_docstore_id[row])
+            self.assertEqual(store.document(row).page_content, expected.page_content)
+            self.assertEqual(store.metadata(row), expected.metadata)
+            self.assertEqual(store.vector_id(row), self.db.index_to_docstore_id[row])
+
+    def test_chunk_positions_round_trip(self):
+        db = FAISS.from_texts(["first", "second"], self.embeddings, metadatas=[{"documentId": "doc", "title": "Guide", "chunk": 0}, {"documentId": "doc", "title": "Guide", "chunk": 1}])
+        write_faiss_store(self.directory.name, "positions", db)
+        store = ChunkStore(self.directory.name, "positions")
+        self.assertEqual([store.metadata(row)["chunk"] for row in range(2)], [0, 1])
+        self.assertNotIn("chunk", ChunkStore(self.directory.name, "faiss_index").metadata(0))
+        os.remove(os.path.join(self.directory.name, "positions.chunks.npy"))
+        self.assertEqual(ChunkStore(self.directory.name, "positions").metadata(1), {"documentId": "doc", "title": "Guide"})
+
+    def test_reader_matches_pickled_store_results(self):
+        db = load_chunk_store_faiss(self.directory.name, "faiss_index", self.embeddings)
+        query = "chunk 7: compost ✓ épluchures"
+        self.assertEqual(
+            [document.page_content for document in db.max_marginal_relevance_search(query, k=5)],
+            [document.page_content for document in self.db.max_marginal_relevance_search(query, k=5)],
+        )
+
+    def test_writable_store_supports_updates(self):
+        db = load_faiss_store(self.directory.name, "faiss_index", self.embeddings)
+        db.delete([db.index_to_docstore_id[0], db.index_to_docstore_id[1]])
+        db.add_texts(["new chunk"], metadatas=[{"documentId": "doc-9", "title": "New"}])
+        self.assertEqual(db.index.ntotal, 39)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import sys
+import os
+import unittest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../chat_handler')))
+
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from context_packing import ContextPacker, text_overlap
+
+GUIDE = " ".join(f"Sentence {i} explains how layer {i} of browns and greens keeps the compost pile aerated." for i in range(80))
+
+def chunks(document_id, text=GUIDE, positions=True):
+    splitter = RecursiveCharacterTextSplitter(chunk_size=512, chunk_overlap=32)
+    return [Document(page_content=chunk, metadata={"documentId": document_id, "title": document_id, **({"chunk": i} if positions else {})})
+            for i, chunk in enumerate(splitter.split_text(text))]
+
+class TestContextPacking(unittest.TestCase):
+    def test_text_overlap(self):
+        self.assertEqual(text_overlap("the compost pile is warm", "pile is warm today"), len("pile is warm"))
+        self.assertEqual(text_overlap("short", "unrelated text"), 0)
+
+    def test_merges_neighbouring_chunks(self):
+        guide = chunks("guide")
+        for with_positions in (True, False):
+            retrieved = [guide[3], guide[1], guide[2], guide[6]] if with_positions else chunks("guide", positions=False)[1:4]
+            stats = {}
+            packed = ContextPacker(max_tokens=5000, stats=stats).pack(retrieved)
+            self.assertIn(guide[1].page_content + guide[2].page_content[text_overlap(guide[1].page_content, guide[2].page_content):], packed[0].page_content)
+            self.assertEqual(stats["merged"], 2)
+            self.assertLess(stats["tokens_after"], stats["tokens_before"])
+        self.assertEqual(packed[0].metadata, {"documentId": "guide", "title": "guide"})
+        packed = ContextPacker(max_tokens=5000).pack([guide[3], guide[1], guide[2], guide[6]])
+        self.assertEqual([document.metadata["chunks"] for document in packed], [[1, 2, 3], [6]])
+
+    def test_drops_duplicates_and_fits_budget(self):
+        guide, copy = chunks("guide"), chunks("copy")
+        stats = {}
+        packed = ContextPacker(max_tokens=300, stats=stats).pack([guide[0], copy[0], guide[5], guide[9], guide[7]])
+        self.assertEqual(stats["duplicates_dropped"], 1)
+        self.assertEqual([document.metadata["chunks"] for document in packed], [[0], [5]])
+        self.assertEqual(stats["over_budget_dropped"], 2)
+        self.assertLessEqual(stats["tokens_after"], 300)
+
+    def test_cuts_passage_larger_than_budget(self):
+        packed = ContextPacker(max_tokens=50).pack(chunks("guide")[:3])
+        self.assertEqual(len(packed), 1)
+        self.assertEqual(len(packed[0].page_content), 200)
+
+if __name__ == '__main__':
+    unittest.main()
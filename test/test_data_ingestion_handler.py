@@ -0,0 +1,199 @@
+import sys
+import os
+import json
+import threading
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../data_ingestion_handler')))
+
+from benchmarks.fakes import FakeDynamoDBResource, FakeS3, make_image_pdf, make_pdf
+from data_ingestion_handler import lambda_function
+from deduplication import text_fingerprint
+from pdf_extraction import extract_text, page_ranges
+from shared.tracing import MemorySink
+
+BUCKET = "uploads"
+
+def s3_event(*keys):
+    return {"Records": [{"s3": {"bucket": {"name": BUCKET}, "object": {"key": key}}} for key in keys]}
+
+class TestDataIngestionHandler(unittest.TestCase):
+    def setUp(self):
+        self.s3 = FakeS3()
+        self.dynamodb = FakeDynamoDBResource()
+        patches = [
+            mock.patch.object(lambda_function.boto3, "client", lambda name: self.s3),
+            mock.patch.object(lambda_function.boto3, "resource", lambda name: self.dynamodb),
+            mock.patch.object(lambda_function, "_thread_state", threading.local()),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def documents(self):
+        return list(self.dynamodb.client.tables.get("DocumentMetadata", {}).values())
+
+    def test_small_text_is_stored_inline(self):
+        self.s3.put(BUCKET, "guides/Backyard Composting.pdf", make_pdf(3))
+        response = lambda_function.lambda_handler(s3_event("guides/Backyard Composting.pdf"), {})
+        self.assertEqual(response["statusCode"], 200)
+        document, = self.documents()
+        self.assertEqual(document["title"]["S"], "Backyard Composting")
+        self.assertEqual(document["status"]["S"], "pending")
+        self.assertEqual(document["pages"]["N"], "3")
+        self.assertIn("Page 3. Compost", document["text"]["S"])
+        self.assertNotIn("textKey", document)
+
+    def test_large_text_is_offloaded_to_s3(self):
+        self.s3.put(BUCKET, "manual.pdf", make_pdf(40))
+        with mock.patch.dict(os.environ, {"TEXT_OFFLOAD_BYTES": "1000", "PDF_SOURCE": "mmap", "PDF_EXTRACT_WORKERS": "4"}):
+            response = lambda_function.lambda_handler(s3_event("manual.pdf"), {})
+        self.assertEqual(response["statusCode"], 200)
+        document, = self.documents()
+        self.assertNotIn("text", document)
+        text = self.s3.objects[(BUCKET, document["textKey"]["S"])].decode("utf-8")
+        self.assertEqual(len(text.encode("utf-8")), int(document["textBytes"]["N"]))
+        self.assertLess(text.index("Page 1."), text.index("Page 2."))
+        self.assertLess(text.index("Page 39."), text.index("Page 40."))
+
+    def test_offloaded_text_is_deleted_when_an_update_is_stored_inline(self):
+        with mock.patch.dict(os.environ, {"TEXT_OFFLOAD_BYTES": "1000"}):
+            first = self.ingest("Manual.pdf", make_pdf(40))
+        text_key = f"extracted-text/{first['documentId']}.txt"
+        self.assertIn((BUCKET, text_key), self.s3.objects)
+        second = self.ingest("Manual.pdf", make_pdf(2, "Turn the pile weekly."))
+        self.assertEqual((second["status"], second["documentId"]), ("updated", first["documentId"]))
+        document, = self.documents()
+        self.assertIn("Turn the pile weekly.", document["text"]["S"])
+        self.assertNotIn((BUCKET, text_key), self.s3.objects)
+
+    def test_every_record_in_the_batch_is_processed(self):
+        keys = [f"guides/guide+{i}.pdf" for i in range(6)]
+        for i, key in enumerate(keys):
+            self.s3.put(BUCKET, key.replace("+", " "), make_pdf(2, f"Guide {i} on composting."))
+        with mock.patch.dict(os.environ, {"INGEST_CONCURRENCY": "3"}):
+            response = lambda_function.lambda_handler(s3_event(*keys), {})
+        self.assertEqual(response["statusCode"], 200)
+        self.assertEqual(response["batchItemFailures"], [])
+        self.assertEqual(sorted(document["title"]["S"] for document in self.documents()), [f"guide {i}" for i in range(6)])
+
+    def test_user_uploads_are_deduplicated_per_user(self):
+        for key in ("users/org-1/Worm Bins.pdf", "users/org-2/Worm Bins.pdf", "users/org-2/worm copy.pdf"):
+            self.s3.put(BUCKET, key, make_pdf(2, "Red wigglers like shredded paper."))
+        for key in ("users/org-1/Worm Bins.pdf", "users/org-2/Worm Bins.pdf", "users/org-2/worm copy.pdf"):
+            response = lambda_function.lambda_handler(s3_event(key), {})
+            self.assertEqual(response["statusCode"], 200)
+        results = json.loads(response["body"])["results"]
+        self.assertEqual(results[0]["status"], "duplicate")
+        self.assertEqual(sorted(document["userId"]["S"] for document in self.documents()), ["org-1", "org-2"])
+
+    def test_stages_are_reported_as_metrics(self):
+        self.s3.put(BUCKET, "a.pdf", make_pdf(2, "Leaves and grass."))
+        self.s3.put(BUCKET, "b.pdf", make_pdf(2, "Leaves and grass."))
+        sink = MemorySink()
+        with mock.patch.object(lambda_function.tracer, "sink", sink), mock.patch.dict(os.environ, {"INGEST_CONCURRENCY": "2"}):
+            lambda_function.lambda_handler(s3_event("a.pdf", "b.pdf"), {})
+        metrics, = sink.metrics()
+        for stage in ("s3_download", "hashing", "pdf_extraction", "dynamodb", "duration"):
+            self.assertGreater(metrics[stage], 0)
+        self.assertEqual((metrics["records_stored"], metrics["records_duplicate"], metrics["pages"]), (1, 1, 2))
+
+    def test_failed_records_are_reported_individually(self):
+        self.s3.put(BUCKET, "good.pdf", make_pdf(2))
+        self.s3.put(BUCKET, "broken.pdf", b"not a pdf")
+        event = {"Records": [
+            {"messageId": "m1", "body": json.dumps(s3_event("good.pdf"))},
+            {"messageId": "m2", "body": json.dumps(s3_event("broken.pdf"))},
+            {"messageId": "m3", "body": json.dumps(s3_event("missing.pdf"))},
+        ]}
+        response = lambda_function.lambda_handler(event, {})
+        self.assertEqual(response["statusCode"], 207)
+        self.assertEqual(response["batchItemFailures"], [{"itemIdentifier": "m2"}, {"itemIdentifier": "m3"}])
+        self.assertEqual(len(self.documents()), 1)
+
+    def test_failed_direct_s3_records_raise_for_the_async_retry(self):
+        self.s3.put(BUCKET, "good.pdf", make_pdf(2))
+        with self.assertRaises(lambda_function.IngestionFailed):
+            lambda_function.lambda_handler(s3_event("good.pdf", "missing.pdf"), {})
+        self.assertEqual(len(self.documents()), 1)
+        self.s3.put(BUCKET, "missing.pdf", make_pdf(2, "Now it is here."))
+        response = lambda_function.lambda_handler(s3_event("good.pdf", "missing.pdf"), {})
+        self.assertEqual([result["status"] for result in json.loads(response["body"])["results"]], ["duplicate", "stored"])
+
+    def hashes(self):
+        return {key: item["documentId"]["S"] for key, item in self.dynamodb.client.tables.get("DocumentHashes", {}).items()}
+
+    def ingest(self, key, pdf):
+        self.s3.put(BUCKET, key, pdf)
+        response = lambda_function.lambda_handler(s3_event(key), {})
+        self.assertEqual(response["statusCode"], 200)
+        return json.loads(response["body"])["results"][0]
+
+    def test_identical_pdf_is_skipped_before_extraction(self):
+        pdf = make_pdf(2)
+        stored = self.ingest("a/Leaf Mold.pdf", pdf)
+        with mock.patch.object(lambda_function, "extract_text") as extract:
+            duplicate = self.ingest("b/Leaf Mold Copy.pdf", pdf)
+        extract.assert_not_called()
+        self.assertEqual(duplicate, {"key": "b/Leaf Mold Copy.pdf", "status": "duplicate", "documentId": stored["documentId"]})
+        self.assertEqual(len(self.documents()), 1)
+
+    def test_same_text_in_a_different_pdf_is_a_duplicate(self):
+        stored = self.ingest("Worm Bins.pdf", make_pdf(2, "Red wigglers  eat kitchen scraps."))
+        duplicate = self.ingest("Worm Bins (scan).pdf", make_pdf(2, "RED WIGGLERS eat kitchen\nscraps."))
+        self.assertEqual(duplicate["status"], "duplicate")
+        self.assertEqual(duplicate["documentId"], stored["documentId"])
+        self.assertEqual(len(self.documents()), 1)
+
+    def test_image_only_pdfs_are_not_duplicates_of_each_other(self):
+        pdf = make_image_pdf(2)
+        first = self.ingest("Bin Diagram.pdf", pdf)
+        second = self.ingest("Pile Diagram.pdf", make_image_pdf(2, color=(0.6, 0.3, 0.1)))
+        self.assertEqual([first["status"], second["status"]], ["stored", "stored"])
+        self.assertNotEqual(first["documentId"], second["documentId"])
+        self.assertFalse(any(key.startswith("text#") for key in self.hashes()))
+        self.assertEqual(self.ingest("Bin Diagram (copy).pdf", pdf)["status"], "duplicate")
+
+    def test_new_version_of_a_title_updates_the_document(self):
+        first = self.ingest("Hot Composting.pdf", make_pdf(2, "Turn the pile weekly."))
+        self.dynamodb.client.update_item(
+            TableName="DocumentMetadata", Key={"documentId": {"S": first["documentId"]}},
+            UpdateExpression="SET #s = :indexed", ExpressionAttributeNames={"#s": "status"},
+            ExpressionAttributeValues={":indexed": {"S": "indexed"}})
+        second = self.ingest("Hot Composting.pdf", make_pdf(2, "Turn the pile every three days."))
+        self.assertEqual(second["status"], "updated")
+        self.assertEqual(second["documentId"], first["documentId"])
+        document, = self.documents()
+        self.assertEqual(document["status"]["S"], "pending")
+        self.assertIn("three days", document["text"]["S"])
+        # Only the current version's hashes remain, so the old version can be uploaded again as an update
+        hashes = self.hashes()
+        self.assertEqual(sorted(hashes), sorted([f"pdf#{document['pdfHash']['S']}", f"text#{document['textHash']['S']}", "title#Hot Composting"]))
+        self.assertEqual(self.ingest("Hot Composting.pdf", make_pdf(2, "Turn the pile weekly."))["status"], "updated")
+
+    def test_text_fingerprint_ignores_how_pages_were_split(self):
+        source = make_pdf(30)
+        serial, _ = extract_text(source, workers=1)
+        parallel, _ = extract_text(source, workers=3)
+        self.assertEqual(text_fingerprint(parallel), text_fingerprint(serial))
+        self.assertEqual(text_fingerprint([b"Compost h", b"appens"]), text_fingerprint([b"compost  happens\n"]))
+        self.assertNotEqual(text_fingerprint([b"compost happens"]), text_fingerprint([b"compost", b" happens too"]))
+
+    def test_parallel_extraction_matches_serial(self):
+        source = make_pdf(30)
+        serial, pages = extract_text(source, workers=1)
+        parallel, _ = extract_text(source, workers=3)
+        self.assertEqual(pages, 30)
+        self.assertEqual(len(parallel), 3)
+        self.assertEqual(b"".join(parallel), b"".join(serial))
+
+    def test_page_ranges_cover_every_page(self):
+        ranges = list(page_ranges(101, 4))
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], 101)
+        self.assertTrue(all(end == start for (_, end), (start, _) in zip(ranges, ranges[1:])))
+
+if __name__ == '__main__':
+    unittest.main()
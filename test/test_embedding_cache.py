@@ -0,0 +1,64 @@
+import sys
+import os
+import tempfile
+import unittest
+from langchain_community.embeddings import DeterministicFakeEmbedding
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../vector_embeddings_handler')))
+
+from embedding_cache import CachedEmbeddings, DynamoDBEmbeddingCache, LocalEmbeddingCache, cache_key
+
+class CountingEmbeddings(DeterministicFakeEmbedding):
+    calls: list = []
+
+    def embed_documents(self, texts):
+        self.calls.append(list(texts))
+        return super().embed_documents(texts)
+
+class FakeBatchDynamoDB:
+    def __init__(self):
+        self.items = {}
+        self.throttle_next = True
+
+    def batch_get_item(self, RequestItems):
+        (table_name, request), = RequestItems.items()
+        keys = request["Keys"]
+        if self.throttle_next and len(keys) > 1:
+            self.throttle_next = False
+            return {"Responses": {table_name: []}, "UnprocessedKeys": {table_name: {"Keys": keys}}}
+        found = [self.items[key["chunkHash"]["S"]] for key in keys if key["chunkHash"]["S"] in self.items]
+        return {"Responses": {table_name: found}}
+
+    def batch_write_item(self, RequestItems):
+        (table_name, requests), = RequestItems.items()
+        for request in requests:
+            item = request["PutRequest"]["Item"]
+            self.items[item["chunkHash"]["S"]] = item
+        return {}
+
+class TestEmbeddingCache(unittest.TestCase):
+    def check_cache(self, cache):
+        underlying = CountingEmbeddings(size=8, calls=[])
+        embeddings = CachedEmbeddings(underlying, cache, "text-embedding-3-small")
+        first = embeddings.embed_documents(["compost", "worms", "compost"])
+        self.assertEqual(underlying.calls, [["compost", "worms"]])
+        self.assertEqual(embeddings.stats(), {"hits": 0, "misses": 3, "hit_rate": 0.0})
+
+        second = embeddings.embed_documents(["worms", "leaves", "compost"])
+        self.assertEqual(underlying.calls[-1], ["leaves"])
+        self.assertEqual(embeddings.hits, 2)
+        self.assertEqual(second[0], first[1])
+        self.assertEqual(second[2], first[0])
+
+    def test_local_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.check_cache(LocalEmbeddingCache(directory))
+
+    def test_dynamodb_cache_retries_unprocessed_keys(self):
+        self.check_cache(DynamoDBEmbeddingCache(FakeBatchDynamoDB()))
+
+    def test_key_depends_on_model(self):
+        self.assertNotEqual(cache_key("text-embedding-3-small", "compost"), cache_key("text-embedding-ada-002", "compost"))
+
+if __name__ == '__main__':
+    unittest.main()
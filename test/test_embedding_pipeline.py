@@ -0,0 +1,52 @@
+import sys
+import os
+import time
+import unittest
+import numpy as np
+from langchain.schema import Document
+from langchain_openai import OpenAIEmbeddings
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../vector_embeddings_handler')))
+
+from benchmarks.fakes import FakeEmbeddingsServer, hash_embedding
+from embedding_pipeline import EmbeddingPipeline, token_batches
+
+def make_chunks(count):
+    return [Document(page_content=f"chunk {i} " + "compost " * 60, metadata={"documentId": str(i % 3)}) for i in range(count)]
+
+class TestEmbeddingPipeline(unittest.TestCase):
+    def make_embeddings(self, server):
+        return OpenAIEmbeddings(model="text-embedding-3-small", base_url=server.base_url, api_key="test",
+                                max_retries=0, check_embedding_ctx_length=False)
+
+    def test_batches_are_bounded_by_tokens(self):
+        chunks = make_chunks(20)
+        batches = list(token_batches(chunks, max_tokens=500))
+        self.assertEqual(sum(len(batch) for batch in batches), 20)
+        self.assertTrue(all(sum(len(chunk.page_content) // 4 + 1 for chunk in batch) <= 500 for batch in batches))
+
+    def test_backs_off_on_rate_limits_and_streams_every_batch(self):
+        chunks = make_chunks(60)
+        received = {}
+        with FakeEmbeddingsServer(size=16, latency=0.02, max_concurrent_requests=2) as server:
+            pipeline = EmbeddingPipeline(self.make_embeddings(server), max_batch_tokens=300, max_concurrency=6, base_delay=0.01)
+            completed = pipeline.run(chunks, lambda batch, vectors: received.update(
+                {chunk.page_content: vector for chunk, vector in zip(batch, vectors)}))
+        self.assertTrue(completed)
+        self.assertGreater(server.rate_limited, 0)
+        self.assertEqual(pipeline.stats["chunks"], 60)
+        self.assertEqual(len(received), 60)
+        for chunk in chunks[:5]:
+            np.testing.assert_allclose(received[chunk.page_content], hash_embedding(chunk.page_content, 16), rtol=1e-6)
+
+    def test_stops_at_deadline(self):
+        with FakeEmbeddingsServer(size=16) as server:
+            pipeline = EmbeddingPipeline(self.make_embeddings(server), max_batch_tokens=300)
+            completed = pipeline.run(make_chunks(10), lambda batch, vectors: None, deadline=time.monotonic() - 1)
+        self.assertFalse(completed)
+        self.assertEqual(pipeline.stats["chunks"], 0)
+        self.assertEqual(server.requests, 0)
+
+if __name__ == '__main__':
+    unittest.main()
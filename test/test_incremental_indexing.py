@@ -0,0 +1,254 @@
+import sys
+import os
+import json
+import tempfile
+import unittest
+from unittest import mock
+from langchain_community.embeddings import DeterministicFakeEmbedding
+from langchain_community.vectorstores import FAISS
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../vector_embeddings_handler')))
+
+from benchmarks.fakes import FakeDynamoDB, FakeS3
+from shared.chunk_store import load_chunk_store_faiss
+from shared.index_manifest import MANIFEST_KEY
+from vector_embeddings_handler import lambda_function
+
+def make_document(documentId, text, status="pending"):
+    return {"documentId": {"S": documentId}, "title": {"S": documentId}, "text": {"S": text}, "status": {"S": status}}
+
+class TestIncrementalIndexing(unittest.TestCase):
+    def setUp(self):
+        self.s3 = FakeS3()
+        self.dynamodb = FakeDynamoDB()
+        self.env = mock.patch.dict(os.environ, {
+            "AWS_LAMBDA_FUNCTION_MEMORY_SIZE": "512",
+            "AWS_LAMBDA_LOG_GROUP_NAME": "test",
+            "OPENAI_API_KEY": "test",
+            "EMBEDDING_CACHE": "none",
+        })
+        self.env.start()
+        self.addCleanup(self.env.stop)
+        embeddings = mock.patch.object(lambda_function, "OpenAIEmbeddings", lambda **kwargs: DeterministicFakeEmbedding(size=16))
+        embeddings.start()
+        self.addCleanup(embeddings.stop)
+
+    def upload(self, *documents):
+        for document in documents:
+            self.dynamodb.put_item(TableName="DocumentMetadata", Item=document)
+
+    def status(self, documentId):
+        return self.dynamodb.tables["DocumentMetadata"][documentId]["status"]["S"]
+
+    def vectors(self, documentId):
+        return list(self.dynamodb.tables["VectorMetadata"][documentId]["vectors"]["SS"])
+
+    def run_handler(self, event=None, context=None):
+        clients = {"s3": self.s3, "dynamodb": self.dynamodb}
+        with mock.patch.object(lambda_function.boto3, "client", lambda name: clients[name]):
+            return lambda_function.lambda_handler(event or {}, context or {})
+
+    def test_appends_to_published_index(self):
+        self.upload(make_document("a", "compost " * 200))
+        first = self.run_handler()
+        self.assertEqual(first["statusCode"], 200)
+        self.assertEqual(self.status("a"), "indexed")
+
+        self.upload(make_document("b", "worms " * 100))
+        second = self.run_handler()
+        self.assertEqual(second["statusCode"], 200)
+        self.assertEqual(second["body"]["documents_processed"], 1)
+        self.assertEqual(second["body"]["vectors_removed"], 0)
+        self.assertEqual(second["body"]["index_size"], first["body"]["index_size"] + second["body"]["vectors_stored"])
+
+    def test_indexed_documents_are_not_reprocessed(self):
+        self.upload(make_document("a", "compost " * 200))
+        self.run_handler()
+        self.assertEqual(self.run_handler()["body"], "No pending documents found.")
+
+    def test_updated_document_replaces_stale_vectors(self):
+        self.upload(make_document("a", "compost " * 200), make_document("b", "worms " * 100))
+        first = self.run_handler()
+        stale_vectors = self.vectors("a")
+
+        self.upload(make_document("a", "leaves " * 50))
+        second = self.run_handler()
+        self.assertEqual(second["statusCode"], 200)
+        self.assertEqual(second["body"]["vectors_removed"], len(stale_vectors))
+        self.assertEqual(second["body"]["index_size"], first["body"]["index_size"] - len(stale_vectors) + second["body"]["vectors_stored"])
+        self.assertFalse(set(stale_vectors) & set(self.vectors("a")))
+
+    def test_rebuild_mode_ignores_published_index(self):
+        self.upload(make_document("a", "compost " * 200))
+        first = self.run_handler()
+        self.upload(make_document("b", "worms " * 100))
+        response = self.run_handler({"mode": "rebuild"})
+        self.assertEqual(response["body"]["documents_processed"], 2)
+        self.assertEqual(response["body"]["index_size"], response["body"]["vectors_stored"])
+        self.assertEqual(response["body"]["vectors_stored"], first["body"]["vectors_stored"] + 2)
+
+    def test_streams_every_page_of_pending_documents(self):
+        self.upload(*[make_document(str(i), f"document {i} " + "compost " * 100) for i in range(7)])
+        with mock.patch.dict(os.environ, {"INDEX_PAGE_SIZE": "3"}):
+            response = self.run_handler()
+        self.assertEqual(response["body"]["documents_processed"], 7)
+        self.assertEqual([page["documents"] for page in response["body"]["pages"]], [3, 3, 1])
+        self.assertEqual(sorted(self.dynamodb.tables["VectorMetadata"]), [str(i) for i in range(7)])
+
+    def test_documents_claimed_by_another_run_are_skipped(self):
+        self.upload(make_document("a", "compost " * 200), make_document("b", "worms " * 100))
+        self.dynamodb.update_item(TableName="DocumentMetadata", Key={"documentId": {"S": "b"}},
+            UpdateExpression="SET #s = :indexing, claimedBy = :run, claimedAt = :now",
+            ExpressionAttributeNames={"#s": "status"},
+            ExpressionAttributeValues={":indexing": {"S": "indexing"}, ":run": {"S": "other"}, ":now": {"N": "9999999999"}})
+        response = self.run_handler()
+        self.assertEqual(response["body"]["documents_processed"], 1)
+        self.assertEqual(self.status("b"), "indexing")
+        self.assertNotIn("b", self.dynamodb.tables["VectorMetadata"])
+
+    def test_only_expired_claims_are_queried_again(self):
+        self.upload(*[make_document(str(i), f"compost {i} " * 100) for i in range(5)])
+        self.upload(make_document("crashed", "worms " * 100, status="indexing"))
+        self.dynamodb.update_item(TableName="DocumentMetadata", Key={"documentId": {"S": "crashed"}},
+            UpdateExpression="SET claimedBy = :run, claimedAt = :then",
+            ExpressionAttributeValues={":run": {"S": "crashed"}, ":then": {"N": "1"}})
+        calls = self.dynamodb.calls.get("UpdateItem", 0)
+        response = self.run_handler()
+        self.assertEqual(response["body"]["documents_processed"], 6)
+        self.assertEqual(self.dynamodb.calls["UpdateItem"] - calls, 6)
+        self.assertEqual(self.status("crashed"), "indexed")
+
+    def test_nothing_claimed_publishes_nothing(self):
+        nothing = {"statusCode": 200, "body": "Nothing to index: the pending documents are claimed by other runs."}
+        self.upload(make_document("a", "compost " * 200))
+        with mock.patch.object(lambda_function.VectorMetadataStore, "claim", lambda store, ids, statuses: []):
+            self.assertEqual(self.run_handler(), nothing)
+        self.run_handler()
+        published = dict(self.s3.objects)
+        self.upload(make_document("b", "worms " * 100))
+        with mock.patch.object(lambda_function.VectorMetadataStore, "claim", lambda store, ids, statuses: []):
+            self.assertEqual(self.run_handler(), nothing)
+        self.assertEqual(self.s3.objects, published)
+
+    def test_failed_run_releases_its_claims(self):
+        self.upload(*[make_document(str(i), f"compost {i} " * 100) for i in range(4)])
+        with mock.patch.dict(os.environ, {"INDEX_PAGE_SIZE": "2"}), \
+                mock.patch.object(lambda_function.IndexPublisher, "publish", side_effect=RuntimeError("S3 is down")):
+            response = self.run_handler()
+        self.assertEqual(response, {"statusCode": 500, "body": "S3 is down"})
+        self.assertEqual([self.status(str(i)) for i in range(4)], ["pending"] * 4)
+        self.assertEqual(self.run_handler()["body"]["documents_processed"], 4)
+
+    def test_page_interrupted_by_deadline_is_rolled_back(self):
+        self.upload(make_document("a", "compost " * 200))
+        self.run_handler()
+        published = dict(self.s3.objects)
+        self.upload(make_document("b", "worms " * 100))
+        response = self.run_handler(context=mock.Mock(get_remaining_time_in_millis=lambda: 0))
+        self.assertEqual(response["body"]["status"], "incomplete")
+        self.assertEqual(self.s3.objects, published)
+        self.assertEqual(self.status("b"), "pending")
+        self.assertNotIn("b", self.dynamodb.tables["VectorMetadata"])
+
+    def test_rebuild_interrupted_by_deadline_publishes_nothing(self):
+        self.upload(*[make_document(str(i), f"compost {i} " * 100) for i in range(6)])
+        self.run_handler()
+        published = dict(self.s3.objects)
+        original_run = lambda_function.EmbeddingPipeline.run
+        calls = []
+        def stop_on_second_page(pipeline, *args, **kwargs):
+            calls.append(1)
+            return original_run(pipeline, *args, **kwargs) if len(calls) < 2 else False
+        with mock.patch.dict(os.environ, {"INDEX_PAGE_SIZE": "2"}), \
+             mock.patch.object(lambda_function.EmbeddingPipeline, "run", stop_on_second_page):
+            response = self.run_handler({"mode": "rebuild"})
+        self.assertEqual(response["body"]["status"], "incomplete")
+        self.assertEqual(self.s3.objects, published)
+        # The claimed documents are still in the published index, so they stay indexed
+        self.assertEqual([self.status(str(i)) for i in range(6)], ["indexed"] * 6)
+        self.assertNotIn("claimedBy", self.dynamodb.tables["DocumentMetadata"]["0"])
+
+    def test_publishes_versions_behind_the_manifest(self):
+        self.upload(make_document("a", "compost " * 200))
+        first = self.run_handler()["body"]["index_version"]
+        self.upload(make_document("b", "worms " * 100))
+        second = self.run_handler()["body"]["index_version"]
+        manifest = json.loads(self.s3.objects[("compost-chatbot-bucket", MANIFEST_KEY)])
+        self.assertEqual(manifest["version"], second)
+        self.assertEqual(manifest["history"], [second, first])
+        self.assertIn(("compost-chatbot-bucket", f"indices/{second}/faiss_index.faiss"), self.s3.objects)
+        self.assertEqual(manifest["format"], "chunkstore-v1")
+        self.assertEqual(self.s3.calls["PutObject"], 2 * (len(manifest["files"]) + 1))
+
+    def test_old_versions_are_deleted(self):
+        versions = []
+        with mock.patch.dict(os.environ, {"INDEX_VERSIONS_TO_KEEP": "2"}):
+            for i in range(3):
+                self.upload(make_document(str(i), "compost " * 100))
+                versions.append(self.run_handler()["body"]["index_version"])
+        self.assertNotIn(("compost-chatbot-bucket", f"indices/{versions[0]}/faiss_index.texts"), self.s3.objects)
+        self.assertIn(("compost-chatbot-bucket", f"indices/{versions[1]}/faiss_index.texts"), self.s3.objects)
+
+    def test_old_versions_are_deleted_with_all_their_files(self):
+        with mock.patch.dict(os.environ, {"INDEX_VERSIONS_TO_KEEP": "1", "INDEX_TYPE": "ivf_flat", "INDEX_MIN_APPROXIMATE_VECTORS": "1"}):
+            self.upload(make_document("a", "compost " * 400))
+            first = self.run_handler()["body"]["index_version"]
+        self.assertIn(("compost-chatbot-bucket", f"indices/{first}/faiss_index.flat.faiss"), self.s3.objects)
+        with mock.patch.dict(os.environ, {"INDEX_VERSIONS_TO_KEEP": "1"}):
+            self.upload(make_document("b", "worms " * 100))
+            self.run_handler()
+        self.assertEqual([key for _, key in self.s3.objects if key.startswith(f"indices/{first}/")], [])
+
+    def test_concurrent_publication_is_rejected(self):
+        self.upload(make_document("a", "compost " * 200))
+        self.run_handler()
+        self.upload(make_document("b", "worms " * 100))
+        original_publish = lambda_function.IndexPublisher.publish
+        def publish_after_concurrent_run(publisher, *args, **kwargs):
+            self.s3.put("compost-chatbot-bucket", MANIFEST_KEY, json.dumps({"version": "other"}))
+            return original_publish(publisher, *args, **kwargs)
+        with mock.patch.object(lambda_function.IndexPublisher, "publish", publish_after_concurrent_run):
+            response = self.run_handler()
+        self.assertEqual(response["statusCode"], 409)
+        self.assertEqual(self.status("b"), "pending")
+
+    def test_reads_text_offloaded_to_s3(self):
+        self.s3.put("uploads", "extracted-text/a.txt", "compost " * 200)
+        self.upload({"documentId": {"S": "a"}, "title": {"S": "a"}, "status": {"S": "pending"},
+                     "textBucket": {"S": "uploads"}, "textKey": {"S": "extracted-text/a.txt"}})
+        response = self.run_handler()
+        self.assertEqual(response["body"]["documents_processed"], 1)
+        self.assertGreater(response["body"]["vectors_stored"], 1)
+
+    def test_approximate_index_is_served_and_flat_index_kept_for_updates(self):
+        with mock.patch.dict(os.environ, {"INDEX_TYPE": "ivf_sq8", "INDEX_MIN_APPROXIMATE_VECTORS": "1"}):
+            self.upload(make_document("a", "compost " * 400), make_document("b", "worms " * 400))
+            first = self.run_handler()["body"]
+            self.upload(make_document("a", "leaves " * 100))
+            second = self.run_handler()["body"]
+        self.assertEqual(first["index_type"], "IndexIVFScalarQuantizer")
+        self.assertEqual(second["index_size"], first["index_size"] - second["vectors_removed"] + second["vectors_stored"])
+        manifest = json.loads(self.s3.objects[("compost-chatbot-bucket", MANIFEST_KEY)])
+        self.assertEqual(manifest["builder_files"], ["faiss_index.flat.faiss"])
+        self.assertNotIn("faiss_index.flat.faiss", manifest["files"])
+        with tempfile.TemporaryDirectory() as directory:
+            for file_name in manifest["files"]:
+                self.s3.download_file("compost-chatbot-bucket", f"{manifest['prefix']}{file_name}", f"{directory}/{file_name}")
+            db = load_chunk_store_faiss(directory, "faiss_index", DeterministicFakeEmbedding(size=16))
+            self.assertEqual(db.index.ntotal, second["index_size"])
+            chunk = db.docstore.search(db.index.ntotal - 1)
+            self.assertEqual(db.similarity_search(chunk.page_content, k=1)[0], chunk)
+
+    def test_updates_index_published_in_legacy_pickle_format(self):
+        db = FAISS.from_texts(["legacy " * 50], DeterministicFakeEmbedding(size=16), metadatas=[{"documentId": "old", "title": "old"}])
+        with tempfile.TemporaryDirectory() as directory:
+            db.save_local(folder_path=directory, index_name="faiss_index")
+            for suffix in (".faiss", ".pkl"):
+                self.s3.upload_file(f"{directory}/faiss_index{suffix}", "compost-chatbot-bucket", f"indices/faiss_index{suffix}")
+        self.upload(make_document("a", "compost " * 200))
+        response = self.run_handler()
+        self.assertEqual(response["body"]["index_size"], 1 + response["body"]["vectors_stored"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import sys
+import os
+import json
+import time
+import unittest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../chat_handler')))
+
+from benchmarks.fakes import FakeS3
+from index_cache import IndexCache
+from shared.index_manifest import MANIFEST_KEY
+
+BUCKET = "bucket"
+
+class TestIndexCache(unittest.TestCase):
+    def make_cache(self, s3, refresh_interval=60):
+        self.builds = 0
+        def build(file_path, base_file_name):
+            self.builds += 1
+            return self.builds
+        return IndexCache(BUCKET, "indices/", "faiss_index", build, refresh_interval=refresh_interval, local_dir="/tmp/index_cache_test/", s3_client=s3)
+
+    def publish(self, s3, version):
+        for file_name in ("faiss_index.faiss", "faiss_index.pkl"):
+            s3.put(BUCKET, f"indices/{version}/{file_name}", version)
+        s3.put(BUCKET, MANIFEST_KEY, json.dumps({"version": version, "prefix": f"indices/{version}/", "files": ["faiss_index.faiss", "faiss_index.pkl"]}))
+
+    def wait_for_refresh(self, cache):
+        deadline = time.monotonic() + 5
+        while cache._refreshing and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_warm_requests_reuse_loaded_index(self):
+        s3 = FakeS3()
+        self.publish(s3, "v1")
+        cache = self.make_cache(s3)
+        self.assertEqual(cache.get(), 1)
+        self.assertEqual(cache.get(), 1)
+        self.assertEqual(cache.get(), 1)
+        self.assertEqual(s3.calls["GetObject"], 3)
+        self.assertEqual(cache.stats["loads"], 1)
+        self.assertEqual(cache.stats["hits"], 2)
+        self.assertEqual(cache.version, "v1")
+
+    def test_new_manifest_version_swaps_in_background(self):
+        s3 = FakeS3()
+        self.publish(s3, "v1")
+        cache = self.make_cache(s3, refresh_interval=0)
+        self.assertEqual(cache.get(), 1)
+        self.publish(s3, "v2")
+        self.assertEqual(cache.get(), 1)
+        self.wait_for_refresh(cache)
+        self.assertEqual(cache.get(), 2)
+        self.wait_for_refresh(cache)
+        self.assertEqual(cache.stats["swaps"], 1)
+        self.assertEqual(cache.version, "v2")
+
+    def test_unchanged_manifest_does_not_reload(self):
+        s3 = FakeS3()
+        self.publish(s3, "v1")
+        cache = self.make_cache(s3, refresh_interval=0)
+        cache.get()
+        cache.get()
+        self.wait_for_refresh(cache)
+        self.assertEqual(cache.stats["checks"], 1)
+        self.assertEqual(cache.stats["loads"], 1)
+
+    def test_falls_back_to_unversioned_index(self):
+        s3 = FakeS3()
+        s3.put(BUCKET, "indices/faiss_index.faiss", "a")
+        s3.put(BUCKET, "indices/faiss_index.pkl", "b")
+        cache = self.make_cache(s3)
+        self.assertEqual(cache.get(), 1)
+        self.assertEqual(len(cache.version.split(":")), 2)
+
+if __name__ == '__main__':
+    unittest.main()
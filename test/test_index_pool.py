@@ -0,0 +1,93 @@
+import sys
+import os
+import json
+import shutil
+import unittest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../chat_handler')))
+
+from benchmarks.fakes import FakeS3
+from index_cache import IndexCache, IndexNotPublished
+from index_pool import IndexPool
+from shared.index_manifest import index_prefix, manifest_key
+
+BUCKET = "bucket"
+LOCAL_DIR = "/tmp/index_pool_test/"
+
+class TestIndexPool(unittest.TestCase):
+    def setUp(self):
+        self.s3 = FakeS3()
+        self.builds = []
+        self.addCleanup(shutil.rmtree, LOCAL_DIR, True)
+
+    def create_cache(self, user_id):
+        def build(file_path, base_file_name):
+            self.builds.append(user_id)
+            return f"chain of {user_id}"
+        return IndexCache(BUCKET, index_prefix(user_id), "faiss_index", build, local_dir=f"{LOCAL_DIR}{user_id}/",
+                          s3_client=self.s3, legacy_fallback=False)
+
+    def publish(self, user_id, size):
+        prefix = index_prefix(user_id)
+        self.s3.put(BUCKET, f"{prefix}v1/faiss_index.faiss", b"x" * size)
+        self.s3.put(BUCKET, manifest_key(prefix), json.dumps({"version": "v1", "prefix": f"{prefix}v1/", "files": ["faiss_index.faiss"]}))
+
+    def test_indexes_are_loaded_on_first_use_and_kept(self):
+        self.publish("org-1", 100)
+        pool = IndexPool(self.create_cache, max_bytes=1000)
+        self.assertEqual(self.builds, [])
+        cache, chain = pool.get("org-1")
+        self.assertEqual(chain, "chain of org-1")
+        self.assertIs(pool.get("org-1")[0], cache)
+        self.assertEqual(self.builds, ["org-1"])
+        self.assertEqual(pool.stats, {"hits": 1, "loads": 1, "load_errors": 0, "evictions": 0, "resident": 1, "resident_bytes": 100})
+
+    def test_least_recently_used_index_is_evicted_over_the_cap(self):
+        for user_id in ("org-1", "org-2", "org-3"):
+            self.publish(user_id, 400)
+        pool = IndexPool(self.create_cache, max_bytes=1000)
+        evicted, _ = pool.get("org-1")
+        pool.get("org-2")
+        pool.get("org-1")
+        evicted, _ = pool.get("org-2")
+        pool.get("org-1")
+        pool.get("org-3")
+        self.assertIsNone(evicted.version)
+        self.assertFalse(os.path.exists(f"{LOCAL_DIR}org-2/v1/"))
+        self.assertEqual((pool.stats["evictions"], pool.stats["resident_bytes"]), (1, 800))
+        pool.get("org-2")
+        self.assertEqual(self.builds, ["org-1", "org-2", "org-3", "org-2"])
+
+    def test_indexes_are_evicted_when_the_disk_runs_low(self):
+        for user_id in ("org-1", "org-2", "org-3"):
+            self.publish(user_id, 100)
+        pool = IndexPool(self.create_cache, max_bytes=1000, min_free_bytes=1 << 60, disk_path=LOCAL_DIR)
+        for user_id in ("org-1", "org-2", "org-3"):
+            pool.get(user_id)
+        self.assertEqual((pool.stats["evictions"], pool.stats["resident"]), (2, 1))
+        self.assertEqual(pool.get("org-3")[1], "chain of org-3")
+
+    def test_index_larger_than_the_cap_is_still_served(self):
+        self.publish("org-1", 2000)
+        pool = IndexPool(self.create_cache, max_bytes=1000)
+        self.assertEqual(pool.get("org-1")[1], "chain of org-1")
+        self.assertEqual(pool.stats["resident"], 1)
+
+    def test_user_without_an_index_is_not_kept(self):
+        pool = IndexPool(self.create_cache, max_bytes=1000)
+        with self.assertRaises(IndexNotPublished):
+            pool.get("org-1")
+        self.publish("org-1", 100)
+        self.assertEqual(pool.get("org-1")[1], "chain of org-1")
+        self.assertEqual((pool.stats["load_errors"], pool.stats["loads"]), (1, 1))
+
+    def test_invalid_user_ids_are_rejected(self):
+        pool = IndexPool(self.create_cache, max_bytes=1000)
+        for user_id in ("../org-1", "org/1", ""):
+            with self.assertRaises(ValueError):
+                pool.get(user_id)
+        self.assertEqual(pool.stats["resident"], 0)
+
+if __name__ == '__main__':
+    unittest.main()
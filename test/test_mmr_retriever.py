@@ -0,0 +1,64 @@
+import sys
+import os
+import tempfile
+import unittest
+import faiss
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../chat_handler')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../vector_embeddings_handler')))
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_community.vectorstores import FAISS
+from index_types import build_index
+from mmr_retriever import MMRRetriever
+from shared.chunk_store import load_chunk_store_faiss, write_faiss_store
+
+def documents(count):
+    return [Document(page_content=f"chunk {i}", metadata={"documentId": f"d{i % 5}", "title": f"Guide {i % 5}"}) for i in range(count)]
+
+class TestMMRRetriever(unittest.TestCase):
+    def setUp(self):
+        self.embeddings = DeterministicFakeEmbedding(size=32)
+        self.db = FAISS.from_documents(documents(300), self.embeddings)
+        directory = tempfile.mkdtemp()
+        write_faiss_store(directory, "faiss_index", self.db)
+        self.chunk_db = load_chunk_store_faiss(directory, "faiss_index", self.embeddings)
+
+    def test_matches_langchain_mmr(self):
+        for query in ("how wet should compost be", "can I compost meat", "worm bins"):
+            expected = self.db.max_marginal_relevance_search(query, k=8, fetch_k=40, lambda_mult=0.3)
+            for db in (self.db, self.chunk_db):
+                found = MMRRetriever(db=db, k=8, fetch_k=40, lambda_mult=0.3).invoke(query)
+                self.assertEqual([document.page_content for document in found], [document.page_content for document in expected])
+
+    def test_filter_by_document_and_title(self):
+        for db in (self.db, self.chunk_db):
+            found = MMRRetriever(db=db, k=5, fetch_k=20, filter={"documentId": ["d1", "d3"]}).invoke("compost")
+            self.assertEqual(len(found), 5)
+            self.assertTrue(all(document.metadata["documentId"] in ("d1", "d3") for document in found))
+            found = MMRRetriever(db=db, k=5).filtered({"title": "Guide 4"}).invoke("compost")
+            self.assertTrue(found and all(document.metadata["title"] == "Guide 4" for document in found))
+
+    def test_filter_on_approximate_indexes(self):
+        indexes = {index_type: build_index(self.chunk_db.index, index_type, nlist=8, nprobe=8, min_vectors=1)
+                   for index_type in ("ivf_flat", "ivf_sq8", "hnsw")}
+        # 4-bit PQ codes, since training 8-bit codes on a few hundred vectors takes seconds
+        indexes["ivf_pq"] = faiss.index_factory(32, "IVF8,PQ4x4")
+        vectors = self.chunk_db.index.reconstruct_n(0, self.chunk_db.index.ntotal)
+        indexes["ivf_pq"].train(vectors)
+        indexes["ivf_pq"].add(vectors)
+        indexes["ivf_pq"].make_direct_map()
+        for index_type, index in indexes.items():
+            db = FAISS(self.embeddings, index, self.chunk_db.docstore, self.chunk_db.index_to_docstore_id)
+            found = MMRRetriever(db=db, k=5, fetch_k=20).filtered({"documentId": ["d1", "d3"]}).invoke("compost")
+            self.assertEqual(len(found), 5, index_type)
+            self.assertTrue(all(document.metadata["documentId"] in ("d1", "d3") for document in found))
+
+    def test_score_threshold_drops_weak_candidates(self):
+        self.assertEqual(MMRRetriever(db=self.chunk_db, score_threshold=0.99).invoke("unrelated question"), [])
+        self.assertEqual(len(MMRRetriever(db=self.chunk_db, score_threshold=-1.0).invoke("unrelated question")), 8)
+
+if __name__ == '__main__':
+    unittest.main()
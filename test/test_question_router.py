@@ -0,0 +1,71 @@
+import sys
+import os
+import time
+import unittest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../chat_handler')))
+
+from langchain_core.documents import Document
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.runnables import RunnableLambda
+from question_router import QuestionRouter, is_self_contained
+
+HISTORY = [HumanMessage(content="How do I start a worm bin?"), AIMessage(content="Use shredded cardboard and red wigglers.")]
+
+class TestQuestionRouter(unittest.TestCase):
+    def make_router(self, mode, rewritten=None, delay=0.0):
+        self.rewrites = []
+        self.retrievals = []
+        def rewrite(inputs):
+            self.rewrites.append(inputs["input"])
+            time.sleep(delay)
+            return rewritten or inputs["input"]
+        def retrieve(question):
+            self.retrievals.append(question)
+            time.sleep(delay)
+            return [Document(page_content=question)]
+        return QuestionRouter(RunnableLambda(rewrite), RunnableLambda(retrieve), mode=mode)
+
+    def test_self_contained_heuristic(self):
+        self.assertTrue(is_self_contained("How long does hot composting take?"))
+        self.assertTrue(is_self_contained("Can I compost citrus peels in a worm bin?"))
+        self.assertFalse(is_self_contained("How often should I feed them?"))
+        self.assertFalse(is_self_contained("What about eggshells?"))
+        self.assertFalse(is_self_contained("Why?"))
+
+    def test_first_turns_and_self_contained_questions_skip_the_rewrite(self):
+        router = self.make_router("adaptive")
+        router.retrieve({"input": "How often should I feed them?", "chat_history": []})
+        router.retrieve({"input": "Can I compost citrus peels at home?", "chat_history": HISTORY})
+        self.assertEqual(self.rewrites, [])
+        self.assertEqual(router.stats, {"no_history": 1, "self_contained": 1})
+
+    def test_follow_ups_are_rewritten(self):
+        router = self.make_router("adaptive", rewritten="How often should I feed red wigglers?")
+        documents = router.retrieve({"input": "How often should I feed them?", "chat_history": HISTORY})
+        self.assertEqual(documents[0].page_content, "How often should I feed red wigglers?")
+        self.assertEqual(router.stats, {"rewrite": 1})
+
+    def test_always_mode_rewrites_every_follow_up_turn(self):
+        router = self.make_router("always")
+        router.retrieve({"input": "Can I compost citrus peels at home?", "chat_history": HISTORY})
+        self.assertEqual(len(self.rewrites), 1)
+
+    def test_speculative_retrieval_is_used_when_the_question_is_unchanged(self):
+        router = self.make_router("speculative", delay=0.2)
+        started = time.monotonic()
+        documents = router.retrieve({"input": "What about them?", "chat_history": HISTORY})
+        self.assertLess(time.monotonic() - started, 0.35)
+        self.assertEqual(documents[0].page_content, "What about them?")
+        self.assertEqual(self.retrievals, ["What about them?"])
+        self.assertEqual(router.stats, {"speculative_hit": 1})
+
+    def test_speculative_miss_retrieves_the_rewritten_question(self):
+        router = self.make_router("speculative", rewritten="What about red wigglers?")
+        documents = router.retrieve({"input": "What about them?", "chat_history": HISTORY})
+        self.assertEqual(documents[0].page_content, "What about red wigglers?")
+        self.assertEqual(router.stats, {"speculative_miss": 1})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import sys
+import os
+import json
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../chat_handler')))
+
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.runnables import RunnableLambda
+from benchmarks.fakes import FakeDynamoDB
+from session_history import DynamoDBSessionBackend, InMemorySessionBackend, SessionHistoryCache
+
+def turn(question, answer):
+    return [HumanMessage(content=question), AIMessage(content=answer)]
+
+class TestSessionHistory(unittest.TestCase):
+    def test_history_is_persisted_and_reloaded(self):
+        dynamodb = FakeDynamoDB()
+        backend = DynamoDBSessionBackend(dynamodb)
+        SessionHistoryCache(backend).get("s1").add_messages(turn("What are greens?", "Nitrogen-rich scraps."))
+        history = SessionHistoryCache(backend).get("s1")
+        self.assertEqual([message.content for message in history.messages], ["What are greens?", "Nitrogen-rich scraps."])
+        self.assertEqual(dynamodb.tables["ChatSessions"]["s1"]["version"]["N"], "1")
+
+    def test_warm_sessions_are_served_from_the_cache(self):
+        dynamodb = FakeDynamoDB()
+        cache = SessionHistoryCache(DynamoDBSessionBackend(dynamodb), max_sessions=2)
+        cache.get("s1").add_messages(turn("q1", "a1"))
+        cache.get("s1").add_messages(turn("q2", "a2"))
+        self.assertEqual(dynamodb.calls["GetItem"], 1)
+        self.assertEqual(cache.stats["hits"], 1)
+        cache.get("s2")
+        cache.get("s3")
+        self.assertEqual(cache.stats["evictions"], 1)
+        self.assertEqual(len(cache.get("s1").messages), 4)
+        self.assertEqual(cache.stats["misses"], 4)
+
+    def test_concurrent_writers_do_not_lose_turns(self):
+        backend = InMemorySessionBackend()
+        first, second = SessionHistoryCache(backend), SessionHistoryCache(backend)
+        first.get("s1").add_messages(turn("q1", "a1"))
+        stale = second.get("s1")
+        first.get("s1").add_messages(turn("q2", "a2"))
+        stale.add_messages(turn("q3", "a3"))
+        self.assertEqual([message.content for message in SessionHistoryCache(backend).get("s1").messages],
+                         ["q1", "a1", "q2", "a2", "q3", "a3"])
+
+    def test_history_is_trimmed_to_the_token_budget(self):
+        history = SessionHistoryCache(InMemorySessionBackend(), max_tokens=60).get("s1")
+        for i in range(10):
+            history.add_messages(turn(f"question {i} " + "x" * 40, f"answer {i} " + "y" * 40))
+        contents = [message.content for message in history.messages]
+        self.assertEqual(len(contents), 2)
+        self.assertTrue(contents[0].startswith("question 9"))
+
+    def test_dropped_turns_are_summarized(self):
+        summaries = []
+        def summarize(summary, messages):
+            summaries.append((summary, [message.content for message in messages]))
+            return f"{summary}+{len(messages)}"
+        history = SessionHistoryCache(InMemorySessionBackend(), max_tokens=40, summarize=summarize).get("s1")
+        for i in range(3):
+            history.add_messages(turn(f"q{i} " + "x" * 60, f"a{i}"))
+        self.assertEqual(summaries[0][1][0], "q0 " + "x" * 60)
+        self.assertEqual(history.messages[0].type, "system")
+        self.assertIn(history.summary, history.messages[0].content)
+
+class TestChatHandlerHistory(unittest.TestCase):
+    def test_follow_up_turns_see_the_history(self):
+        with mock.patch.dict(os.environ, {"SESSION_HISTORY": "memory"}):
+            from chat_handler import lambda_function
+            histories = SessionHistoryCache(InMemorySessionBackend())
+        chain = RunnableLambda(lambda inputs: {"answer": f"{len(inputs['chat_history'])} earlier messages"})
+        with mock.patch.object(lambda_function, "session_histories", histories), \
+             mock.patch.object(lambda_function, "answer_cache", None), \
+             mock.patch.object(lambda_function.index_cache, "get", lambda: chain):
+            answers = [json.loads(lambda_function.lambda_handler({"body": json.dumps({"query": query, "session_id": "s1"})}, None)["body"])["response"]
+                       for query in ("What is compost?", "How long does it take?")]
+        self.assertEqual(answers, ["0 earlier messages", "2 earlier messages"])
+
+if __name__ == '__main__':
+    unittest.main()
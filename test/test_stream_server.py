@@ -0,0 +1,85 @@
+import sys
+import os
+import json
+import http.client
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../chat_handler')))
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_community.vectorstores import FAISS
+from benchmarks.fakes import canned_chat_model
+from chat_handler import lambda_function
+from answer_cache import RecentQueryEmbeddings
+from session_history import InMemorySessionBackend, SessionHistoryCache
+from shared.chunk_store import write_faiss_store
+from shared.tracing import MemorySink
+from stream_server import make_server
+
+class TestStreamServer(unittest.TestCase):
+    def setUp(self):
+        embeddings = RecentQueryEmbeddings(DeterministicFakeEmbedding(size=16))
+        directory = tempfile.mkdtemp()
+        documents = [Document(page_content=f"tip {i}", metadata={"documentId": f"d{i % 2}", "title": f"Guide {i % 2}"}) for i in range(10)]
+        write_faiss_store(directory, "faiss_index", FAISS.from_documents(documents, embeddings))
+        patches = [
+            mock.patch.dict(os.environ, {"OPENAI_API_KEY": "test"}),
+            mock.patch.object(lambda_function, "_chat_model", canned_chat_model("Keep it moist.", 0, 0)),
+            mock.patch.object(lambda_function, "_query_embeddings", embeddings),
+            mock.patch.object(lambda_function, "answer_cache", None),
+            mock.patch.object(lambda_function, "session_histories", SessionHistoryCache(InMemorySessionBackend())),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        chain = lambda_function.build_rag_chain(directory, "faiss_index")
+        patch = mock.patch.object(lambda_function.index_cache, "get", lambda: chain)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.server = make_server(lambda_function, port=0)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def post(self, path, body):
+        connection = http.client.HTTPConnection("127.0.0.1", self.server.server_address[1])
+        connection.request("POST", path, json.dumps(body))
+        response = connection.getresponse()
+        data = response.read().decode("utf-8")
+        connection.close()
+        return response, data
+
+    def test_stream_sends_sources_then_tokens(self):
+        response, data = self.post("/chat/stream", {"query": "How wet should compost be?", "session_id": "s1"})
+        self.assertEqual(response.getheader("Content-Type"), "text/event-stream")
+        events = [(block.split("\n")[0][len("event: "):], json.loads(block.split("\n")[1][len("data: "):]))
+                  for block in data.strip().split("\n\n")]
+        kinds = [kind for kind, _ in events]
+        self.assertEqual(kinds[0], "sources")
+        self.assertEqual(sorted(events[0][1]), ["Guide 0", "Guide 1"])
+        self.assertEqual(kinds[1:-1], ["token"] * 3)
+        self.assertEqual(events[-1], ("done", {"response": "Keep it moist."}))
+
+    def test_stream_reports_stage_metrics(self):
+        sink = MemorySink()
+        with mock.patch.object(lambda_function.tracer, "sink", sink):
+            self.post("/chat/stream", {"query": "How wet should compost be?", "session_id": "s3"})
+        metrics, = sink.metrics()
+        for stage in ("embedding", "retrieval", "context_packing", "first_token", "llm_generation", "context_tokens", "answer_tokens"):
+            self.assertGreater(metrics[stage], 0, stage)
+        self.assertEqual(sink.records[0]["Endpoint"], "stream")
+
+    def test_json_contract_is_unchanged(self):
+        response, data = self.post("/chat", {"query": "How wet should compost be?", "session_id": "s2"})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(json.loads(data), {"response": "Keep it moist."})
+        response, data = self.post("/chat/stream", {"session_id": "s2"})
+        self.assertEqual(response.status, 400)
+
+if __name__ == '__main__':
+    unittest.main()
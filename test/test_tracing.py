@@ -0,0 +1,59 @@
+import sys
+import os
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+
+from shared import tracing
+from shared.tracing import MemorySink, Tracer, count, propagate, span
+
+class TestTracing(unittest.TestCase):
+    def setUp(self):
+        self.sink = MemorySink()
+        self.tracer = Tracer("test_handler", sink=self.sink)
+
+    def test_spans_and_counts_add_up_per_invocation(self):
+        with self.tracer.invocation(RequestId="r1"):
+            for _ in range(2):
+                with span("dynamodb"):
+                    time.sleep(0.01)
+            count("answer_tokens", 12)
+            count("answer_tokens", 3)
+        metrics, = self.sink.metrics()
+        self.assertGreaterEqual(metrics["dynamodb"], 20)
+        self.assertEqual(metrics["answer_tokens"], 15)
+        self.assertGreaterEqual(metrics["duration"], metrics["dynamodb"])
+        self.assertGreater(metrics["max_rss"], 0)
+        record, = self.sink.records
+        self.assertEqual((record["Service"], record["RequestId"]), ("test_handler", "r1"))
+        units = {metric["Name"]: metric["Unit"] for metric in record["_aws"]["CloudWatchMetrics"][0]["Metrics"]}
+        self.assertEqual((units["dynamodb"], units["answer_tokens"], units["max_rss"]), ("Milliseconds", "Count", "Kilobytes"))
+
+    def test_only_the_first_invocation_is_cold(self):
+        with mock.patch.object(tracing, "_cold_start", True):
+            for _ in range(2):
+                with self.tracer.invocation():
+                    pass
+        self.assertEqual([record["ColdStart"] for record in self.sink.records], ["true", "false"])
+        self.assertEqual([metrics["cold_start"] for metrics in self.sink.metrics()], [1, 0])
+
+    def test_other_threads_report_only_when_propagated(self):
+        def work():
+            with span("extraction"):
+                count("pages")
+        with self.tracer.invocation():
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                for future in [executor.submit(propagate(work)) for _ in range(3)] + [executor.submit(work)]:
+                    future.result()
+        self.assertEqual(self.sink.metrics()[0]["pages"], 3)
+
+    def test_spans_outside_an_invocation_are_ignored(self):
+        with span("retrieval"):
+            count("answer_tokens")
+        self.assertEqual(self.sink.records, [])
+
+if __name__ == '__main__':
+    unittest.main()
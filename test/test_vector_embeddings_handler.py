@@ -1,21 +1,73 @@
 import sys
 import os
 import unittest
-import json
+from unittest import mock
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../vector_embeddings_handler')))
 
+from benchmarks.fakes import FakeDynamoDB, FakeS3, hash_embeddings
+from shared.index_manifest import MANIFEST_KEY, index_prefix, manifest_key
+from vector_embeddings_handler import lambda_function
 from vector_embeddings_handler.lambda_function import lambda_handler
 
 class TestLambdaHandler(unittest.TestCase):
-   def test_lambda_handler_success(self):
-        event = {}
-        context = {}
-        response = lambda_handler(event, context)
-        
+    def setUp(self):
+        self.s3 = FakeS3()
+        self.dynamodb = FakeDynamoDB()
+        clients = {"s3": self.s3, "dynamodb": self.dynamodb}
+        patches = [
+            mock.patch.dict(os.environ, {
+                "AWS_LAMBDA_FUNCTION_MEMORY_SIZE": "512",
+                "AWS_LAMBDA_LOG_GROUP_NAME": "test",
+                "OPENAI_API_KEY": "test",
+            }),
+            mock.patch.object(lambda_function, "OpenAIEmbeddings", lambda **kwargs: hash_embeddings(size=16)),
+            mock.patch.object(lambda_function.boto3, "client", lambda name: clients[name]),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_lambda_handler_success(self):
+        self.dynamodb.put_item(TableName="DocumentMetadata", Item={
+            "documentId": {"S": "guide"}, "title": {"S": "Backyard Composting"},
+            "text": {"S": "Keep the pile as moist as a wrung-out sponge. " * 40}, "status": {"S": "pending"},
+        })
+        response = lambda_handler({}, {})
+
         self.assertEqual(response['statusCode'], 200)
         self.assertIn('body', response)
-        self.assertEqual(response['body'], 'Interaction successful!')
+        self.assertEqual(response['body']['status'], 'success')
+        self.assertEqual(response['body']['documents_processed'], 1)
+        self.assertEqual(response['body']['index_size'], response['body']['vectors_stored'])
+        self.assertIn(("compost-chatbot-bucket", MANIFEST_KEY), self.s3.objects)
+        self.assertEqual(self.dynamodb.tables["DocumentMetadata"]["guide"]["status"]["S"], "indexed")
+
+    def test_user_documents_are_indexed_separately(self):
+        for documentId, user_id in (("shared", None), ("org-1", "org-1"), ("org-2", "org-2")):
+            item = {
+                "documentId": {"S": documentId}, "title": {"S": documentId},
+                "text": {"S": "Turn the pile every week. " * 40}, "status": {"S": "pending"},
+            }
+            if user_id:
+                item["userId"] = {"S": user_id}
+            self.dynamodb.put_item(TableName="DocumentMetadata", Item=item)
+
+        response = lambda_handler({"user_id": "org-1"}, {})
+        self.assertEqual(response['statusCode'], 200)
+        self.assertEqual((response['body']['user_id'], response['body']['documents_processed']), ("org-1", 1))
+        self.assertIn(("compost-chatbot-bucket", manifest_key(index_prefix("org-1"))), self.s3.objects)
+        self.assertNotIn(("compost-chatbot-bucket", MANIFEST_KEY), self.s3.objects)
+
+        response = lambda_handler({}, {})
+        self.assertEqual(response['body']['documents_processed'], 1)
+        statuses = {documentId: item["status"]["S"] for documentId, item in self.dynamodb.tables["DocumentMetadata"].items()}
+        self.assertEqual(statuses, {"shared": "indexed", "org-1": "indexed", "org-2": "pending"})
+
+    def test_nothing_pending(self):
+        response = lambda_handler({}, {})
+        self.assertEqual(response, {'statusCode': 200, 'body': 'No pending documents found.'})
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
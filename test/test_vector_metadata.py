@@ -0,0 +1,50 @@
+import sys
+import os
+import unittest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../vector_embeddings_handler')))
+
+from benchmarks.fakes import FakeDynamoDB
+from vector_metadata import VectorMetadataStore
+
+class TestVectorMetadataStore(unittest.TestCase):
+    def setUp(self):
+        self.dynamodb = FakeDynamoDB()
+        for documentId in ("a", "b", "c"):
+            self.dynamodb.put_item(TableName="DocumentMetadata", Item={"documentId": {"S": documentId}, "status": {"S": "pending"}})
+
+    def status(self, documentId):
+        return self.dynamodb.tables["DocumentMetadata"][documentId]["status"]["S"]
+
+    def test_second_run_cannot_claim_claimed_documents(self):
+        first = VectorMetadataStore(self.dynamodb, "run-1")
+        second = VectorMetadataStore(self.dynamodb, "run-2")
+        self.assertEqual(first.claim(["a", "b"]), ["a", "b"])
+        self.assertEqual(second.claim(["a", "b", "c"]), ["c"])
+        self.assertEqual(second.stats["claim_conflicts"], 2)
+
+    def test_expired_claims_can_be_taken_over(self):
+        VectorMetadataStore(self.dynamodb, "crashed").claim(["a"])
+        self.assertEqual(VectorMetadataStore(self.dynamodb, "run-2", lease_seconds=900).claim(["a"]), [])
+        self.assertEqual(VectorMetadataStore(self.dynamodb, "run-3", lease_seconds=-1).claim(["a"]), ["a"])
+        self.assertEqual(self.dynamodb.tables["DocumentMetadata"]["a"]["claimedBy"]["S"], "run-3")
+
+    def test_reuploaded_document_is_left_pending(self):
+        store = VectorMetadataStore(self.dynamodb, "run-1")
+        store.claim(["a", "b", "c"])
+        self.dynamodb.put_item(TableName="DocumentMetadata", Item={"documentId": {"S": "b"}, "status": {"S": "pending"}})
+        self.assertEqual(store.mark_indexed(["a", "b", "c"]), 2)
+        self.assertEqual([self.status(documentId) for documentId in "abc"], ["indexed", "pending", "indexed"])
+        self.assertEqual(self.dynamodb.calls["TransactWriteItems"], 4)
+
+    def test_vectors_round_trip_in_batches(self):
+        store = VectorMetadataStore(self.dynamodb, "run-1")
+        store.put_vectors({str(i): [f"{i}-0", f"{i}-1"] for i in range(60)})
+        vectors = store.get_vectors([str(i) for i in range(60)] + ["missing"])
+        self.assertEqual(len(vectors), 60)
+        self.assertEqual(sorted(vectors["7"]), ["7-0", "7-1"])
+        self.assertEqual(self.dynamodb.calls["BatchWriteItem"], 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import time
+import logging
+
+# Helpers around DynamoDB's batch APIs. Both calls can return part of the request as unprocessed when the
+# table is throttled; those items are retried with exponential backoff until they go through or
+# `max_attempts` is exhausted.
+
+logger = logging.getLogger()
+
+BATCH_GET_LIMIT = 100
+BATCH_WRITE_LIMIT = 25
+
+
+def chunked(items, size):
+  for start in range(0, len(items), size):
+    yield items[start:start + size]
+
+
+def batch_get_items(dynamodb, table_name, keys, projection=None, max_attempts=8):
+  items = []
+  for batch in chunked(keys, BATCH_GET_LIMIT):
+    request = {table_name: {'Keys': batch}}
+    if projection:
+      request[table_name]['ProjectionExpression'] = projection
+    for attempt in range(max_attempts):
+      response = dynamodb.batch_get_item(RequestItems=request)
+      items.extend(response.get('Responses', {}).get(table_name, []))
+      request = response.get('UnprocessedKeys') or {}
+      if not request:
+        break
+      time.sleep(min(0.05 * 2 ** attempt, 2))
+    if request:
+      raise RuntimeError(f"{len(request[table_name]['Keys'])} keys were left unprocessed by batch_get_item on {table_name}")
+  return items
+
+
+def batch_write_items(dynamodb, table_name, items, max_attempts=8):
+  for batch in chunked(items, BATCH_WRITE_LIMIT):
+    request = {table_name: [{'PutRequest': {'Item': item}} for item in batch]}
+    for attempt in range(max_attempts):
+      response = dynamodb.batch_write_item(RequestItems=request)
+      request = response.get('UnprocessedItems') or {}
+      if not request:
+        break
+      time.sleep(min(0.05 * 2 ** attempt, 2))
+    if request:
+      raise RuntimeError(f"{len(request[table_name])} items were left unprocessed by batch_write_item on {table_name}")
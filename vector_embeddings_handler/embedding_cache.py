@@ -0,0 +1,117 @@
+import hashlib
+import logging
+import os
+import threading
+from pathlib import Path
+import numpy as np
+from botocore.exceptions import ClientError
+from langchain_core.embeddings import Embeddings
+from dynamo_batch import batch_get_items, batch_write_items
+
+# Content-addressed cache of chunk embeddings. Entries are keyed by a hash of the embedding model name and
+# the chunk text, so re-ingesting a revised guide only sends the chunks that actually changed to the
+# embeddings API. Vectors are stored as raw float32 bytes.
+
+logger = logging.getLogger()
+
+
+def cache_key(model, text):
+  return hashlib.sha256(f"{model}\n{text}".encode("utf-8")).hexdigest()
+
+
+def encode_vector(vector):
+  return np.asarray(vector, dtype=np.float32).tobytes()
+
+
+def decode_vector(data):
+  return np.frombuffer(bytes(data), dtype=np.float32).tolist()
+
+
+class LocalEmbeddingCache:
+  def __init__(self, directory):
+    self.directory = Path(directory)
+    self.directory.mkdir(parents=True, exist_ok=True)
+
+  def get_many(self, keys):
+    found = {}
+    for key in keys:
+      path = self.directory / key
+      if path.exists():
+        found[key] = decode_vector(path.read_bytes())
+    return found
+
+  def put_many(self, entries):
+    for key, vector in entries.items():
+      (self.directory / key).write_bytes(encode_vector(vector))
+
+
+class DynamoDBEmbeddingCache:
+  def __init__(self, dynamodb, table_name="EmbeddingCache"):
+    self.dynamodb = dynamodb
+    self.table_name = table_name
+
+  def get_many(self, keys):
+    keys = list(dict.fromkeys(keys))
+    items = batch_get_items(self.dynamodb, self.table_name, [{'chunkHash': {'S': key}} for key in keys])
+    return {item['chunkHash']['S']: decode_vector(item['vector']['B']) for item in items}
+
+  def put_many(self, entries):
+    batch_write_items(self.dynamodb, self.table_name,
+      [{'chunkHash': {'S': key}, 'vector': {'B': encode_vector(vector)}} for key, vector in entries.items()])
+
+
+class CachedEmbeddings(Embeddings):
+  def __init__(self, underlying, cache, model):
+    self.underlying = underlying
+    self.cache = cache
+    self.model = model
+    self.hits = 0
+    self.misses = 0
+    self._stats_lock = threading.Lock()
+
+  def embed_documents(self, texts):
+    keys = [cache_key(self.model, text) for text in texts]
+    try:
+      cached = self.cache.get_many(keys)
+    except ClientError as e:
+      logger.warning(f"Embedding cache lookup failed, embedding every chunk: {str(e)}")
+      cached = {}
+
+    missing = {}
+    for key, text in zip(keys, texts):
+      if key not in cached:
+        missing.setdefault(key, text)
+    misses = sum(1 for key in keys if key not in cached)
+    with self._stats_lock:
+      self.hits += len(keys) - misses
+      self.misses += misses
+
+    if missing:
+      vectors = self.underlying.embed_documents(list(missing.values()))
+      # Round through float32 so fresh and cached vectors are identical, as FAISS stores them anyway
+      embedded = {key: decode_vector(encode_vector(vector)) for key, vector in zip(missing.keys(), vectors)}
+      try:
+        self.cache.put_many(embedded)
+      except ClientError as e:
+        logger.warning(f"Embedding cache write failed: {str(e)}")
+      cached.update(embedded)
+
+    return [cached[key] for key in keys]
+
+  def embed_query(self, text):
+    return self.underlying.embed_query(text)
+
+  def stats(self):
+    total = self.hits + self.misses
+    return {'hits': self.hits, 'misses': self.misses, 'hit_rate': round(self.hits / total, 4) if total else 0.0}
+
+
+def create_embedding_cache(dynamodb):
+  backend = os.getenv('EMBEDDING_CACHE', 'dynamodb')
+  if backend == 'dynamodb':
+    return DynamoDBEmbeddingCache(dynamodb, os.getenv('EMBEDDING_CACHE_TABLE', 'EmbeddingCache'))
+  if backend == 'local':
+    return LocalEmbeddingCache(os.getenv('EMBEDDING_CACHE_DIR', '/tmp/embedding_cache'))
+  if backend == 'none':
+    return None
+  raise ValueError(f"Unknown EMBEDDING_CACHE backend '{backend}'")
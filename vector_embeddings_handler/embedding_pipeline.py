@@ -0,0 +1,142 @@
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from shared.tokens import estimate_tokens
+
+# Embeds chunks in token-sized batches sent concurrently through a bounded thread pool. Concurrency backs off
+# multiplicatively whenever the API answers 429 and creeps back up as batches succeed; 429s, 5xx and
+# connection errors are retried with jittered exponential backoff (or the server's Retry-After). Finished
+# batches are handed to `on_batch` on the calling thread as they arrive, so they can be streamed into a FAISS
+# index (which is not thread-safe). With a CachedEmbeddings model every finished batch is also written to the
+# embedding cache, which acts as the checkpoint: a run stopped at its deadline resumes from the cache.
+
+logger = logging.getLogger()
+
+MAX_BATCH_ITEMS = 2048
+
+
+def token_batches(documents, max_tokens, max_items=MAX_BATCH_ITEMS):
+  batch = []
+  batch_tokens = 0
+  for document in documents:
+    tokens = estimate_tokens(document.page_content)
+    if batch and (batch_tokens + tokens > max_tokens or len(batch) >= max_items):
+      yield batch
+      batch = []
+      batch_tokens = 0
+    batch.append(document)
+    batch_tokens += tokens
+  if batch:
+    yield batch
+
+
+def is_rate_limit_error(error):
+  return getattr(error, "status_code", None) == 429 or type(error).__name__ == "RateLimitError"
+
+
+def is_transient_error(error):
+  status_code = getattr(error, "status_code", None)
+  return is_rate_limit_error(error) or (status_code is not None and status_code >= 500) \
+    or type(error).__name__ in ("APIConnectionError", "APITimeoutError")
+
+
+def retry_after_seconds(error):
+  response = getattr(error, "response", None)
+  headers = getattr(response, "headers", None) or {}
+  try:
+    return float(headers.get("retry-after"))
+  except (TypeError, ValueError):
+    return None
+
+
+class AdaptiveConcurrency:
+  def __init__(self, max_concurrency):
+    self.max_concurrency = max_concurrency
+    self.limit = max_concurrency
+    self.active = 0
+    self.condition = threading.Condition()
+
+  def acquire(self):
+    with self.condition:
+      while self.active >= self.limit:
+        self.condition.wait()
+      self.active += 1
+
+  def release(self, rate_limited=False):
+    with self.condition:
+      self.active -= 1
+      if rate_limited:
+        self.limit = max(1, self.limit // 2)
+      else:
+        self.limit = min(self.max_concurrency, self.limit + 1)
+      self.condition.notify_all()
+
+
+class EmbeddingDeadlineExceeded(Exception):
+  pass
+
+
+class EmbeddingPipeline:
+  def __init__(self, embeddings, max_batch_tokens=8000, max_concurrency=4, max_retries=6, base_delay=1.0, max_delay=30.0):
+    self.embeddings = embeddings
+    self.max_batch_tokens = max_batch_tokens
+    self.max_concurrency = max_concurrency
+    self.max_retries = max_retries
+    self.base_delay = base_delay
+    self.max_delay = max_delay
+    self.concurrency = AdaptiveConcurrency(max_concurrency)
+    self._stats_lock = threading.Lock()
+    self.stats = {"batches": 0, "chunks": 0, "rate_limited": 0, "retries": 0, "skipped_batches": 0, "tokens": 0, "seconds": 0.0}
+
+  def _count(self, name, amount=1):
+    with self._stats_lock:
+      self.stats[name] += amount
+
+  def _embed_batch(self, batch, deadline):
+    texts = [document.page_content for document in batch]
+    for attempt in range(self.max_retries + 1):
+      if deadline is not None and time.monotonic() >= deadline:
+        raise EmbeddingDeadlineExceeded()
+      self.concurrency.acquire()
+      rate_limited = False
+      try:
+        return self.embeddings.embed_documents(texts)
+      except Exception as e:
+        if not is_transient_error(e) or attempt == self.max_retries:
+          raise
+        error = e
+        rate_limited = is_rate_limit_error(e)
+        self._count("rate_limited", int(rate_limited))
+        self._count("retries")
+      finally:
+        self.concurrency.release(rate_limited)
+      delay = retry_after_seconds(error) or random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+      logger.info(f"Embedding batch failed with {type(error).__name__}, retrying in {delay:.2f}s (concurrency limit {self.concurrency.limit})")
+      time.sleep(delay)
+
+  # Returns False when the run stopped at `deadline` (a time.monotonic() value) with batches left over
+  def run(self, documents, on_batch, deadline=None):
+    started = time.monotonic()
+    batches = list(token_batches(documents, self.max_batch_tokens))
+    completed = True
+    with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+      futures = {executor.submit(self._embed_batch, batch, deadline): batch for batch in batches}
+      for future in as_completed(futures):
+        batch = futures[future]
+        try:
+          vectors = future.result()
+        except EmbeddingDeadlineExceeded:
+          completed = False
+          self._count("skipped_batches")
+          continue
+        on_batch(batch, vectors)
+        self._count("batches")
+        self._count("chunks", len(batch))
+        self._count("tokens", sum(estimate_tokens(document.page_content) for document in batch))
+    # Totals accumulate over every run of this pipeline
+    self.stats["seconds"] = round(self.stats["seconds"] + time.monotonic() - started, 3)
+    self.stats["chunks_per_second"] = round(self.stats["chunks"] / self.stats["seconds"], 1) if self.stats["seconds"] else 0.0
+    logger.info(f"Embedding pipeline finished: {self.stats}")
+    return completed
@@ -0,0 +1,88 @@
+import time
+import logging
+from botocore.exceptions import ClientError
+from shared.index_manifest import INDEX_PREFIX, ManifestConflict, new_version, read_manifest, version_prefix, write_manifest
+
+# Loads the currently published index version and publishes a new one: the index files are uploaded once
+# under a fresh indices/<version>/ prefix and the manifest is then swapped to point at it. Versions that
+# fall out of the manifest's history are deleted, keeping a few behind so readers still downloading an older
+# version are not cut off. Files only the indexer itself needs (the flat working index behind an approximate
+# one) are published as `builder_files`, which readers don't download. A user's index is published the same
+# way under its own `prefix`.
+
+logger = logging.getLogger()
+
+
+class IndexPublisher:
+  def __init__(self, s3, bucket, base_file_name, keep_versions=3, prefix=INDEX_PREFIX):
+    self.s3 = s3
+    self.bucket = bucket
+    self.base_file_name = base_file_name
+    self.prefix = prefix
+    self.keep_versions = keep_versions
+    self.manifest, self.manifest_etag = None, None
+
+  def read_current(self):
+    self.manifest, self.manifest_etag = read_manifest(self.s3, self.bucket, self.prefix)
+    return self.manifest
+
+  def download_current(self, file_path):
+    # Returns False when nothing has been published yet
+    if self.manifest is not None:
+      prefix = self.manifest['prefix']
+      files = self.manifest['files'] + self.manifest.get('builder_files', [])
+    else:
+      # Indexes published before versioning sit directly under indices/
+      prefix = self.prefix
+      files = [f"{self.base_file_name}.faiss", f"{self.base_file_name}.pkl"]
+    try:
+      for file_name in files:
+        self.s3.download_file(self.bucket, f"{prefix}{file_name}", f"{file_path}{file_name}")
+    except ClientError as e:
+      if self.manifest is None and e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey'):
+        return False
+      raise
+    logger.info(f"Downloaded FAISS index version {self.manifest['version'] if self.manifest else 'legacy'}")
+    return True
+
+  def publish(self, file_path, files, stats=None, builder_files=()):
+    version = new_version()
+    prefix = version_prefix(version, self.prefix)
+    uploaded = list(files) + list(builder_files)
+    for file_name in uploaded:
+      self.s3.upload_file(Filename=f"{file_path}{file_name}", Bucket=self.bucket, Key=f"{prefix}{file_name}")
+
+    history = [version] + (self.manifest or {}).get('history', [])
+    manifest = {
+      'version': version,
+      'prefix': prefix,
+      'files': list(files),
+      'builder_files': list(builder_files),
+      'published_at': int(time.time()),
+      'history': history[:self.keep_versions],
+      **(stats or {}),
+    }
+    try:
+      write_manifest(self.s3, self.bucket, manifest, self.manifest_etag, self.prefix)
+    except ManifestConflict:
+      self._delete_version(version)
+      raise
+    logger.info(f"Published FAISS index version {version}")
+
+    for old_version in history[self.keep_versions:]:
+      self._delete_version(old_version)
+    self.manifest = manifest
+    return manifest
+
+  def _delete_version(self, version):
+    # Everything under the version's prefix: older versions may have been published with other files, such
+    # as a .pkl docstore or the flat builder index of an approximate one
+    listing = {'Bucket': self.bucket, 'Prefix': version_prefix(version, self.prefix)}
+    while True:
+      response = self.s3.list_objects_v2(**listing)
+      keys = [{'Key': entry['Key']} for entry in response.get('Contents', [])]
+      if keys:
+        self.s3.delete_objects(Bucket=self.bucket, Delete={'Objects': keys})
+      if not response.get('IsTruncated'):
+        return
+      listing['ContinuationToken'] = response['NextContinuationToken']
@@ -0,0 +1,71 @@
+import logging
+import math
+import faiss
+import numpy as np
+
+# Builds the FAISS index that is published for serving from the indexer's flat working index. Approximate
+# types trade some recall for smaller files and faster searches on large corpora:
+#
+#   flat      exact search, 4 bytes per dimension (the working index itself)
+#   ivf_flat  inverted lists over k-means cells, full vectors; `nprobe` cells are searched per query
+#   hnsw      HNSW graph over full vectors; no training, larger than flat
+#   ivf_pq    inverted lists with product-quantized vectors, `pq_m` bytes per vector
+#   ivf_sq8   inverted lists with 8-bit scalar-quantized vectors, 1 byte per dimension
+#
+# IVF quantizers are trained on a random sample of the vectors. The vectors are added in row order, so the
+# published index lines up with the chunk store rows exactly like the flat one, and IVF indexes keep a
+# direct map so the chat retriever can reconstruct candidate vectors for MMR. Corpora smaller than
+# `min_vectors` always stay flat, where brute force is fast and training would be unreliable.
+
+logger = logging.getLogger()
+
+INDEX_TYPES = ("flat", "ivf_flat", "hnsw", "ivf_pq", "ivf_sq8")
+ADD_BATCH_VECTORS = 65536
+
+
+def default_nlist(count):
+  # ~4 * sqrt(n) cells, with enough training points per cell for k-means
+  return max(1, min(int(4 * math.sqrt(count)), count // 39))
+
+
+def factory_string(index_type, count, dimensions, nlist=None, hnsw_m=32, pq_m=None):
+  nlist = nlist or default_nlist(count)
+  if index_type == "flat":
+    return "Flat"
+  if index_type == "ivf_flat":
+    return f"IVF{nlist},Flat"
+  if index_type == "hnsw":
+    return f"HNSW{hnsw_m}"
+  if index_type == "ivf_pq":
+    pq_m = pq_m or max(1, dimensions // 16)
+    if dimensions % pq_m:
+      raise ValueError(f"INDEX_PQ_M={pq_m} does not divide the {dimensions} embedding dimensions")
+    return f"IVF{nlist},PQ{pq_m}"
+  if index_type == "ivf_sq8":
+    return f"IVF{nlist},SQ8"
+  raise ValueError(f"Unknown index type '{index_type}', expected one of {INDEX_TYPES}")
+
+
+def build_index(flat_index, index_type, nlist=None, nprobe=16, hnsw_m=32, ef_search=64, pq_m=None,
+                train_sample=50000, min_vectors=10000, seed=0):
+  # Returns `flat_index` itself when the index stays flat
+  count = flat_index.ntotal
+  if index_type == "flat" or count < min_vectors:
+    return flat_index
+  spec = factory_string(index_type, count, flat_index.d, nlist, hnsw_m, pq_m)
+  index = faiss.index_factory(flat_index.d, spec, flat_index.metric_type)
+
+  if not index.is_trained:
+    sample = np.sort(np.random.default_rng(seed).choice(count, size=min(count, train_sample), replace=False))
+    index.train(flat_index.reconstruct_batch(sample.astype(np.int64)))
+  for start in range(0, count, ADD_BATCH_VECTORS):
+    index.add(flat_index.reconstruct_n(start, min(ADD_BATCH_VECTORS, count - start)))
+
+  ivf = faiss.try_extract_index_ivf(index)
+  if ivf is not None:
+    ivf.nprobe = nprobe
+    ivf.make_direct_map()
+  if hasattr(index, "hnsw"):
+    index.hnsw.efSearch = ef_search
+  logger.info(f"Built {spec} index over {count} vectors")
+  return index
@@ -1,192 +1,374 @@
 import os
+import time
+import itertools
+import uuid
 import resource
 import boto3
+import faiss
 from pathlib import Path
 from langchain.schema import Document
 from langchain_openai import OpenAIEmbeddings
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_community.vectorstores import FAISS
+from embedding_cache import CachedEmbeddings, create_embedding_cache
+from embedding_pipeline import EmbeddingPipeline
+from vector_metadata import VectorMetadataStore
+from index_publisher import IndexPublisher
+from index_types import build_index
+from shared.index_manifest import BASE_FILE_NAME, ManifestConflict, index_prefix
+from shared.chunk_store import FORMAT as CHUNK_STORE_FORMAT, file_names as chunk_store_file_names, load_faiss_store, write_faiss_store
+from shared.tracing import Tracer, count, span
 import logging
 
-# This function synchronizes documents stored in DynamoDB with a FAISS vector index. It splits the documents into smaller chunks, generates embeddings, creates a FAISS index, stores the index in S3, and keeps track of vector IDs in DynamoDB. It also includes logic to reload and update the vectors in the FAISS index if the documents are updated.
+# This function synchronizes documents stored in DynamoDB with a FAISS vector index. It splits the documents into smaller chunks, generates embeddings, and publishes the index to S3 once per run as a new version behind the index manifest, keeping track of vector IDs in DynamoDB.
+# In 'incremental' mode (the default) the published index is loaded and only the pending documents are touched: vectors of updated documents are removed using the IDs stored in VectorMetadata and the new chunks are appended, so indexing cost scales with the size of the change. 'rebuild' mode builds a fresh index from every pending and indexed document.
+# Documents are claimed before they are processed so concurrent runs never index the same document twice, and are flipped from 'pending' to 'indexed' once the index holding their vectors has been published.
+# A run with a user_id in its event indexes that user's documents into the user's own index; without one it indexes the shared corpus, i.e. the documents that belong to no user.
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-def lambda_handler(event, context):
+BUCKET_NAME = "compost-chatbot-bucket"
+INDEX_MODES = ("incremental", "rebuild")
+# Flat working index published next to an approximate serving index, so incremental runs keep exact vectors
+FLAT_INDEX_SUFFIX = ".flat.faiss"
+
+# Stage timings and indexing counts of every run, emitted as one metrics record each
+tracer = Tracer("vector_embeddings_handler")
+
+def index_documents(event, context):
+  metadata = None
+  claimed_document_ids = []
   try:
 
     logger.info(f"Lambda function memory size: {os.environ['AWS_LAMBDA_FUNCTION_MEMORY_SIZE']} MB")
     logger.info(f"Lambda log group name: {os.environ['AWS_LAMBDA_LOG_GROUP_NAME']}")
 
+    mode = (event or {}).get('mode') or os.getenv('INDEX_MODE', 'incremental')
+    if mode not in INDEX_MODES:
+      raise ValueError(f"Unknown index mode '{mode}', expected one of {INDEX_MODES}")
+    user_id = (event or {}).get('user_id')
+    prefix = index_prefix(user_id)
+
     dynamodb = boto3.client('dynamodb')
+    s3 = boto3.client("s3")
 
-    def query_documents_by_status(status):
+    def query_documents_by_status(status, page_size):
+      # Yields one DynamoDB page at a time so only `page_size` documents (and their chunks) are held in memory
       logger.info("Querying documents by status")
-      response = dynamodb.query(
-        TableName = 'DocumentMetadata',
-        IndexName = 'status-index',
-        KeyConditionExpression = '#s = :status',
-        ExpressionAttributeNames={'#s': 'status'},
-        ExpressionAttributeValues={':status': {'S': status}}
-      )
-      logger.info(f"Documents with status '{status}': {response.get('Items', [])}")
-      return response.get('Items', [])
+      if user_id is None:
+        query_kwargs = dict(
+          TableName = 'DocumentMetadata',
+          IndexName = 'status-index',
+          KeyConditionExpression = '#s = :status',
+          FilterExpression = 'attribute_not_exists(userId)',
+          ExpressionAttributeNames={'#s': 'status'},
+          ExpressionAttributeValues={':status': {'S': status}},
+          Limit = page_size,
+        )
+      else:
+        query_kwargs = dict(
+          TableName = 'DocumentMetadata',
+          IndexName = 'userId-index',
+          KeyConditionExpression = 'userId = :user',
+          FilterExpression = '#s = :status',
+          ExpressionAttributeNames={'#s': 'status'},
+          ExpressionAttributeValues={':user': {'S': user_id}, ':status': {'S': status}},
+          Limit = page_size,
+        )
+      if status == 'indexing':
+        # Only claims whose lease expired; live ones, including the claims this run just made, are skipped
+        query_kwargs['FilterExpression'] += ' AND claimedAt < :cutoff'
+        query_kwargs['ExpressionAttributeValues'][':cutoff'] = {'N': str(int(time.time()) - metadata.lease_seconds)}
+      while True:
+        with span('dynamodb'):
+          response = dynamodb.query(**query_kwargs)
+        items = response.get('Items', [])
+        logger.info(f"Fetched page of {len(items)} documents with status '{status}'")
+        if items:
+          yield items
+        if 'LastEvaluatedKey' not in response:
+          return
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def document_text(document):
+      # Large extracted texts are offloaded to S3 by the ingestion handler
+      if "text" in document:
+        return document["text"]["S"]
+      with span('s3_download'):
+        response = s3.get_object(Bucket=document["textBucket"]["S"], Key=document["textKey"]["S"])
+        return response["Body"].read().decode("utf-8")
 
     def split_document(document, documentId, title):
       logger.info(f"Splitting document {documentId}")
       chunk_size = 512
       chunk_overlap = 32
       text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-      documents = [Document(page_content=chunk, metadata={"documentId": documentId, "title": title})
-              for chunk in text_splitter.split_text(document)]
+      # The chunk position lets the chat handler merge neighbouring chunks back together
+      with span('splitting'):
+        documents = [Document(page_content=chunk, metadata={"documentId": documentId, "title": title, "chunk": position})
+                for position, chunk in enumerate(text_splitter.split_text(document))]
       logger.info(f"Split {documentId} into {len(documents)} chunks")
       return documents
               
-    def store_vectors_to_dynamo_db(document_id, vectors):
-      logger.info(f"Storing vector IDs for document {document_id}")
-      table_name = "VectorMetadata"
-      dynamodb.put_item(
-        TableName = table_name,
-        Item = {
-          'documentId': {'S': document_id},
-          'vectors': {'SS': vectors}
-        }
-      )
-
-    def get_vectors_from_faiss_index(documents, db, index_to_docstore_id):
-      logger.info("Getting vectors from FAISS index")
-      document_vectors = {}
-      for i in range(len(documents)):
-        document = db.docstore.search(index_to_docstore_id[i])
-        if document:
-          if document.metadata["documentId"] not in document_vectors:
-            document_vectors[document.metadata["documentId"]] = [index_to_docstore_id[i]]
-          else:
-            document_vectors[document.metadata["documentId"]].append(index_to_docstore_id[i])
-      logger.info(f"Retrieved vector IDs from FAISS index")
-      return document_vectors
-
-
-    # Query documents with 'pending' status
-    documents = query_documents_by_status('pending')
+    metadata = VectorMetadataStore(dynamodb, str(uuid.uuid4()), lease_seconds=int(os.getenv('INDEX_CLAIM_LEASE_SECONDS', '900')))
+    claimable_statuses = ('pending', 'indexed') if mode == 'rebuild' else ('pending',)
+
+    # Query documents with 'pending' status, one page at a time. Documents left 'indexing' by a run that
+    # crashed are picked up again once their claim has expired
+    page_size = int(os.getenv('INDEX_PAGE_SIZE', '25'))
+    pages = itertools.chain.from_iterable(
+      query_documents_by_status(status, page_size) for status in claimable_statuses + ('indexing',)
+    )
+    first_page = next(pages, None)
 
-    if not documents:
+    if first_page is None:
       logger.info("No pending documents found")
       return {
         'statusCode': 200,
         'body': 'No pending documents found.'
       }
 
-    # Split the documents into chunks
-    all_split_documents = []
-    for document in documents:
-      all_split_documents.extend(split_document(document["text"]["S"], document["documentId"]["S"], document["title"]["S"]))
-    logger.info("Documents split into chunks")
-
     openai_api_key = os.getenv('OPENAI_API_KEY')
     if not openai_api_key:
       raise ValueError("OPENAI_API_KEY environment variable is not set")
+    embedding_model_name = "text-embedding-3-small"
+    # Retries are left to the embedding pipeline, which also adapts its concurrency to 429s
     embeddings_model = OpenAIEmbeddings(
-      client = None, model = "text-embedding-3-small"
+      client = None, model = embedding_model_name, max_retries = 0
     )
 
-    # Create a FAISS index from the split documents
-    db = FAISS.from_documents(all_split_documents, embeddings_model)
-    logger.info("FAISS index created")
+    # Only chunks missing from the embedding cache are sent to the embeddings API
+    embedding_cache = create_embedding_cache(dynamodb)
+    if embedding_cache is not None:
+      embeddings_model = CachedEmbeddings(embeddings_model, embedding_cache, embedding_model_name)
 
-    # Save the FAISS index locally
-    file_path = "/tmp/"
+    file_path = f"/tmp/users/{user_id}/" if user_id is not None else "/tmp/"
     Path(file_path).mkdir(parents=True, exist_ok=True)
-    base_file_name = "faiss_index"
-
-    faiss_local_path = f"{file_path}{base_file_name}.faiss"
-    pkl_local_path = f"{file_path}{base_file_name}.pkl"
+    base_file_name = BASE_FILE_NAME
+
+    # The manifest is read in both modes so publishing can detect a concurrent run's version
+    publisher = IndexPublisher(s3, BUCKET_NAME, base_file_name, keep_versions=int(os.getenv('INDEX_VERSIONS_TO_KEEP', '3')), prefix=prefix)
+    publisher.read_current()
+    db = None
+    with span('s3_download'):
+      downloaded = mode == "incremental" and publisher.download_current(file_path)
+    if downloaded:
+      with span('index_load'):
+        if (publisher.manifest or {}).get('format') == CHUNK_STORE_FORMAT:
+          db = load_faiss_store(file_path, base_file_name, embeddings_model)
+          flat_file = f"{base_file_name}{FLAT_INDEX_SUFFIX}"
+          if flat_file in publisher.manifest.get('builder_files', []):
+            db.index = faiss.read_index(f"{file_path}{flat_file}")
+        else:
+          # Indexes published before the chunk store format still carry a pickled docstore
+          db = FAISS.load_local(
+                index_name=base_file_name,
+                folder_path=file_path,
+                embeddings=embeddings_model,
+                allow_dangerous_deserialization=True,
+            )
+    elif mode == "incremental":
+      logger.info("No published FAISS index found, starting a new one")
+    logger.info(f"Indexing pending documents in {mode} mode")
+
+    document_vectors = {}
+    page_vector_ids = []
+
+    def add_batch_to_index(batch, vectors):
+      nonlocal db
+      vector_ids = [str(uuid.uuid4()) for _ in batch]
+      text_embeddings = [(chunk.page_content, vector) for chunk, vector in zip(batch, vectors)]
+      metadatas = [chunk.metadata for chunk in batch]
+      if db is None:
+        db = FAISS.from_embeddings(text_embeddings, embeddings_model, metadatas=metadatas, ids=vector_ids)
+        logger.info("FAISS index created")
+      else:
+        db.add_embeddings(text_embeddings, metadatas=metadatas, ids=vector_ids)
+      page_vector_ids.extend(vector_ids)
+      for chunk, vector_id in zip(batch, vector_ids):
+        document_vectors.setdefault(chunk.metadata["documentId"], []).append(vector_id)
+
+    pipeline = EmbeddingPipeline(
+      embeddings_model,
+      max_batch_tokens=int(os.getenv('EMBEDDING_BATCH_TOKENS', '8000')),
+      max_concurrency=int(os.getenv('EMBEDDING_CONCURRENCY', '4')),
+    )
+    # Stop embedding early enough to leave time for publishing; finished batches are already in the
+    # embedding cache, so the next run picks up where this one stopped
+    deadline = None
+    if hasattr(context, 'get_remaining_time_in_millis'):
+      deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - int(os.getenv('EMBEDDING_DEADLINE_MARGIN_SECONDS', '60'))
+
+    # Stream pages through split -> embed -> add to index
+    processed_document_ids = []
+    vectors_removed = 0
+    page_stats = []
+    completed = True
+    for page_number, documents in enumerate(itertools.chain([first_page], pages), start=1):
+      page_started = time.monotonic()
+      page_vector_ids.clear()
+      page_document_ids = metadata.claim([document["documentId"]["S"] for document in documents], claimable_statuses)
+      claimed_document_ids.extend(page_document_ids)
+      claimed = set(page_document_ids)
+      chunks = []
+      for document in documents:
+        if document["documentId"]["S"] in claimed:
+          chunks.extend(split_document(document_text(document), document["documentId"]["S"], document["title"]["S"]))
+      del documents
+      if not page_document_ids:
+        continue
+
+      with span('embedding'):
+        embedded = pipeline.run(chunks, add_batch_to_index, deadline=deadline)
+      if not embedded:
+        # Roll back the part of the page that made it into the index; its documents are released
+        logger.info(f"Embedding stopped at the deadline on page {page_number}")
+        if page_vector_ids:
+          db.delete(list(page_vector_ids))
+        for documentId in page_document_ids:
+          document_vectors.pop(documentId, None)
+        metadata.release(page_document_ids)
+        completed = False
+        break
+
+      # Remove the stale vectors of documents that were re-indexed
+      if db is not None:
+        indexed_ids = set(db.index_to_docstore_id.values()) - set(page_vector_ids)
+        stored_vectors = metadata.get_vectors(page_document_ids)
+        for documentId in page_document_ids:
+          stale_vectors = [vector_id for vector_id in stored_vectors.get(documentId, []) if vector_id in indexed_ids]
+          if stale_vectors:
+            logger.info(f"Deleting {len(stale_vectors)} stale vectors for document {documentId}")
+            db.delete(stale_vectors)
+            vectors_removed += len(stale_vectors)
+
+      processed_document_ids.extend(page_document_ids)
+      page_seconds = time.monotonic() - page_started
+      page_stats.append({
+        'page': page_number,
+        'documents': len(page_document_ids),
+        'chunks': len(chunks),
+        'seconds': round(page_seconds, 3),
+        'chunks_per_second': round(len(chunks) / page_seconds, 1) if page_seconds else 0.0,
+      })
+      logger.info(f"Page throughput: {page_stats[-1]}")
+
+    if not completed and (mode == 'rebuild' or not processed_document_ids):
+      # A rebuild publishes the whole index, so one cut short would drop every document it did not reach;
+      # the previous version stays published and the claimed documents go back to the status they had
+      metadata.release(processed_document_ids)
+      return {
+        'statusCode': 200,
+        'body': {
+          'status': 'incomplete',
+          'message': 'Embedding stopped before the Lambda deadline; documents keep their status and the next run resumes from the embedding cache.',
+          'mode': mode,
+          'documents_processed': 0,
+          'embedding': pipeline.stats,
+          'embedding_cache': embeddings_model.stats() if embedding_cache is not None else None,
+        }
+      }
+    if not processed_document_ids:
+      # Every pending document was claimed by another run; publishing an unchanged index would only make the
+      # chat handlers reload it and drop their cached answers
+      logger.info("No documents were claimed by this run")
+      return {
+        'statusCode': 200,
+        'body': 'Nothing to index: the pending documents are claimed by other runs.'
+      }
+    if db is None:
+      raise ValueError("Pending documents produced no chunks and there is no published index to update")
 
-    logger.info(f"Saving FAISS index to {faiss_local_path} and {pkl_local_path}")
+    # Save the FAISS index locally in the pickle-free chunk store format
+    index_files = chunk_store_file_names(base_file_name)
+    logger.info(f"Saving FAISS index to {file_path}: {index_files}")
 
-    db.save_local(index_name=base_file_name, folder_path=file_path)
+    with span('index_write'):
+      write_faiss_store(file_path, base_file_name, db)
     logger.info("FAISS index saved locally")
 
-    if not os.path.exists(faiss_local_path):
-            raise FileNotFoundError(f"FAISS file {faiss_local_path} not found")
-    if not os.path.exists(pkl_local_path):
-        raise FileNotFoundError(f"PKL file {pkl_local_path} not found")
-
-
-    # Upload the FAISS index files to S3
-    s3 = boto3.client("s3")
-
-    faiss_file_path = f"indices/{base_file_name}.faiss"  
-    pkl_file_path = f"indices/{base_file_name}.pkl"
-
-    s3.upload_file(
-        Filename=f"{file_path}{base_file_name}.faiss",
-        Bucket="compost-chatbot-bucket",     
-        Key=faiss_file_path                  
-    )
-
-    s3.upload_file(
-        Filename=f"{file_path}{base_file_name}.pkl",
-        Bucket="compost-chatbot-bucket",
-        Key=pkl_file_path
-    )
-    logger.info("FAISS index uploaded to S3")
-
-    # Retrieve vectors from the FAISS index and store their IDs in DynamoDB
-    document_vectors = get_vectors_from_faiss_index(all_split_documents, db, db.index_to_docstore_id)
-    for documentId, vectors in document_vectors.items():
-      store_vectors_to_dynamo_db(documentId, vectors)
-
-     # Reload the FAISS index from S3
-    file_path = "/tmp/"
-    base_file_name = "faiss_index"
-    s3.download_file('compost-chatbot-bucket', f"indices/{base_file_name}.faiss", f"{file_path}{base_file_name}.faiss")
-    s3.download_file('compost-chatbot-bucket', f"indices/{base_file_name}.pkl", f"{file_path}{base_file_name}.pkl")
-    logger.info("FAISS index downloaded from S3")
-
-    db = FAISS.load_local(
-          index_name=base_file_name,
-          folder_path=file_path,
-          embeddings=embeddings_model,
-          allow_dangerous_deserialization=True,
+    # With INDEX_TYPE set, an approximate index trained on a sample of the vectors is served instead of the
+    # flat one, which is kept as a builder file for the next incremental run
+    with span('index_build'):
+      serving_index = build_index(
+        db.index,
+        os.getenv('INDEX_TYPE', 'flat'),
+        nlist=int(os.getenv('INDEX_NLIST', '0')) or None,
+        nprobe=int(os.getenv('INDEX_NPROBE', '16')),
+        hnsw_m=int(os.getenv('INDEX_HNSW_M', '32')),
+        ef_search=int(os.getenv('INDEX_HNSW_EF_SEARCH', '64')),
+        pq_m=int(os.getenv('INDEX_PQ_M', '0')) or None,
+        train_sample=int(os.getenv('INDEX_TRAIN_SAMPLE', '50000')),
+        min_vectors=int(os.getenv('INDEX_MIN_APPROXIMATE_VECTORS', '10000')),
       )
+      builder_files = []
+      if serving_index is not db.index:
+        builder_files.append(f"{base_file_name}{FLAT_INDEX_SUFFIX}")
+        os.replace(f"{file_path}{base_file_name}.faiss", f"{file_path}{builder_files[0]}")
+        faiss.write_index(serving_index, f"{file_path}{base_file_name}.faiss")
+    index_type = type(serving_index).__name__
+
+    for file_name in index_files:
+      if not os.path.exists(f"{file_path}{file_name}"):
+        raise FileNotFoundError(f"Index file {file_path}{file_name} not found")
+
+
+    # Publish the updated FAISS index to S3 once, as a new version behind the manifest
+    try:
+      with span('s3_upload'):
+        manifest = publisher.publish(file_path, index_files, {
+          'format': CHUNK_STORE_FORMAT,
+          'documents_indexed': len(processed_document_ids),
+          'vectors': db.index.ntotal,
+          'index_type': index_type,
+        }, builder_files)
+    except ManifestConflict as e:
+      # Another run published first; this run's embeddings are cached, so the next run redoes it cheaply
+      logger.info(f"Index publication lost to a concurrent run: {str(e)}")
+      metadata.release(processed_document_ids)
+      return {
+        'statusCode': 409,
+        'body': {
+          'status': 'conflict',
+          'message': 'Another run published a new index version first; documents keep their status.',
+          'documents_processed': 0,
+        }
+      }
+
+    # Store the new vector IDs in DynamoDB so the next update can remove them, then mark the documents indexed
+    metadata.put_vectors(document_vectors)
+    metadata.mark_indexed(processed_document_ids)
+    logger.info(f"Document metadata stats: {metadata.stats}")
     
-    # Update or delete vectors as needed
-    for document in documents:
-          documentId = document["documentId"]["S"]
-          response = dynamodb.get_item(
-              TableName="VectorMetadata",
-              Key={"documentId": {"S": documentId}},
-          )
-
-          if "Item" in vectors:
-              vectors = response["Item"]["vectors"]["SS"]
-              logger.info(f"Deleting vectors for document {documentId}: {vectors}")
-              db.delete(vectors)
-
-          text = document["text"]["S"]
-          title = document["title"]["S"]
-          document_splits = split_document(text, documentId, title)
-          logger.info(f"Split document {documentId} into {len(document_splits)} chunks for updating vectors")
-          document_vectors = get_vectors_from_faiss_index(document_splits, db, db.index_to_docstore_id)
-          logger.info(f"Updating document {documentId} with vectors: {document_vectors}")
-
-          db.save_local(index_name=base_file_name, folder_path=file_path)
-          s3.upload_file(Filename=f"{file_path}/{base_file_name}.faiss", Bucket="compost-chatbot-bucket", Key=faiss_file_path)
-          s3.upload_file(Filename=f"{file_path}/{base_file_name}.pkl", Bucket="compost-chatbot-bucket", Key=pkl_file_path)
-
-          store_vectors_to_dynamo_db(documentId, vectors)
-    
+    if embedding_cache is not None:
+      logger.info(f"Embedding cache stats: {embeddings_model.stats()}")
+
     memory_usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
     logger.info(f"Memory usage: {memory_usage} KB")
+    count('documents_processed', len(processed_document_ids))
+    count('embedded_chunks', pipeline.stats['chunks'])
+    count('embedding_tokens', pipeline.stats['tokens'])
+    count('vectors_removed', vectors_removed)
+    count('index_vectors', db.index.ntotal)
     
 
     response_message = {
-            'status': 'success',
-            'message': 'Processed documents and updated FAISS index.',
-            'documents_processed': len(documents),
+            'status': 'success' if completed else 'incomplete',
+            'message': 'Processed documents and updated FAISS index.' if completed else
+              'Published the pages finished before the Lambda deadline; remaining documents stay pending.',
+            'mode': mode,
+            'user_id': user_id,
+            'documents_processed': len(processed_document_ids),
+            'documents_indexed': metadata.stats['indexed'],
+            'pages': page_stats,
             'vectors_stored': sum(len(vectors) for vectors in document_vectors.values()),
+            'vectors_removed': vectors_removed,
+            'index_size': db.index.ntotal,
+            'index_type': index_type,
+            'index_version': manifest['version'],
+            'embedding': pipeline.stats,
+            'embedding_cache': embeddings_model.stats() if embedding_cache is not None else None,
             'memory_usage': memory_usage
         }
     
@@ -198,9 +380,20 @@ def lambda_handler(event, context):
       }
   except Exception as e:
     logger.error(f"Error: {str(e)}")
+    count('errors')
+    if claimed_document_ids:
+      # Hand the claims back so the next run doesn't have to wait for their lease to expire; documents this
+      # run already marked indexed fail the release condition and keep their status
+      try:
+        metadata.release(claimed_document_ids)
+      except Exception as release_error:
+        logger.error(f"Could not release the claimed documents: {str(release_error)}")
     return {
       'statusCode': 500,
       'body': str(e)
     }
-  
 
+
+def lambda_handler(event, context):
+  with tracer.invocation(RequestId=getattr(context, 'aws_request_id', '')):
+    return index_documents(event, context)
@@ -0,0 +1,135 @@
+import time
+import logging
+from botocore.exceptions import ClientError
+from dynamo_batch import batch_get_items, batch_write_items, chunked
+from shared.tracing import timed
+
+# Bulk access to the indexer's DynamoDB state. Vector IDs are read and written with the batch APIs, and a
+# document moves pending -> indexing -> indexed through conditional writes: a run first claims a document
+# (so a concurrent run skips it), then flips every claimed document to 'indexed' in transactions once the
+# index containing its vectors has been published. Claims older than `lease_seconds` are treated as
+# abandoned by a crashed run and can be taken over. A released claim puts the document back in the status it
+# was claimed from, so an 'indexed' document claimed by a rebuild that did not publish stays 'indexed'.
+
+logger = logging.getLogger()
+
+DOCUMENT_TABLE = "DocumentMetadata"
+VECTOR_TABLE = "VectorMetadata"
+TRANSACTION_LIMIT = 100
+
+
+def is_conditional_check_failure(error):
+  return error.response.get('Error', {}).get('Code') in ('ConditionalCheckFailedException', 'TransactionCanceledException')
+
+
+class VectorMetadataStore:
+  def __init__(self, dynamodb, run_id, lease_seconds=900):
+    self.dynamodb = dynamodb
+    self.run_id = run_id
+    self.lease_seconds = lease_seconds
+    self.stats = {"claimed": 0, "claim_conflicts": 0, "indexed": 0, "index_conflicts": 0, "released": 0}
+    self._claimed_from = {}
+
+  @timed("dynamodb")
+  def get_vectors(self, document_ids):
+    if not document_ids:
+      return {}
+    items = batch_get_items(self.dynamodb, VECTOR_TABLE, [{'documentId': {'S': documentId}} for documentId in document_ids])
+    return {item['documentId']['S']: item['vectors']['SS'] for item in items}
+
+  @timed("dynamodb")
+  def put_vectors(self, document_vectors):
+    batch_write_items(self.dynamodb, VECTOR_TABLE, [
+      {'documentId': {'S': documentId}, 'vectors': {'SS': vectors}}
+      for documentId, vectors in document_vectors.items() if vectors
+    ])
+
+  @timed("dynamodb")
+  def claim(self, document_ids, claimable_statuses=('pending',)):
+    now = int(time.time())
+    values = {
+      ':indexing': {'S': 'indexing'},
+      ':run': {'S': self.run_id},
+      ':now': {'N': str(now)},
+      ':cutoff': {'N': str(now - self.lease_seconds)},
+    }
+    placeholders = []
+    for i, status in enumerate(claimable_statuses):
+      values[f':status{i}'] = {'S': status}
+      placeholders.append(f':status{i}')
+    condition = f"#s IN ({', '.join(placeholders)}) OR (#s = :indexing AND claimedAt < :cutoff)"
+
+    claimed = []
+    for documentId in document_ids:
+      try:
+        old = self.dynamodb.update_item(
+          TableName=DOCUMENT_TABLE,
+          Key={'documentId': {'S': documentId}},
+          UpdateExpression='SET #s = :indexing, claimedBy = :run, claimedAt = :now',
+          ConditionExpression=condition,
+          ExpressionAttributeNames={'#s': 'status'},
+          ExpressionAttributeValues=values,
+          ReturnValues='ALL_OLD',
+        ).get('Attributes', {})
+        # The status of a claim taken over from a crashed run is unknown, so it is released as pending
+        status = old.get('status', {}).get('S')
+        self._claimed_from[documentId] = status if status in claimable_statuses else 'pending'
+        claimed.append(documentId)
+      except ClientError as e:
+        if not is_conditional_check_failure(e):
+          raise
+        self.stats["claim_conflicts"] += 1
+        logger.info(f"Document {documentId} is claimed by another run, skipping")
+    self.stats["claimed"] += len(claimed)
+    return claimed
+
+  def _transition(self, documentId, status):
+    return {
+      'Update': {
+        'TableName': DOCUMENT_TABLE,
+        'Key': {'documentId': {'S': documentId}},
+        'UpdateExpression': 'SET #s = :status REMOVE claimedBy, claimedAt',
+        'ConditionExpression': '#s = :indexing AND claimedBy = :run',
+        'ExpressionAttributeNames': {'#s': 'status'},
+        'ExpressionAttributeValues': {
+          ':status': {'S': status},
+          ':indexing': {'S': 'indexing'},
+          ':run': {'S': self.run_id},
+        },
+      }
+    }
+
+  @timed("dynamodb")
+  def mark_indexed(self, document_ids):
+    # A document re-uploaded while it was being indexed has lost this run's claim; it fails the condition
+    # and stays pending so the next run indexes the new text
+    indexed = 0
+    for batch in chunked(list(document_ids), TRANSACTION_LIMIT):
+      try:
+        self.dynamodb.transact_write_items(TransactItems=[self._transition(documentId, 'indexed') for documentId in batch])
+        indexed += len(batch)
+        continue
+      except ClientError as e:
+        if not is_conditional_check_failure(e):
+          raise
+      for documentId in batch:
+        try:
+          self.dynamodb.transact_write_items(TransactItems=[self._transition(documentId, 'indexed')])
+          indexed += 1
+        except ClientError as e:
+          if not is_conditional_check_failure(e):
+            raise
+          self.stats["index_conflicts"] += 1
+          logger.info(f"Document {documentId} changed while it was being indexed, leaving it for the next run")
+    self.stats["indexed"] += indexed
+    return indexed
+
+  @timed("dynamodb")
+  def release(self, document_ids):
+    for documentId in document_ids:
+      try:
+        self.dynamodb.update_item(**self._transition(documentId, self._claimed_from.get(documentId, 'pending'))['Update'])
+        self.stats["released"] += 1
+      except ClientError as e:
+        if not is_conditional_check_failure(e):
+          raise